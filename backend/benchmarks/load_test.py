@@ -0,0 +1,414 @@
+"""
+Load and soak test of the HTTP API.
+
+Starts the FastAPI app in process, in a temporary working directory and with the stub models, and
+drives a mixed upload/query/delete workload at a configurable concurrency. Reports throughput,
+time to first token and latency percentiles per time window, with the event loop lag of the
+server and the growth of the resident set size of the process, as JSON.
+
+Usage (from the backend directory):
+    python benchmarks/load_test.py --duration 120 --concurrency 8 --mix query=8,upload=1,delete=1 --output load_test.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+from time import perf_counter as timer
+from time import sleep
+
+import numpy as np
+import psutil
+import requests
+import torch
+import uvicorn
+
+BACKEND_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIRECTORY)
+
+OPERATIONS = ("query", "upload", "delete")
+
+
+class ServerThread:
+    def __init__(self, app, port: int, lag_interval: float = 0.05):
+        """
+        Runs uvicorn on a background thread and measures the lag of its event loop.
+
+        A task on the server loop sleeps lag_interval seconds at a time, any time it wakes up late
+        is time the loop spent blocked by a request handler.
+
+        Parameters:
+        app (FastAPI): The application to serve.
+        port (int): The port to listen on, on 127.0.0.1.
+        lag_interval (float): The sleep interval of the lag probe in seconds. Defaults to 0.05.
+
+        Sets the following attributes:
+        loop_lag (list[tuple[float, float]]): The time of each probe and its lag in seconds.
+        """
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.lag_interval = lag_interval
+        self.loop_lag: list[tuple[float, float]] = []
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+
+    async def _monitor_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.loop_lag.append((timer(), max(loop.time() - start - self.lag_interval, 0.0)))
+
+    async def _serve(self):
+        monitor = asyncio.create_task(self._monitor_lag())
+        try:
+            await self.server.serve()
+        finally:
+            monitor.cancel()
+
+    def start(self, timeout: float = 600.0):
+        self._thread.start()
+        deadline = timer() + timeout
+        while not self.server.started:
+            if not self._thread.is_alive() or timer() > deadline:
+                raise RuntimeError("The server did not start")
+            sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self._thread.join()
+
+
+class RssSampler:
+    def __init__(self, interval: float = 0.5):
+        """
+        Samples the resident set size of the process on a background thread.
+
+        Parameters:
+        interval (float): The sampling interval in seconds. Defaults to 0.5.
+
+        Sets the following attributes:
+        samples (list[tuple[float, int]]): The time of each sample and the RSS in bytes.
+        """
+        self.interval = interval
+        self.process = psutil.Process()
+        self.samples: list[tuple[float, int]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.samples.append((timer(), self.process.memory_info().rss))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.samples.append((timer(), self.process.memory_info().rss))
+
+
+class Corpus:
+    def __init__(self, pdf_paths: list[str], min_documents: int = 1):
+        """
+        Tracks which PDFs of the pool are uploaded, so uploads always send a new document and
+        deletions always remove an existing one.
+
+        Parameters:
+        pdf_paths (list[str]): The paths of the pool of PDFs.
+        min_documents (int): Deletions never leave fewer documents than this. Defaults to 1.
+        """
+        self.available = list(pdf_paths)
+        self.uploaded: list[str] = []
+        self.min_documents = min_documents
+        self._busy: set[str] = set()
+        self._lock = threading.Lock()
+
+    def take(self, operation: str, rng: random.Random) -> str | None:
+        """
+        Reserves a PDF for an upload or a deletion, or returns None if there is none.
+        """
+        with self._lock:
+            if operation == "upload":
+                candidates = [path for path in self.available if path not in self._busy]
+            else:
+                idle = [path for path in self.uploaded if path not in self._busy]
+                candidates = idle if len(idle) > self.min_documents else []
+            if not candidates:
+                return None
+            path = rng.choice(candidates)
+            self._busy.add(path)
+            return path
+
+    def release(self, operation: str, path: str, succeeded: bool):
+        with self._lock:
+            self._busy.discard(path)
+            if succeeded:
+                source, target = (self.available, self.uploaded) if operation == "upload" else \
+                        (self.uploaded, self.available)
+                source.remove(path)
+                target.append(path)
+
+
+def upload(base_url: str, pdf_path: str, timeout: float) -> dict:
+    with open(pdf_path, "rb") as file:
+        response = requests.post(f"{base_url}/uploadFiles/",
+                                 files=[("files", (os.path.basename(pdf_path), file, "application/pdf"))],
+                                 timeout=timeout)
+    ok = response.ok and os.path.basename(pdf_path) in response.json().get("newly_added_pdfs", [])
+    return {"ok": ok, "status": response.status_code}
+
+
+def delete(base_url: str, pdf_path: str, timeout: float) -> dict:
+    response = requests.delete(f"{base_url}/delete", params={"pdf_name": os.path.basename(pdf_path)},
+                               timeout=timeout)
+    return {"ok": response.ok, "status": response.status_code}
+
+
+def query(base_url: str, text: str, timeout: float, start_time: float) -> dict:
+    """
+    Sends a query to the streaming endpoint and reads the Server-Sent Events to the end.
+
+    Returns:
+    dict: Whether the stream ended without an error event, the HTTP status, the time to the first
+        token event in seconds and the number of token events.
+    """
+    ttft = None
+    tokens = 0
+    ok = True
+    with requests.post(f"{base_url}/generate/stream", json={"query": text}, stream=True, timeout=timeout) as response:
+        if not response.ok:
+            return {"ok": False, "status": response.status_code}
+        for line in response.iter_lines(decode_unicode=True):
+            if line == "event: token":
+                tokens += 1
+                if ttft is None:
+                    ttft = timer() - start_time
+            elif line == "event: error":
+                ok = False
+    return {"ok": ok, "status": response.status_code, "ttft": ttft, "tokens": tokens}
+
+
+def run_worker(worker_index: int, args: argparse.Namespace, base_url: str, corpus: Corpus, queries: list[str],
+               weights: list[float], deadline: float, records: list[dict]):
+    """
+    Sends requests until the deadline, choosing each operation at random with the weights of the mix.
+    An upload or deletion that has no document to act on is replaced by a query.
+    """
+    rng = random.Random(args.seed + worker_index)
+    while timer() < deadline:
+        operation = rng.choices(OPERATIONS, weights=weights)[0]
+        pdf_path = corpus.take(operation, rng) if operation != "query" else None
+        if pdf_path is None:
+            operation = "query"
+
+        start_time = timer()
+        try:
+            if operation == "query":
+                result = query(base_url, rng.choice(queries), args.timeout, start_time)
+            elif operation == "upload":
+                result = upload(base_url, pdf_path, args.timeout)
+            else:
+                result = delete(base_url, pdf_path, args.timeout)
+        except requests.RequestException as exception:
+            result = {"ok": False, "status": None, "error": type(exception).__name__}
+        end_time = timer()
+
+        if pdf_path is not None:
+            corpus.release(operation, pdf_path, result["ok"])
+        records.append({"operation": operation, "start": start_time, "end": end_time,
+                        "latency": end_time - start_time, **result})
+        if args.think_time:
+            sleep(args.think_time)
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    return {
+            "p50_ms": float(np.percentile(values, 50) * 1000),
+            "p95_ms": float(np.percentile(values, 95) * 1000),
+            "p99_ms": float(np.percentile(values, 99) * 1000),
+            "max_ms": float(np.max(values) * 1000),
+            }
+
+
+def summarize(records: list[dict], seconds: float) -> dict[str, dict]:
+    """
+    Returns the request count, error count, throughput, latency and time to first token of each operation.
+    """
+    summary = {}
+    for operation in OPERATIONS:
+        operation_records = [record for record in records if record["operation"] == operation]
+        if not operation_records:
+            continue
+        summary[operation] = {
+                "requests": len(operation_records),
+                "errors": sum(not record["ok"] for record in operation_records),
+                "throughput_per_second": len(operation_records) / seconds if seconds else 0.0,
+                "latency": percentiles([record["latency"] for record in operation_records if record["ok"]]),
+                }
+        if operation == "query":
+            summary[operation]["ttft"] = percentiles([record["ttft"] for record in operation_records
+                                                      if record["ok"] and record.get("ttft") is not None])
+    return summary
+
+
+def build_report(args: argparse.Namespace, records: list[dict], loop_lag: list[tuple[float, float]],
+                 rss_samples: list[tuple[float, int]], start_time: float, end_time: float) -> dict:
+    duration = end_time - start_time
+    windows = []
+    for window_start in np.arange(0.0, duration, args.window):
+        window_end = min(window_start + args.window, duration)
+        in_window = lambda t: window_start <= t - start_time < window_end
+        window_lag = [lag for t, lag in loop_lag if in_window(t)]
+        window_rss = [rss for t, rss in rss_samples if in_window(t)]
+        windows.append({
+                "start_seconds": float(window_start),
+                "end_seconds": float(window_end),
+                "operations": summarize([record for record in records if in_window(record["end"])],
+                                        window_end - window_start),
+                "event_loop_lag": percentiles(window_lag),
+                "rss_mb": window_rss[-1] / 2**20 if window_rss else None,
+                })
+
+    measured_rss = [(t, rss) for t, rss in rss_samples if t >= start_time]
+    rss_times = np.array([t - start_time for t, _ in measured_rss])
+    rss_values = np.array([rss for _, rss in measured_rss], dtype=np.float64) / 2**20
+    growth_per_minute = float(np.polyfit(rss_times, rss_values, 1)[0] * 60) if len(measured_rss) > 1 else 0.0
+
+    return {
+            "config": vars(args),
+            "environment": {
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "cpu_count": os.cpu_count(),
+                "torch_threads": torch.get_num_threads(),
+                },
+            "duration_seconds": duration,
+            "operations": summarize(records, duration),
+            "event_loop_lag": percentiles([lag for t, lag in loop_lag if t >= start_time]),
+            "memory": {
+                "rss_start_mb": float(rss_values[0]) if len(rss_values) else None,
+                "rss_end_mb": float(rss_values[-1]) if len(rss_values) else None,
+                "rss_peak_mb": float(rss_values.max()) if len(rss_values) else None,
+                "rss_growth_mb": float(rss_values[-1] - rss_values[0]) if len(rss_values) else None,
+                "rss_growth_mb_per_minute": growth_per_minute,
+                },
+            "windows": windows,
+            }
+
+
+def parse_mix(mix: str) -> list[float]:
+    weights = dict.fromkeys(OPERATIONS, 0.0)
+    for part in mix.split(","):
+        operation, _, weight = part.partition("=")
+        if operation.strip() not in weights:
+            raise argparse.ArgumentTypeError(f"Unknown operation in --mix: {operation}")
+        weights[operation.strip()] = float(weight)
+    if not any(weights.values()):
+        raise argparse.ArgumentTypeError("--mix needs at least one positive weight")
+    return [weights[operation] for operation in OPERATIONS]
+
+
+def run_load_test(args: argparse.Namespace) -> dict:
+    weights = parse_mix(args.mix)
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        # The settings, the uploads, file_hashes.csv and the ingest journal are read relative to the
+        # working directory when the app is imported, so the environment is set up before the import
+        os.environ["EMBEDDINGS_DIR"] = os.path.join(work_directory, "embeddings")
+        os.environ["MAX_NEW_TOKENS"] = str(args.new_tokens)
+        os.environ["LOGGING_LEVEL"] = args.logging_level
+        if not args.real_models:
+            os.environ["STUB_MODELS"] = "true"
+        previous_directory = os.getcwd()
+        os.chdir(work_directory)
+
+        try:
+            from benchmarks.rag_benchmark import generate_corpus
+            from main import app
+            from utils.stub_models.stub_models import WORDS
+
+            pdf_directory = os.path.join(work_directory, "pool")
+            pdf_names = generate_corpus(pdf_directory, max(args.pool, args.initial_documents),
+                                        args.pages, args.paragraphs_per_page, args.seed)
+            corpus = Corpus([os.path.join(pdf_directory, name) for name in pdf_names])
+
+            rng = random.Random(args.seed)
+            queries = [" ".join(rng.choices(WORDS, k=6)) + "?" for _ in range(max(args.queries, 1))]
+
+            with socket.socket() as probe:
+                probe.bind(("127.0.0.1", 0))
+                port = probe.getsockname()[1]
+            server = ServerThread(app, port, lag_interval=args.lag_interval)
+            server.start()
+            base_url = f"http://127.0.0.1:{port}"
+
+            try:
+                with RssSampler(interval=args.sample_interval) as sampler:
+                    # The initial corpus is uploaded before the clock starts
+                    for _ in range(args.initial_documents):
+                        pdf_path = corpus.take("upload", rng)
+                        corpus.release("upload", pdf_path, upload(base_url, pdf_path, args.timeout)["ok"])
+                    if not corpus.uploaded:
+                        raise RuntimeError("The initial documents could not be uploaded")
+
+                    records: list[dict] = []
+                    start_time = timer()
+                    deadline = start_time + args.duration
+                    workers = [threading.Thread(target=run_worker,
+                                                args=(i, args, base_url, corpus, queries, weights, deadline, records))
+                               for i in range(args.concurrency)]
+                    for worker in workers:
+                        worker.start()
+                    for worker in workers:
+                        worker.join()
+                    end_time = timer()
+            finally:
+                server.stop()
+
+            return build_report(args, records, server.loop_lag, sampler.samples, start_time, end_time)
+        finally:
+            os.chdir(previous_directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and soak test of the HTTP API with stub models")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds of traffic")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of concurrent clients")
+    parser.add_argument("--mix", default="query=8,upload=1,delete=1",
+                        help="Relative weights of the operations, e.g. query=8,upload=1,delete=1")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Seconds each client waits between requests")
+    parser.add_argument("--initial-documents", type=int, default=2, help="PDFs uploaded before the clock starts")
+    parser.add_argument("--pool", type=int, default=8, help="Number of distinct PDFs uploads choose from")
+    parser.add_argument("--pages", type=int, default=10, help="Pages per PDF")
+    parser.add_argument("--paragraphs-per-page", type=int, default=4, help="Paragraphs per page")
+    parser.add_argument("--queries", type=int, default=50, help="Number of distinct queries")
+    parser.add_argument("--new-tokens", type=int, default=32, help="Maximum tokens generated per query")
+    parser.add_argument("--window", type=float, default=10.0, help="Seconds per reporting window")
+    parser.add_argument("--lag-interval", type=float, default=0.05, help="Sleep interval of the event loop lag probe")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="RSS sampling interval in seconds")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Timeout of each request in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus, the queries and the clients")
+    parser.add_argument("--logging-level", default="WARNING", help="Logging level of the server")
+    parser.add_argument("--real-models", action="store_true",
+                        help="Use the configured models instead of the stub models")
+    parser.add_argument("--output", default="load_test.json", help="File the JSON report is written to")
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+
+    report = run_load_test(args)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Load test report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+End-to-end benchmark of the RAG pipeline on a synthetic corpus.
+
+Generates PDFs offline, runs every stage of ingestion, retrieval and generation and reports
+throughput, p50/p99 latency and peak RSS per stage as JSON.
+
+Usage (from the backend directory):
+    python benchmarks/rag_benchmark.py --stub-models --documents 4 --pages 50 --output rag_benchmark.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+from time import perf_counter as timer
+from types import SimpleNamespace
+
+import numpy as np
+import psutil
+import pymupdf
+import torch
+from transformers import DynamicCache
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.file_embedder.file_embedder import FileImporter
+from utils.file_reader.file_reader import (EMBEDDING_SIDECARS, EmbeddingsReader, blocked_scores,
+                                           load_embeddings_array, to_storage_dtype)
+from utils.llm.llm import Llm
+from utils.stub_models.stub_models import WORDS, StubEmbedder, StubTokenizer, build_stub_causal_lm
+
+
+class PeakMemorySampler:
+    def __init__(self, interval: float = 0.005):
+        """
+        Context manager sampling the resident set size of the process on a background thread
+        and keeping the maximum seen while the block runs.
+
+        Parameters:
+        interval (float): The sampling interval in seconds. Defaults to 0.005.
+        """
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_rss = self.process.memory_info().rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+
+class StageRecorder:
+    def __init__(self):
+        """
+        Collects the latency samples, processed item counts and peak RSS of every stage.
+        """
+        self.samples: dict[str, list[float]] = {}
+        self.items: dict[str, int] = {}
+        self.units: dict[str, str] = {}
+        self.peak_rss: dict[str, int] = {}
+
+    def record(self, stage: str, unit: str, function, *args, items: int = 1, **kwargs):
+        """
+        Runs function(*args, **kwargs) and records it as one sample of the stage.
+
+        Parameters:
+        stage (str): The stage name.
+        unit (str): The unit of the processed items, used to label the throughput.
+        function (Callable): The function to time.
+        items (int | Callable): The number of processed items, or a function of the result returning it.
+
+        Returns:
+        The result of the function.
+        """
+        with PeakMemorySampler() as sampler:
+            start_time = timer()
+            result = function(*args, **kwargs)
+            elapsed = timer() - start_time
+
+        self.samples.setdefault(stage, []).append(elapsed)
+        self.items[stage] = self.items.get(stage, 0) + (items(result) if callable(items) else items)
+        self.units[stage] = unit
+        self.peak_rss[stage] = max(self.peak_rss.get(stage, 0), sampler.peak_rss)
+        return result
+
+    def report(self) -> dict[str, dict[str, float | int | str]]:
+        report = {}
+        for stage, samples in self.samples.items():
+            total = sum(samples)
+            report[stage] = {
+                    "samples": len(samples),
+                    "items": self.items[stage],
+                    "unit": self.units[stage],
+                    "total_seconds": total,
+                    "throughput_per_second": self.items[stage] / total if total else 0.0,
+                    "p50_ms": float(np.percentile(samples, 50) * 1000),
+                    "p99_ms": float(np.percentile(samples, 99) * 1000),
+                    "peak_rss_mb": self.peak_rss[stage] / 2**20,
+                    }
+        return report
+
+
+def greedy_decode(model, logits: torch.Tensor, past_key_values, n_tokens: int) -> int:
+    """
+    Decodes greedily from the KV cache of a prefill forward pass, one forward pass per token, so
+    the time taken covers the decode steps only and not the prefill.
+
+    Parameters:
+    model (PreTrainedModel): The causal language model.
+    logits (torch.Tensor): The logits returned by the prefill.
+    past_key_values (Cache): The KV cache returned by the prefill, extended in place.
+    n_tokens (int): The number of tokens to decode.
+
+    Returns:
+    int: The number of decoded tokens.
+    """
+    for _ in range(n_tokens):
+        next_token = logits[:, -1:].argmax(dim=-1)
+        outputs = model(input_ids=next_token, past_key_values=past_key_values, use_cache=True)
+        logits, past_key_values = outputs.logits, outputs.past_key_values
+    return n_tokens
+
+
+def generate_corpus(directory: str, n_documents: int, n_pages: int, paragraphs_per_page: int, seed: int) -> list[str]:
+    """
+    Writes synthetic PDFs of random sentences over the stub vocabulary.
+
+    Parameters:
+    directory (str): The directory the PDFs are written to.
+    n_documents (int): The number of PDFs.
+    n_pages (int): The number of pages of each PDF.
+    paragraphs_per_page (int): The number of paragraphs on each page.
+    seed (int): The random seed, the same seed always produces the same corpus.
+
+    Returns:
+    list[str]: The file names of the generated PDFs.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    def sentence() -> str:
+        words = rng.choices(WORDS, k=rng.randint(8, 20))
+        return " ".join(words).capitalize() + "."
+
+    pdf_names = []
+    for document_index in range(n_documents):
+        doc = pymupdf.open()
+        for _ in range(n_pages):
+            page = doc.new_page()
+            paragraphs = [" ".join(sentence() for _ in range(rng.randint(3, 6))) for _ in range(paragraphs_per_page)]
+            page.insert_textbox(page.rect + (36, 36, -36, -36), "\n\n".join(paragraphs), fontsize=9)
+        pdf_name = f"synthetic_{document_index}.pdf"
+        doc.save(os.path.join(directory, pdf_name))
+        doc.close()
+        pdf_names.append(pdf_name)
+    return pdf_names
+
+
+def embedding_precision_report(csv_paths: list[str], query_embeddings: np.ndarray, k: int = 5) -> dict:
+    """
+    Measures the recall@k of the reduced precision embeddings against the float32 top k.
+
+    Parameters:
+    csv_paths (list[str]): The CSV files of the corpus.
+    query_embeddings (np.ndarray): The float32 embedding of each query.
+    k (int): The number of results compared. Defaults to 5.
+
+    Returns:
+    dict: For each storage dtype, its recall@k, size in bytes and mean scan time in milliseconds.
+    """
+    reference = np.concatenate([load_embeddings_array(path, "float32") for path in csv_paths])
+    k = min(k, len(reference))
+    expected = [set(np.argsort(-(reference @ query))[:k]) for query in query_embeddings]
+
+    report = {}
+    for dtype in EMBEDDING_SIDECARS:
+        embeddings = to_storage_dtype(reference, dtype)
+        hits = 0
+        start_time = timer()
+        for query, expected_rows in zip(query_embeddings, expected):
+            scores = blocked_scores(embeddings, query, dtype)
+            hits += len(expected_rows & set(np.argsort(-scores)[:k]))
+        elapsed = timer() - start_time
+        report[dtype] = {
+                f"recall_at_{k}": hits / max(k * len(query_embeddings), 1),
+                "bytes": embeddings.nbytes,
+                "scan_ms": 1000 * elapsed / max(len(query_embeddings), 1),
+                }
+    return report
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    recorder = StageRecorder()
+
+    if args.stub_models:
+        embedding_model = StubEmbedder()
+        tokenizer = StubTokenizer()
+        model = build_stub_causal_lm(tokenizer)
+        device = "cpu"
+    else:
+        from sentence_transformers import SentenceTransformer
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        embedding_model = SentenceTransformer(model_name_or_path=args.embedding_model, device=device)
+        tokenizer = AutoTokenizer.from_pretrained(args.model_id)
+        model = AutoModelForCausalLM.from_pretrained(args.model_id,
+                                                     torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+                                                     low_cpu_mem_usage=True).to(device).eval()
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        upload_directory = os.path.join(work_directory, "uploads")
+        embeddings_directory = os.path.join(work_directory, "embeddings")
+
+        pdf_names = generate_corpus(upload_directory, args.documents, args.pages, args.paragraphs_per_page, args.seed)
+
+        # Ingestion, one sample per document
+        for pdf_name in pdf_names:
+            fi = FileImporter(embedding_model=embedding_model,
+                              upload_directory=upload_directory,
+                              embeddings_directory=embeddings_directory)
+            fi.pdf_path = pdf_name
+            recorder.record("extraction", "pages", fi.open_and_read_pdf, items=args.pages)
+            recorder.record("sentencizing", "pages", fi.split_text_into_sentences, items=args.pages)
+            recorder.record("chunking", "pages", fi.chunks_from_text, items=args.pages)
+            recorder.record("embedding", "chunks", fi.embed_chunks, items=len(fi.pages_and_chunks))
+            recorder.record("save", "chunks", fi.save_pdf, items=len(fi.pages_and_chunks))
+
+        csv_paths = sorted(os.path.join(embeddings_directory, f) for f in os.listdir(embeddings_directory)
+                           if f.endswith(".csv"))
+        fr = EmbeddingsReader(embedding_model=embedding_model, embedding_dtype=args.embedding_dtype)
+        recorder.record("load", "chunks", fr.read_csvs, csv_paths,
+                        items=lambda _: len(fr.chunk_store))
+
+        # Query path, one sample per query
+        prompt_builder = SimpleNamespace(tokenizer=tokenizer)
+        queries = [" ".join(rng.choices(WORDS, k=6)) + "?" for _ in range(args.queries)]
+        for query in queries:
+            top_k_results = recorder.record("retrieval", "queries", fr.retrive_relevant_resources,
+                                            query, print_time=False)
+            context_items = fr.chunk_store.get_many(i["row_id"] for i in top_k_results)
+            prompt = recorder.record("prompt_build", "queries", Llm.prompt_formatter, prompt_builder,
+                                     query=query, context_items=context_items)
+
+            model_inputs = tokenizer(prompt, return_tensors="pt").to(device)
+            prompt_tokens = model_inputs["input_ids"].shape[1]
+            with torch.inference_mode():
+                # A growing cache, the default cache of models like gemma-2 is sized to the prompt
+                prefill = recorder.record("prefill", "tokens", model, **model_inputs, use_cache=True,
+                                          past_key_values=DynamicCache(), items=prompt_tokens)
+                recorder.record("decode", "tokens", greedy_decode, model, prefill.logits, prefill.past_key_values,
+                                args.new_tokens, items=lambda decoded: decoded)
+
+        query_embeddings = np.asarray(embedding_model.encode(queries, convert_to_numpy=True), dtype=np.float32)
+        precision = embedding_precision_report(csv_paths, query_embeddings)
+
+    return {
+            "config": vars(args),
+            "environment": {
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "cpu_count": os.cpu_count(),
+                "torch_threads": torch.get_num_threads(),
+                "device": device,
+                },
+            "stages": recorder.report(),
+            "embedding_precision": precision,
+            "memory": {
+                "chunks": len(fr.chunk_store),
+                "chunk_store_bytes": fr.chunk_store.memory_usage(),
+                "chunk_store_bytes_per_chunk": fr.chunk_store.memory_usage() / max(len(fr.chunk_store), 1),
+                "embeddings_bytes": sum(embedding.element_size() * embedding.nelement() for embedding in fr.embeddings),
+                },
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end RAG benchmark on a synthetic corpus")
+    parser.add_argument("--documents", type=int, default=2, help="Number of synthetic PDFs")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per PDF")
+    parser.add_argument("--paragraphs-per-page", type=int, default=4, help="Paragraphs per page")
+    parser.add_argument("--queries", type=int, default=20, help="Number of queries to run")
+    parser.add_argument("--new-tokens", type=int, default=32, help="Tokens decoded per query")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus and the queries")
+    parser.add_argument("--stub-models", action="store_true",
+                        help="Use a hashing embedder and a tiny random model instead of downloading models")
+    parser.add_argument("--embedding-model", default="all-mpnet-base-v2", help="SentenceTransformer model")
+    parser.add_argument("--embedding-dtype", default="float32", choices=list(EMBEDDING_SIDECARS),
+                        help="Dtype the retrieval embeddings are held in")
+    parser.add_argument("--model-id", default="google/gemma-2-2b-it", help="Causal language model")
+    parser.add_argument("--output", default="rag_benchmark.json", help="File the JSON report is written to")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Benchmark report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+import os
+from typing import Literal
+
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -5,7 +9,75 @@ class Settings(BaseSettings):
     root_path: str = ""
     logging_level: str = "INFO"
     testing: bool = False
+    trace_sample_rate: float = 0.0
+
+    rerank_enabled: bool = False
+    rerank_model: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    rerank_candidates: int = 20
+    rerank_top_k: int = 5
+    rerank_latency_budget: float = 0.25
+    rerank_max_in_flight: int = 2
+    rerank_cache_size: int = 4096
+
+    llm_model: str = "google/gemma-2-2b-it"
+    max_new_tokens: int = 4096
+    # Only used until the model registry file exists, it then holds the default embedding model
+    embedding_model: str = "all-mpnet-base-v2"
+    # Replaces every model with the download free stubs of utils/stub_models, e.g. for load tests
+    stub_models: bool = False
+    # Defaults to the "embeddings" directory of the backend when empty
+    embeddings_dir: str = ""
+
+    retrieval_shards: int = 0
+    disk_retrieval: bool = False
+    disk_block_rows: int = 65536
+    disk_hot_tier_bytes: int = 512 * 2**20
+    disk_promote_after_hits: int = 2
+    disk_prefetch_workers: int = 4
+    embedding_dtype: str = "float32"
+
+    # Adaptive retrieval picks up to retrieval_max_chunks of retrieval_candidates, see utils/context_selector
+    adaptive_retrieval: bool = False
+    retrieval_candidates: int = 20
+    retrieval_max_chunks: int = 5
+    retrieval_min_similarity: float = 0.3
+    # 0 disables the score gap cut, 1 disables MMR
+    retrieval_score_gap: float = 0.1
+    retrieval_mmr_lambda: float = 0.7
+
+    answer_cache_enabled: bool = False
+    answer_cache_similarity: float = 0.95
+    answer_cache_max_entries: int = 512
+
+    speculative_decoding: Literal["off", "prompt_lookup", "draft"] = "off"
+    speculative_draft_model: str = ""
+    speculative_num_tokens: int = 10
+
+    session_max_sessions: int = 64
+    session_ttl: float = 1800.0
+    session_max_bytes: int = 2**30
+    session_max_tokens: int = 6144
+
+    stream_queue_size: int = 32
+    stream_flush_chars: int = 64
+    stream_flush_interval: float = 0.05
+
+    page_cache_dir: str = "page_cache"
+    page_cache_max_bytes: int = 256 * 2**20
+
+    extraction_workers: int = min(4, os.cpu_count() or 1)
+    ocr_enabled: bool = False
+    ocr_min_chars: int = 32
+    ocr_workers: int = 2
+    ocr_language: str = "eng"
+
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
+    @model_validator(mode="after")
+    def check_speculative_draft_model(self) -> "Settings":
+        if self.speculative_decoding == "draft" and not self.speculative_draft_model:
+            raise ValueError('speculative_draft_model must be set when speculative_decoding is "draft"')
+        return self
+
 
 settings = Settings()
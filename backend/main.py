@@ -1,19 +1,38 @@
 from config import settings
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 import uvicorn
+from time import perf_counter as timer
 
 from routers.file_router import file_router
 from routers.llm_router import llm_router
+from routers.metrics_router import metrics_router
+from routers.model_router import model_router
+from utils.metrics.metrics import HTTP_LATENCY, HTTP_REQUESTS, start_trace
+from utils.page_extractor.page_extractor import shutdown_pools
 
 
 from fastapi.middleware.cors import CORSMiddleware
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Finishes or rolls back the uploads and deletions interrupted by a crash and loads the models
+    before serving requests, and stops the shared extraction processes on shutdown.
+    """
+    file_router.recover_ingests()
+    llm_router.get_llm()
+    yield
+    shutdown_pools()
+
+
 app = FastAPI(
         description="""
         Retrival augemented generation for language model
         """,
-        version="0.2"
+        version="0.2",
+        lifespan=lifespan,
         )
 
 app.add_middleware(
@@ -22,11 +41,34 @@ app.add_middleware(
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Trace-Id"],
         )
 
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Starts a trace for every request, records the request count and latency per route and
+    returns the trace ID in the X-Trace-Id header. A client supplied X-Trace-Id is reused.
+    """
+    trace_id = start_trace(request.headers.get("X-Trace-Id"), settings.trace_sample_rate)
+    start_time = timer()
+
+    response = await call_next(request)
+
+    route = request.scope.get("route")
+    route_path = route.path if route is not None else "unmatched"
+    HTTP_REQUESTS.inc(method=request.method, route=route_path, status=response.status_code)
+    HTTP_LATENCY.observe(timer() - start_time, method=request.method, route=route_path)
+
+    response.headers["X-Trace-Id"] = trace_id
+    return response
+
+
 app.include_router(file_router.router)
 app.include_router(llm_router.router)
+app.include_router(metrics_router.router)
+app.include_router(model_router.router)
 
 
 if __name__ == "__main__":
@@ -1,24 +1,70 @@
-from fastapi import UploadFile, File, APIRouter, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import UploadFile, File, APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 
 import os
+import re
 import shutil
+from email.utils import formatdate, parsedate_to_datetime
+from threading import Thread
 
 from utils.file_embedder.file_embedder import FileImporter
+from utils.ingest_journal.ingest_journal import (ABORTED, COMMITTED, PDF_WRITTEN, IngestJournal,
+                                                 recover_ingest_jobs, remove_document_files, remove_temporary_files,
+                                                 rollback_ingest)
+from utils.logger.logger import get_logger
+from utils.model_registry.model_registry import model_registry
+from utils.page_cache.page_cache import PageRenderCache
 import utils.file_hash.file_hash as fh
-
-import csv
+from config import settings
 
 router = APIRouter()
 
+logger = get_logger("file_router")
+
 PDF_DIR = os.path.abspath("uploads")
-CSV_DIR = os.path.abspath("embeddings")
+HASH_FILE_PATH = os.path.abspath("file_hashes.csv")
+
+journal = IngestJournal(os.path.abspath("ingest_journal.jsonl"))
+
+page_cache = PageRenderCache(directory=settings.page_cache_dir, max_bytes=settings.page_cache_max_bytes)
 
 
 if not os.path.exists(PDF_DIR):
     os.makedirs(PDF_DIR)
 
 
+def _ingest_pdf(fi: FileImporter, pdf_name: str, file_hash: str, job_id: str):
+    """
+    Embeds an uploaded PDF and commits its ingest job.
+
+    The embeddings are written atomically by FileImporter.save_pdf, and the hash is recorded only
+    once they are in place, so a failed or interrupted ingest can be retried by uploading the file
+    again. A failed ingest is rolled back and aborted, removing only the files the job created.
+
+    Raises:
+    Exception: The error of the failed ingest.
+    """
+    try:
+        if not fi.import_and_embed_pdfs(pdf_name):
+            raise RuntimeError(f"The embeddings of {pdf_name} were not saved")
+    except Exception as exception:
+        rollback_ingest(pdf_name, file_hash, PDF_DIR, model_registry.store_directory(), HASH_FILE_PATH)
+        journal.mark(job_id, ABORTED, error=str(exception))
+        raise
+
+    fh.record_file_hash(pdf_name, file_hash, HASH_FILE_PATH)
+    journal.mark(job_id, COMMITTED)
+
+
+def _name_taken(pdf_name: str) -> bool:
+    """
+    Returns whether a document of that name is uploaded, committed or being ingested.
+    """
+    return os.path.exists(os.path.join(PDF_DIR, pdf_name)) \
+            or os.path.exists(os.path.join(model_registry.store_directory(), pdf_name + ".csv")) \
+            or fh.committed_file_hash(pdf_name, HASH_FILE_PATH) is not None
+
+
 @router.post("/uploadFiles/")
 async def upload_files(files: list[UploadFile]) -> dict[str, list[str]]:
 
@@ -30,44 +76,130 @@ async def upload_files(files: list[UploadFile]) -> dict[str, list[str]]:
     file hashes and skips it if it does. New files are saved to the upload directory and processed 
     for text embedding.
 
+    Every new file is ingested as a job of the ingest journal: the PDF is written to a temporary
+    file and renamed, its embeddings are written the same way, and the file hash is recorded last.
+    A crash at any point leaves a job that recover_ingests resumes or rolls back at startup.
+    A new file is never written over a document of the same name, which has to be deleted first.
+
     Parameters:
     files (list[UploadFile]): A list of UploadFile objects representing the files to be uploaded.
 
     Returns:
-    dict[str, list[str]]: A dictionary containing lists of newly added and already added PDFs.
+    dict[str, list[str]]: A dictionary containing lists of newly added, already added and failed PDFs.
+
+    Raises:
+    HTTPException: If a file is not a PDF (400), or another file of the same name is uploaded (409).
     """
-    file_paths: list[str] = []
     newly_added_pdfs: list[str] = []
     already_added_pdfs: list[str] = []
+    failed_pdfs: list[str] = []
+    uploads: list[tuple[UploadFile, str, str]] = []
+    jobs: list[tuple[str, str, str]] = []
 
-    for file in files:
-        # Check if the uploaded file is a PDF
-        if file.content_type != "application/pdf":
-            raise HTTPException(status_code=400, detail="Only PDF files are allowed.")
+    # Every file is checked before anything is written
+    if any(file.content_type != "application/pdf" for file in files):
+        raise HTTPException(status_code=400, detail="Only PDF files are allowed.")
 
+    for file in files:
         if file.filename is not None:
-            file_already_exists =  fh.check_file_existance(file)
-            if file_already_exists:
+            file_hash = fh.calculate_file_hash(file)
+            if fh.check_file_existance(file_hash, HASH_FILE_PATH) or file_hash in [upload[2] for upload in uploads]:
                 already_added_pdfs.append(file.filename)
                 continue
 
-            file_path: str = (os.path.join(PDF_DIR, file.filename))
-            file_paths.append(file_path)
-            if file:
-                newly_added_pdfs.append(file.filename)
-        
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-
-    if newly_added_pdfs:
-        fi = FileImporter()
-        _ = fi.import_and_embed_pdfs(newly_added_pdfs)
+            file_path: str = os.path.join(PDF_DIR, file.filename)
+            if os.path.dirname(os.path.abspath(file_path)) != PDF_DIR:
+                raise HTTPException(status_code=400, detail="Invalid file path.")
+            if _name_taken(file.filename) or file.filename in [upload[0].filename for upload in uploads]:
+                raise HTTPException(status_code=409,
+                                    detail=f"Another file named {file.filename} is already uploaded, delete it first.")
+            uploads.append((file, file_path, file_hash))
+
+    for file, file_path, file_hash in uploads:
+        job_id = journal.begin(file.filename, file_hash)
+        tmp_path = f"{file_path}.{job_id}.tmp"
+        with open(tmp_path, "wb") as buffer:
+            shutil.copyfileobj(file.file, buffer)
+            buffer.flush()
+            os.fsync(buffer.fileno())
+        os.replace(tmp_path, file_path)
+        journal.mark(job_id, PDF_WRITTEN)
+        jobs.append((file.filename, file_hash, job_id))
+
+    if jobs:
+        fi = FileImporter(embedding_model=model_registry.get_embedder(),
+                          embeddings_directory=model_registry.store_directory())
+        for pdf_name, file_hash, job_id in jobs:
+            try:
+                _ingest_pdf(fi, pdf_name, file_hash, job_id)
+                newly_added_pdfs.append(pdf_name)
+            except Exception:
+                logger.exception("Ingest failed", extra={"fields": {"pdf": pdf_name, "job_id": job_id}})
+                failed_pdfs.append(pdf_name)
+        # Embed the new documents into the stores of the other embedding models in the background
+        if newly_added_pdfs:
+            model_registry.sync_stores()
 
     return {
             "newly_added_pdfs": newly_added_pdfs, 
             "already_added_pdfs": already_added_pdfs, 
+            "failed_pdfs": failed_pdfs,
             }
 
+
+def _delete_pdf_files(pdf_name: str):
+    """
+    Removes a document from every embedding store, then its PDF, hash and rendered pages.
+    Every step can be repeated, so an interrupted deletion is finished by running it again.
+    """
+    remove_document_files(model_registry.store_directories(), pdf_name)
+    pdf_path = os.path.join(PDF_DIR, pdf_name)
+    if os.path.isfile(pdf_path):
+        os.remove(pdf_path)
+    fh.remove_file_hash(pdf_name, HASH_FILE_PATH)
+    page_cache.purge(pdf_name)
+
+
+def _resume_ingests(jobs: list[dict]):
+    fi = FileImporter(embedding_model=model_registry.get_embedder(),
+                      embeddings_directory=model_registry.store_directory())
+    for job in jobs:
+        try:
+            _ingest_pdf(fi, job["pdf"], job["hash"], job["job_id"])
+            logger.info("Ingest resumed", extra={"fields": {"pdf": job["pdf"], "job_id": job["job_id"]}})
+        except Exception:
+            logger.exception("Resumed ingest failed", extra={"fields": {"pdf": job["pdf"], "job_id": job["job_id"]}})
+    model_registry.sync_stores()
+
+
+def recover_ingests():
+    """
+    Brings the uploads, the embedding stores and file_hashes.csv back to a consistent state after
+    a crash, called once at startup before requests are served.
+
+    Temporary files of interrupted writes are removed. Then every job of the ingest journal that
+    neither committed nor aborted is finished:
+    - an interrupted deletion is run again;
+    - an ingest whose PDF was fully written is resumed in a background thread, its document is
+      not served until the embeddings are committed;
+    - any other ingest is rolled back, see recover_ingest_jobs.
+    """
+    remove_temporary_files(PDF_DIR)
+    remove_temporary_files(os.path.dirname(HASH_FILE_PATH), os.path.basename(HASH_FILE_PATH) + ".")
+    for store_directory in model_registry.store_directories():
+        if os.path.isdir(store_directory):
+            remove_temporary_files(store_directory)
+
+    journal.compact()
+    to_resume, to_delete = recover_ingest_jobs(journal, PDF_DIR, model_registry.store_directory(), HASH_FILE_PATH)
+    for job in to_delete:
+        _delete_pdf_files(job["pdf"])
+        journal.mark(job["job_id"], COMMITTED)
+
+    if to_resume:
+        Thread(target=_resume_ingests, args=(to_resume,), daemon=True).start()
+
+
 @router.get("/pdfs")
 async def list_pdfs():
     """
@@ -83,25 +215,176 @@ async def list_pdfs():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _resolve_pdf_path(pdf_name: str) -> str:
+    """
+    Returns the path of a PDF in the uploads directory, rejecting names that escape it.
+
+    Raises:
+    HTTPException: If the name is not a plain file name or the PDF does not exist.
+    """
+    pdf_path = os.path.abspath(os.path.join(PDF_DIR, pdf_name))
+    if os.path.dirname(pdf_path) != PDF_DIR:
+        raise HTTPException(status_code=400, detail="Invalid file path.")
+    if not os.path.isfile(pdf_path):
+        raise HTTPException(status_code=404, detail="PDF file not found on server")
+    return pdf_path
+
+
+def _parse_range(range_header: str, file_size: int) -> tuple[int, int] | None:
+    """
+    Parses a single "bytes=start-end" range.
+
+    Parameters:
+    range_header (str): The value of the Range header.
+    file_size (int): The size of the file in bytes.
+
+    Returns:
+    tuple[int, int] | None: The inclusive start and end offsets, or None if the header is not a
+        single byte range, in which case it is ignored and the whole file is served.
+
+    Raises:
+    ValueError: If the range is not satisfiable.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    if match.group(1) == "":
+        # Suffix range, the last N bytes
+        start, end = max(file_size - int(match.group(2)), 0), file_size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), file_size - 1) if match.group(2) else file_size - 1
+
+    if start > end or start >= file_size:
+        raise ValueError(f"Range not satisfiable: {range_header}")
+    return start, end
+
+
+def _is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """
+    Evaluates the If-None-Match and If-Modified-Since conditional request headers.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _iter_file_range(path: str, start: int, end: int, chunk_size: int = 64 * 1024):
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = file.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
 @router.get("/pdf/{pdf_name}")
-async def get_pdf(pdf_name: str):
+async def get_pdf(pdf_name: str, request: Request):
     """
     Returns a PDF file with the given name from the uploads directory.
 
+    Responses carry ETag and Last-Modified headers, so revalidation returns 304 Not Modified, and
+    single byte ranges are served as 206 Partial Content, which lets PDF viewers load only the
+    pages they display.
+
     Parameters:
     pdf_name (str): The name of the PDF file to retrieve.
+    request (Request): The incoming request, used for the Range and conditional headers.
 
     Returns:
-    FileResponse: The PDF file.
+    FileResponse | StreamingResponse | Response: The PDF file, a byte range of it, or an empty 304/416 response.
 
     Raises:
     HTTPException: If the PDF file is not found in the uploads directory.
     """
-    pdf_path = os.path.join(PDF_DIR, pdf_name)
-    if not os.path.exists(pdf_path):
-        raise HTTPException(status_code=404, detail="PDF file not found on server")
-    
-    return FileResponse(pdf_path, media_type='application/pdf')
+    pdf_path = _resolve_pdf_path(pdf_name)
+    stat = os.stat(pdf_path)
+
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "private, max-age=0, must-revalidate",
+            }
+
+    if _is_not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    byte_range = None
+    if range_header and if_range in (None, etag):
+        try:
+            byte_range = _parse_range(range_header, stat.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+
+    if byte_range is not None:
+        start, end = byte_range
+        return StreamingResponse(_iter_file_range(pdf_path, start, end),
+                                 status_code=206,
+                                 media_type="application/pdf",
+                                 headers={**headers,
+                                          "Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+                                          "Content-Length": str(end - start + 1)})
+
+    return FileResponse(pdf_path, media_type='application/pdf', headers=headers, stat_result=stat)
+
+
+@router.get("/pdf/{pdf_name}/page/{page_number}")
+def get_pdf_page(pdf_name: str, page_number: int, request: Request, format: str = "png", zoom: float = 1.5):
+    """
+    Returns a single page of a PDF rendered to a PNG image or to plain text.
+
+    Only the requested page is rendered, and the result is kept in an on-disk LRU cache, so
+    opening a citation costs kilobytes however large the document is.
+
+    Parameters:
+    pdf_name (str): The name of the PDF file.
+    page_number (int): The 1-based page number, as cited in the generated answers.
+    request (Request): The incoming request, used for the conditional headers.
+    format (str): "png" or "text". Defaults to "png".
+    zoom (float): The scale of the rendered image, between 0.5 and 4. Defaults to 1.5.
+
+    Returns:
+    FileResponse | Response: The rendered page, or an empty 304 response.
+
+    Raises:
+    HTTPException: If the PDF or the page does not exist, or the format or zoom is invalid.
+    """
+    if format not in ("png", "text"):
+        raise HTTPException(status_code=400, detail="The format must be 'png' or 'text'.")
+    if not 0.5 <= zoom <= 4:
+        raise HTTPException(status_code=400, detail="The zoom must be between 0.5 and 4.")
+
+    pdf_path = _resolve_pdf_path(pdf_name)
+
+    # Revalidation is answered from the PDF's stat alone, before rendering anything
+    etag = f'"{page_cache.version(pdf_path, page_number, output_format=format, zoom=zoom)}-{page_number}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=3600"}
+    if _is_not_modified(request, etag, os.stat(pdf_path).st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        cache_path = page_cache.render(pdf_path, page_number, output_format=format, zoom=zoom)
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    media_type = "image/png" if format == "png" else "text/plain; charset=utf-8"
+    return FileResponse(cache_path, media_type=media_type, headers=headers)
 
 @router.delete("/delete")
 async def delete_pdf(pdf_name: str):
@@ -120,10 +403,9 @@ async def delete_pdf(pdf_name: str):
     HTTPException: If the PDF file or its embeddings are not found on the server, or if an error occurs while trying to delete the file.
     """
     pdf_path = os.path.join(PDF_DIR, pdf_name)
-    csv_path = os.path.join(CSV_DIR, pdf_name + '.csv')
+    csv_path = os.path.join(model_registry.store_directory(), pdf_name + '.csv')
 
-    if (not pdf_path.startswith(os.path.abspath(PDF_DIR))):
-            #(not csv_path.startswith(os.path.abspath(CSV_DIR))):
+    if os.path.dirname(os.path.abspath(pdf_path)) != PDF_DIR:
         raise HTTPException(status_code=400, detail="Invalid file path.")
 
     if not os.path.isfile(pdf_path):
@@ -131,34 +413,12 @@ async def delete_pdf(pdf_name: str):
     elif not os.path.isfile(csv_path):
         raise HTTPException(status_code=404, detail="Embeddings not found.")
 
+    # A deletion interrupted by an error or a crash stays incomplete in the journal and is finished at startup
+    job_id = journal.begin(pdf_name, None, kind="delete")
     try:
-
-        filtered_rows = []
-        with open(os.path.abspath("file_hashes.csv"), mode="r", newline='', encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            fieldnames = reader.fieldnames
-            if not fieldnames or "filename" not in fieldnames:
-                raise ValueError("The CSV file does not have the required 'filename' column.")
-            
-            for row in reader:
-                if row["filename"] != pdf_name:
-                    filtered_rows.append(row)
-
-        for i in filtered_rows:
-            print(i)
-        # Write the filtered rows back to the CSV
-        with open(os.path.abspath("file_hashes.csv"), mode="w", newline='', encoding="utf-8") as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(filtered_rows)
-
-            os.remove(pdf_path)
-            os.remove(csv_path)
-
-            return {"Deleted" : pdf_path}
-
+        _delete_pdf_files(pdf_name)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occured: {e}")
+    journal.mark(job_id, COMMITTED)
 
-
-    
+    return {"Deleted" : pdf_path}
@@ -1,12 +1,151 @@
-from fastapi import APIRouter 
+from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+import asyncio
+import json
+import uuid
+from threading import Event, Lock
+from time import perf_counter as timer
 
 
 from .models import QueryRequest
 from utils.llm.llm import Llm
+from utils.session_store.session_store import Session
+from utils.model_registry.model_registry import model_registry
+from utils.logger.logger import get_logger
+from config import settings
 
 router = APIRouter()
-llm = Llm()
+logger = get_logger("llm_router")
+
+_llm: Llm | None = None
+_llm_lock = Lock()
+
+
+def get_llm() -> Llm:
+    """
+    Returns the shared Llm, loading the models on first use. main.py calls it at startup.
+
+    The Llm is not built at import time: the processes of the retrieval shards and the extraction
+    pools import main.py again as __mp_main__, and would each load the models.
+    """
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            _llm = Llm()
+        return _llm
+
+
+def _check_embedding_model(request: QueryRequest):
+    """
+    Rejects queries for an embedding model whose store cannot serve them.
+
+    Raises:
+    HTTPException: If the store of the requested embedding model does not exist or is not ready.
+    """
+    if request.embedding_model is not None and not model_registry.is_ready(request.embedding_model):
+        raise HTTPException(status_code=400, detail=f"Embedding model {request.embedding_model} is not available")
+
+
+def _format_sse(event: str, data) -> str:
+    """
+    Formats one Server-Sent Events frame with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def _acquire_session(request: QueryRequest) -> Session | None:
+    """
+    Locks the session of the request's conversation before the response starts, so a busy
+    conversation is reported with a status code instead of a truncated stream.
+
+    Returns:
+    Session | None: The locked session, None for a stateless query.
+
+    Raises:
+    HTTPException: If the previous turn of the conversation did not finish in time.
+    """
+    if request.conversation_id is None:
+        return None
+    llm = get_llm()
+    acquiring = asyncio.get_running_loop().run_in_executor(None, llm.sessions.acquire, request.conversation_id)
+    try:
+        return await asyncio.shield(acquiring)
+    except TimeoutError as exception:
+        raise HTTPException(status_code=409, detail=str(exception))
+    except asyncio.CancelledError:
+        # The client went away while waiting, release the session once the lock is obtained
+        acquiring.add_done_callback(lambda future: future.cancelled() or future.exception() is not None
+                                    or llm.sessions.release(future.result()))
+        raise
+
+
+class _GenerationPump:
+    def __init__(self, request: QueryRequest, received_at: float, session: Session | None = None):
+        """
+        Constructor for _GenerationPump.
+
+        Runs Llm.generate_events for a request in a worker thread and hands the events over to the
+        response through a bounded asyncio queue. The thread blocks while the queue is full, which
+        blocks the streamer of the generation in turn, so a slow client throttles the decoding.
+        close() stops the generation, it has to be called when the response ends for any reason.
+
+        Parameters:
+        request (QueryRequest): The query.
+        received_at (float): The perf_counter time the request was received.
+        session (Session | None): The session acquired for the request, see _acquire_session. It is
+            released by the generation, or by close() when the generation never started.
+
+        Sets the following attributes:
+        queue (asyncio.Queue): The (event, payload) tuples, ending with ("end", None).
+        stop_event (Event): Stops the generation after the current step.
+        """
+        self.request = request
+        self.received_at = received_at
+        self.session = session
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.stream_queue_size)
+        self.stop_event = Event()
+        self._client_gone = Event()
+        self._started = False
+
+    def _put(self, item: tuple):
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+    def _produce(self):
+        events = get_llm().generate_events(self.request.query, received_at=self.received_at, stop_event=self.stop_event,
+                                     embedding_model=self.request.embedding_model, session=self.session)
+        try:
+            for item in events:
+                if self._client_gone.is_set():
+                    break
+                self._put(item)
+        except Exception as exception:
+            logger.exception("Streaming generation failed")
+            if not self._client_gone.is_set():
+                self._put(("error", {"detail": str(exception)}))
+        finally:
+            events.close()
+            if not self._client_gone.is_set():
+                self._put(("end", None))
+
+    def start(self):
+        self._started = True
+        _ = self.loop.run_in_executor(None, self._produce)
+
+    def close(self):
+        """
+        Stops the generation and unblocks the worker thread. Safe to call more than once.
+        """
+        if not self._started and self.session is not None:
+            session, self.session = self.session, None
+            get_llm().sessions.release(session)
+        self._client_gone.set()
+        self.stop_event.set()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
 
 @router.post("/generate")
 async def generate(request: QueryRequest) -> StreamingResponse:
@@ -14,15 +153,208 @@ async def generate(request: QueryRequest) -> StreamingResponse:
     Generates a response based on the user input text using a pre-trained causal language model.
 
     This endpoint takes a JSON object with a single key "query" containing the user input text.
-    The response is a stream of generated text, which is produced in real-time.
+    The response is a stream of generated text, which is produced in real-time. The generation
+    is stopped when the client disconnects.
+
+    The response starts once the first token is generated, so a generation failing before it is
+    reported with a 500 status. A failure after the response started ends the text with an
+    "[error] <detail>" line, the status can no longer change.
 
     Parameters:
     request (QueryRequest): A JSON object with a single key "query" containing the user input text.
 
     Returns:
     StreamingResponse: A stream of generated text, which is produced in real-time.
+
+    Raises:
+    HTTPException: 409 if the previous turn of the conversation is still running, 500 if the
+        generation failed before its first token.
+    """
+    _check_embedding_model(request)
+    received_at = timer()
+    pump = _GenerationPump(request, received_at=received_at, session=await _acquire_session(request))
+
+    pump.start()
+    try:
+        event, payload = await pump.queue.get()
+        while event not in ("token", "error", "end"):
+            event, payload = await pump.queue.get()
+    except asyncio.CancelledError:
+        pump.close()
+        raise
+    if event == "error":
+        pump.close()
+        raise HTTPException(status_code=500, detail=payload["detail"])
+
+    async def text_stream(event: str, payload):
+        try:
+            while event != "end":
+                if event == "token":
+                    yield payload
+                elif event == "error":
+                    logger.warning("Generation failed after the response started",
+                                   extra={"fields": {"detail": payload["detail"]}})
+                    yield f"\n[error] {payload['detail']}\n"
+                    break
+                event, payload = await pump.queue.get()
+        finally:
+            # Reached when the client disconnects, the response generator is cancelled
+            pump.close()
+
+    # The background task also runs when the response ends before its body was iterated
+    return StreamingResponse(text_stream(event, payload), media_type="text/plain",
+                             background=BackgroundTask(pump.close))
+
+
+@router.post("/generate/stream")
+async def generate_stream(request: QueryRequest) -> StreamingResponse:
+    """
+    Generates a response as a stream of Server-Sent Events.
+
+    A "sources" event with the retrieved chunks is sent as soon as retrieval is done, followed by
+    "token" events and a final "done" event with the generation statistics. The first token is
+    flushed immediately, later tokens are coalesced into frames of up to settings.stream_flush_chars
+    characters or settings.stream_flush_interval seconds. The events are handed over through bounded
+    queues, see _GenerationPump, so a slow client throttles the generation, and the generation is
+    stopped as soon as the client disconnects.
+
+    Parameters:
+    request (QueryRequest): A JSON object with the user input text in "query", an optional
+        "conversation_id" continuing a session and an optional "embedding_model" to retrieve with.
+
+    Returns:
+    StreamingResponse: A text/event-stream response.
+
+    Raises:
+    HTTPException: 409 if the previous turn of the conversation is still running.
+    """
+    _check_embedding_model(request)
+    received_at = timer()
+    pump = _GenerationPump(request, received_at=received_at, session=await _acquire_session(request))
+    loop = pump.loop
+    queue = pump.queue
+
+    async def event_stream():
+        pump.start()
+        pending = None
+        first_token_sent = False
+        try:
+            while True:
+                event, payload = pending if pending is not None else await queue.get()
+                pending = None
+
+                if event == "end":
+                    break
+
+                if event == "sources":
+                    yield _format_sse("sources", [{
+                        "pdf_name": item["pdf_name"],
+                        "page_number": item["page_number"],
+                        "text": item["sentence_chunk"][:200],
+                        } for item in payload])
+
+                elif event == "token":
+                    parts = [payload]
+                    size = len(payload)
+                    deadline = loop.time() + (settings.stream_flush_interval if first_token_sent else 0.0)
+                    while size < settings.stream_flush_chars:
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        try:
+                            next_item = await asyncio.wait_for(queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                        if next_item[0] != "token":
+                            pending = next_item
+                            break
+                        parts.append(next_item[1])
+                        size += len(next_item[1])
+                    first_token_sent = True
+                    yield _format_sse("token", {"text": "".join(parts)})
+
+                else:
+                    yield _format_sse(event, payload)
+        finally:
+            # Reached when the client disconnects, stop generating and unblock the producer
+            pump.close()
+
+    return StreamingResponse(event_stream(),
+                             media_type="text/event-stream",
+                             background=BackgroundTask(pump.close),
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.get("/generate/cache")
+async def answer_cache_stats() -> dict[str, int | float | str | bool]:
+    """
+    Returns the hit-rate metrics of the semantic answer cache.
+
+    Returns:
+    dict[str, int | float | str | bool]: The cache counters, or {"enabled": False} when the cache is disabled.
     """
+    llm = get_llm()
+    if llm.answer_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **llm.answer_cache.stats()}
 
-    stream_response: Iterable[str] = llm.run_generation(request.query)
-    return StreamingResponse(stream_response, media_type="text/plain")
 
+@router.post("/sessions")
+async def create_session() -> dict[str, str]:
+    """
+    Returns a new conversation ID. The session itself is created by the first turn sent with it.
+
+    Returns:
+    dict[str, str]: The conversation ID.
+    """
+    return {"conversation_id": uuid.uuid4().hex}
+
+
+@router.get("/sessions")
+async def list_sessions() -> dict:
+    """
+    Returns the session store limits and counters, and a summary of every session.
+
+    Returns:
+    dict: The store statistics under "stats" and the session summaries under "sessions".
+    """
+    return {
+        "stats": get_llm().sessions.stats(),
+        "sessions": [session.summary() for session in list(get_llm().sessions.sessions.values())],
+        }
+
+
+@router.get("/sessions/{conversation_id}")
+async def get_session(conversation_id: str) -> dict:
+    """
+    Returns the history of a conversation.
+
+    Parameters:
+    conversation_id (str): The conversation ID.
+
+    Returns:
+    dict: The session summary and its messages.
+
+    Raises:
+    HTTPException: If the session does not exist or has expired.
+    """
+    session = get_llm().sessions.get(conversation_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {**session.summary(), "messages": list(session.messages)}
+
+
+@router.delete("/sessions/{conversation_id}")
+async def delete_session(conversation_id: str) -> dict[str, str]:
+    """
+    Deletes a session and frees its KV cache.
+
+    Parameters:
+    conversation_id (str): The conversation ID.
+
+    Raises:
+    HTTPException: If the session does not exist.
+    """
+    if not get_llm().sessions.delete(conversation_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"Deleted": conversation_id}
@@ -3,3 +3,5 @@ from pydantic import BaseModel
 
 class QueryRequest(BaseModel):
     query: str
+    conversation_id: str | None = None
+    embedding_model: str | None = None
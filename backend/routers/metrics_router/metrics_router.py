@@ -0,0 +1,17 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from utils.metrics.metrics import registry
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """
+    Exposes the counters and histograms of the server in the Prometheus text format.
+
+    Returns:
+    PlainTextResponse: The rendered metrics.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,83 @@
+from fastapi import APIRouter, HTTPException
+
+from .models import DefaultModelRequest, MigrationRequest
+from utils.model_registry.model_registry import model_registry
+from config import settings
+
+router = APIRouter()
+
+
+@router.get("/models")
+async def list_models() -> dict:
+    """
+    Lists the language model and the embedding stores of the model registry.
+
+    Returns:
+    dict: The language model under "llm", the default embedding model and the status, dimension
+        and document count of the store of every embedding model.
+    """
+    return {
+        "llm": settings.llm_model,
+        "default_embedding_model": model_registry.default_embedding_model,
+        "embedding_models": model_registry.describe(),
+        }
+
+
+@router.post("/models/embedding/migrate")
+async def migrate_embeddings(request: MigrationRequest) -> dict:
+    """
+    Starts a background job re-embedding the corpus with another embedding model.
+
+    The current default store keeps serving queries while the job runs. Once the job has succeeded
+    the new store can be queried per request, and becomes the default if make_default was set.
+
+    Parameters:
+    request (MigrationRequest): The embedding model and whether it becomes the default when done.
+
+    Returns:
+    dict: The started job.
+
+    Raises:
+    HTTPException: If the model is already the default or a migration to it is running.
+    """
+    try:
+        return model_registry.start_migration(request.model, make_default=request.make_default)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.post("/models/embedding/default")
+async def set_default_embedding_model(request: DefaultModelRequest) -> dict[str, str]:
+    """
+    Makes a migrated embedding model the default for new documents and queries.
+
+    Raises:
+    HTTPException: If the store of the model is not ready.
+    """
+    try:
+        model_registry.set_default(request.model)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"default_embedding_model": request.model}
+
+
+@router.get("/models/jobs")
+async def list_jobs() -> list[dict]:
+    """
+    Lists the migration jobs started since the server started.
+    """
+    return [model_registry.job_status(job_id) for job_id in list(model_registry.jobs)]
+
+
+@router.get("/models/jobs/{job_id}")
+async def get_job(job_id: str) -> dict:
+    """
+    Returns the status and progress of a migration job.
+
+    Raises:
+    HTTPException: If the job does not exist.
+    """
+    job = model_registry.job_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -0,0 +1,10 @@
+from pydantic import BaseModel
+
+
+class MigrationRequest(BaseModel):
+    model: str
+    make_default: bool = False
+
+
+class DefaultModelRequest(BaseModel):
+    model: str
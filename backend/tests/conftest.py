@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The application modules are imported relative to the backend directory, as when running main.py
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,73 @@
+import numpy as np
+
+from utils.context_selector.context_selector import select_context
+
+
+def test_keeps_similarity_order_without_mmr():
+    similarities = np.array([0.2, 0.9, 0.5, 0.7])
+
+    selected = select_context(similarities, max_items=3)
+
+    assert selected.tolist() == [1, 3, 2]
+
+
+def test_empty_when_nothing_passes_the_threshold():
+    similarities = np.array([0.1, 0.25, 0.05])
+
+    selected = select_context(similarities, min_similarity=0.3)
+
+    assert len(selected) == 0
+
+
+def test_threshold_drops_low_candidates():
+    similarities = np.array([0.8, 0.2, 0.6, 0.1])
+
+    selected = select_context(similarities, min_similarity=0.3)
+
+    assert selected.tolist() == [0, 2]
+
+
+def test_cuts_the_ranking_at_the_first_large_gap():
+    similarities = np.array([0.9, 0.85, 0.5, 0.45, 0.1])
+
+    selected = select_context(similarities, max_items=5, max_score_gap=0.2)
+
+    assert selected.tolist() == [0, 1]
+
+
+def test_small_gaps_keep_the_whole_ranking():
+    similarities = np.array([0.9, 0.8, 0.7, 0.6])
+
+    selected = select_context(similarities, max_items=5, max_score_gap=0.2)
+
+    assert selected.tolist() == [0, 1, 2, 3]
+
+
+def test_mmr_skips_near_duplicates():
+    similarities = np.array([0.9, 0.89, 0.7])
+    # The second candidate duplicates the first, the third points elsewhere
+    embeddings = np.array([[1.0, 0.0], [1.0, 0.01], [0.0, 1.0]])
+
+    selected = select_context(similarities, embeddings, max_items=2, mmr_lambda=0.5)
+
+    assert selected.tolist() == [0, 2]
+
+
+def test_mmr_with_lambda_one_keeps_similarity_order():
+    similarities = np.array([0.9, 0.89, 0.7])
+    embeddings = np.array([[1.0, 0.0], [1.0, 0.01], [0.0, 1.0]])
+
+    selected = select_context(similarities, embeddings, max_items=2, mmr_lambda=1.0)
+
+    assert selected.tolist() == [0, 1]
+
+
+def test_mmr_returns_every_candidate_once():
+    rng = np.random.default_rng(0)
+    similarities = rng.random(8)
+    embeddings = rng.normal(size=(8, 4))
+
+    selected = select_context(similarities, embeddings, max_items=8, mmr_lambda=0.7)
+
+    assert sorted(selected.tolist()) == list(range(8))
+    assert selected[0] == int(np.argmax(similarities))
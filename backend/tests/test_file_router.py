@@ -0,0 +1,73 @@
+import os
+
+import pytest
+from starlette.requests import Request
+
+
+@pytest.fixture(scope="module")
+def file_router(tmp_path_factory):
+    # The router creates its upload directory and journal in the working directory on import
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("file_router"))
+    try:
+        from routers.file_router import file_router
+    finally:
+        os.chdir(cwd)
+    return file_router
+
+
+def make_request(**headers) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/",
+                    "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]})
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    (" bytes=0-0 ", (0, 0)),
+])
+def test_parse_range(file_router, header, expected):
+    assert file_router._parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=-", "bytes=0-10,20-30", "items=0-10", "bytes=a-b"])
+def test_parse_range_ignores_unsupported_ranges(file_router, header):
+    assert file_router._parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=1000-1200", "bytes=50-10", "bytes=-0"])
+def test_parse_range_rejects_unsatisfiable_ranges(file_router, header):
+    with pytest.raises(ValueError):
+        file_router._parse_range(header, 1000)
+
+
+def test_not_modified_on_matching_etag(file_router):
+    request = make_request(if_none_match='"other", "abc"')
+
+    assert file_router._is_not_modified(request, '"abc"', 1_000_000)
+
+
+def test_not_modified_on_wildcard_etag(file_router):
+    assert file_router._is_not_modified(make_request(if_none_match="*"), '"abc"', 1_000_000)
+
+
+def test_modified_on_different_etag_even_if_older(file_router):
+    # If-None-Match takes precedence over If-Modified-Since
+    request = make_request(if_none_match='"other"', if_modified_since="Fri, 01 Jan 2100 00:00:00 GMT")
+
+    assert not file_router._is_not_modified(request, '"abc"', 1_000_000)
+
+
+def test_if_modified_since(file_router):
+    mtime = 1_700_000_000  # Tue, 14 Nov 2023 22:13:20 GMT
+
+    assert file_router._is_not_modified(make_request(if_modified_since="Tue, 14 Nov 2023 22:13:20 GMT"), '"abc"', mtime)
+    assert not file_router._is_not_modified(make_request(if_modified_since="Tue, 14 Nov 2023 22:13:19 GMT"), '"abc"', mtime)
+    assert not file_router._is_not_modified(make_request(if_modified_since="not a date"), '"abc"', mtime)
+
+
+def test_modified_without_conditional_headers(file_router):
+    assert not file_router._is_not_modified(make_request(), '"abc"', 1_000_000)
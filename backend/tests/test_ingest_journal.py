@@ -0,0 +1,185 @@
+import json
+import os
+
+import pytest
+
+import utils.file_hash.file_hash as fh
+from utils.ingest_journal.ingest_journal import (ABORTED, BEGIN, COMMITTED, PDF_WRITTEN, IngestJournal,
+                                                 recover_ingest_jobs, remove_temporary_files)
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    upload_directory = tmp_path / "uploads"
+    store_directory = tmp_path / "embeddings"
+    upload_directory.mkdir()
+    store_directory.mkdir()
+    return str(upload_directory), str(store_directory), str(tmp_path / "file_hashes.csv")
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return IngestJournal(str(tmp_path / "ingest_journal.jsonl"))
+
+
+def write(path: str, content: bytes = b"content") -> str:
+    with open(path, "wb") as file:
+        file.write(content)
+    return fh.calculate_path_hash(path)
+
+
+def write_document(store_directory: str, pdf_name: str):
+    csv_path = os.path.join(store_directory, pdf_name + ".csv")
+    write(csv_path, b"sentence_chunk,page_number\n")
+    write(csv_path + ".npy", b"embeddings")
+    return csv_path
+
+
+def last_states(journal: IngestJournal) -> dict[str, dict]:
+    states = {}
+    with open(journal.path, encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            states.setdefault(record["job_id"], {}).update(record)
+    return states
+
+
+def test_begin_without_pdf_is_rolled_back(dirs, journal):
+    upload_directory, store_directory, hash_file_path = dirs
+    job_id = journal.begin("a.pdf", "0" * 64)
+    write(os.path.join(upload_directory, "a.pdf.123.tmp"))
+    write(os.path.join(store_directory, "a.pdf.csv.123.tmp"))
+
+    to_resume, to_delete = recover_ingest_jobs(journal, upload_directory, store_directory, hash_file_path)
+
+    assert to_resume == [] and to_delete == []
+    assert last_states(journal)[job_id]["state"] == ABORTED
+    assert os.listdir(upload_directory) == [] and os.listdir(store_directory) == []
+
+
+def test_pdf_renamed_before_its_record_is_resumed(dirs, journal):
+    upload_directory, store_directory, hash_file_path = dirs
+    file_hash = write(os.path.join(upload_directory, "a.pdf"))
+    job_id = journal.begin("a.pdf", file_hash)
+
+    to_resume, _ = recover_ingest_jobs(journal, upload_directory, store_directory, hash_file_path)
+
+    assert [job["job_id"] for job in to_resume] == [job_id]
+    assert last_states(journal)[job_id]["state"] == BEGIN
+
+
+def test_pdf_written_is_resumed(dirs, journal):
+    upload_directory, store_directory, hash_file_path = dirs
+    file_hash = write(os.path.join(upload_directory, "a.pdf"))
+    job_id = journal.begin("a.pdf", file_hash)
+    journal.mark(job_id, PDF_WRITTEN)
+
+    to_resume, _ = recover_ingest_jobs(journal, upload_directory, store_directory, hash_file_path)
+
+    assert [job["job_id"] for job in to_resume] == [job_id]
+    assert os.path.exists(os.path.join(upload_directory, "a.pdf"))
+
+
+def test_pdf_written_without_pdf_is_aborted(dirs, journal):
+    upload_directory, store_directory, hash_file_path = dirs
+    job_id = journal.begin("a.pdf", "0" * 64)
+    journal.mark(job_id, PDF_WRITTEN)
+    write_document(store_directory, "a.pdf")
+
+    to_resume, _ = recover_ingest_jobs(journal, upload_directory, store_directory, hash_file_path)
+
+    assert to_resume == []
+    assert last_states(journal)[job_id]["state"] == ABORTED
+    assert last_states(journal)[job_id]["error"] == "The PDF is missing"
+    assert os.listdir(store_directory) == []
+
+
+def test_crash_before_commit_record_is_committed(dirs, journal):
+    upload_directory, store_directory, hash_file_path = dirs
+    file_hash = write(os.path.join(upload_directory, "a.pdf"))
+    job_id = journal.begin("a.pdf", file_hash)
+    journal.mark(job_id, PDF_WRITTEN)
+    write_document(store_directory, "a.pdf")
+    fh.record_file_hash("a.pdf", file_hash, hash_file_path)
+
+    to_resume, _ = recover_ingest_jobs(journal, upload_directory, store_directory, hash_file_path)
+
+    assert to_resume == []
+    assert last_states(journal)[job_id]["state"] == COMMITTED
+    assert os.path.exists(os.path.join(store_directory, "a.pdf.csv"))
+
+
+def test_rollback_keeps_the_committed_document_of_the_same_name(dirs, journal):
+    upload_directory, store_directory, hash_file_path = dirs
+    committed_hash = write(os.path.join(upload_directory, "a.pdf"), b"committed")
+    csv_path = write_document(store_directory, "a.pdf")
+    fh.record_file_hash("a.pdf", committed_hash, hash_file_path)
+    job_id = journal.begin("a.pdf", "0" * 64)
+    write(os.path.join(upload_directory, "a.pdf.123.tmp"))
+
+    to_resume, _ = recover_ingest_jobs(journal, upload_directory, store_directory, hash_file_path)
+
+    assert to_resume == []
+    assert last_states(journal)[job_id]["state"] == ABORTED
+    assert fh.calculate_path_hash(os.path.join(upload_directory, "a.pdf")) == committed_hash
+    assert os.path.exists(csv_path) and os.path.exists(csv_path + ".npy")
+    assert not os.path.exists(os.path.join(upload_directory, "a.pdf.123.tmp"))
+
+
+def test_recovery_keeps_committed_documents_named_like_temporary_files(dirs, journal):
+    upload_directory, store_directory, hash_file_path = dirs
+    committed_hash = write(os.path.join(upload_directory, "a.tmp.pdf"))
+    csv_path = write_document(store_directory, "a.tmp.pdf")
+    fh.record_file_hash("a.tmp.pdf", committed_hash, hash_file_path)
+    job_id = journal.begin("a.tmp.pdf", "0" * 64)
+    temporary_paths = [os.path.join(upload_directory, "a.tmp.pdf.123.tmp"),
+                       os.path.join(upload_directory, "a.tmp.pdf." + "f" * 32 + ".tmp"),
+                       os.path.join(store_directory, "a.tmp.pdf.csv.123.tmp"),
+                       os.path.join(store_directory, "a.tmp.pdf.csv.npy.123.tmp.npy")]
+    for path in temporary_paths:
+        write(path)
+
+    remove_temporary_files(upload_directory)
+    remove_temporary_files(store_directory)
+    recover_ingest_jobs(journal, upload_directory, store_directory, hash_file_path)
+
+    assert last_states(journal)[job_id]["state"] == ABORTED
+    assert fh.calculate_path_hash(os.path.join(upload_directory, "a.tmp.pdf")) == committed_hash
+    assert os.path.exists(csv_path) and os.path.exists(csv_path + ".npy")
+    assert not any(os.path.exists(path) for path in temporary_paths)
+
+
+def test_deletions_are_returned(dirs, journal):
+    upload_directory, store_directory, hash_file_path = dirs
+    job_id = journal.begin("a.pdf", None, kind="delete")
+
+    to_resume, to_delete = recover_ingest_jobs(journal, upload_directory, store_directory, hash_file_path)
+
+    assert to_resume == []
+    assert [job["job_id"] for job in to_delete] == [job_id]
+
+
+def test_incomplete_jobs_ignore_finished_jobs_and_truncated_lines(journal):
+    committed = journal.begin("a.pdf", "a")
+    journal.mark(committed, COMMITTED)
+    aborted = journal.begin("b.pdf", "b")
+    journal.mark(aborted, ABORTED, error="failed")
+    pending = journal.begin("c.pdf", "c")
+    journal.mark(pending, PDF_WRITTEN)
+    with open(journal.path, "a", encoding="utf-8") as file:
+        file.write('{"job_id": "trunc')
+
+    jobs = journal.incomplete_jobs()
+
+    assert [(job["job_id"], job["pdf"], job["state"]) for job in jobs] == [(pending, "c.pdf", PDF_WRITTEN)]
+
+
+def test_compact_keeps_only_incomplete_jobs(journal):
+    committed = journal.begin("a.pdf", "a")
+    journal.mark(committed, COMMITTED)
+    pending = journal.begin("c.pdf", "c")
+
+    journal.compact()
+
+    assert list(last_states(journal)) == [pending]
+    assert journal.incomplete_jobs()[0]["pdf"] == "c.pdf"
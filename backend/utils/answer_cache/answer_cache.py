@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+
+import torch
+import torch.nn.functional as F
+
+
+class SemanticAnswerCache:
+    def __init__(self, similarity_threshold: float = 0.95, max_entries: int = 512):
+        """
+        Constructor for SemanticAnswerCache.
+
+        The cache stores generated answers together with the embedding of the query that produced
+        them and the set of chunks that were placed in the prompt. A new query is answered from the
+        cache when its embedding is close enough to a cached query and the same chunks were retrieved.
+
+        Parameters:
+        similarity_threshold (float): The minimum cosine similarity between two queries for a cached
+            answer to be reused. Defaults to 0.95.
+        max_entries (int): The maximum number of cached answers, the least recently used answers
+            are evicted first. Defaults to 512.
+
+        Sets the following attributes:
+        entries (OrderedDict[int, dict]): The cached answers in least recently used order.
+        corpus_version (str): The version of the corpus the cached answers were generated against.
+        hits, misses, evictions, invalidations (int): Counters exposed through stats().
+        """
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+
+        self.entries: OrderedDict[int, dict] = OrderedDict()
+        self.corpus_version: str = ""
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+        self._next_id: int = 0
+        self._matrix: torch.Tensor | None = None
+        self._matrix_ids: list[int] = []
+        self._lock = Lock()
+
+
+    @staticmethod
+    def chunk_key(context_items: list[dict]) -> frozenset[tuple[str, int, str]]:
+        """
+        Builds an order independent key of the chunks placed in a prompt.
+
+        Parameters:
+        context_items (list[dict]): The retrieved chunks.
+
+        Returns:
+        frozenset[tuple[str, int, str]]: The (pdf name, page number, text digest) of every chunk.
+        """
+        return frozenset(
+                (str(item["pdf_name"]), int(item["page_number"]),
+                 hashlib.sha1(str(item["sentence_chunk"]).encode("utf-8")).hexdigest())
+                for item in context_items
+                )
+
+
+    def set_corpus_version(self, corpus_version: str):
+        """
+        Invalidates every cached answer when the corpus has changed.
+
+        Parameters:
+        corpus_version (str): The version of the current corpus.
+        """
+        with self._lock:
+            if corpus_version == self.corpus_version:
+                return
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self._matrix = None
+            self.corpus_version = corpus_version
+
+
+    def lookup(self, query_embedding: torch.Tensor, chunk_key: frozenset) -> str | None:
+        """
+        Returns a cached answer for the query if there is one.
+
+        Parameters:
+        query_embedding (torch.Tensor): The embedding of the new query.
+        chunk_key (frozenset): The key of the chunks retrieved for the new query.
+
+        Returns:
+        str | None: The cached answer, or None on a cache miss.
+        """
+        with self._lock:
+            if self.entries:
+                if self._matrix is None:
+                    self._matrix_ids = list(self.entries.keys())
+                    self._matrix = torch.stack([self.entries[i]["query_embedding"] for i in self._matrix_ids])
+
+                query = F.normalize(query_embedding.detach().float().cpu(), dim=0)
+                similarities = self._matrix @ query
+                candidates = torch.nonzero(similarities >= self.similarity_threshold).flatten()
+
+                for position in sorted(candidates.tolist(), key=lambda p: similarities[p].item(), reverse=True):
+                    entry_id = self._matrix_ids[position]
+                    if self.entries[entry_id]["chunk_key"] == chunk_key:
+                        self.entries.move_to_end(entry_id)
+                        self.hits += 1
+                        return self.entries[entry_id]["answer"]
+
+            self.misses += 1
+            return None
+
+
+    def store(self, query_embedding: torch.Tensor, chunk_key: frozenset, answer: str):
+        """
+        Adds an answer to the cache, evicting the least recently used answers when it is full.
+
+        Parameters:
+        query_embedding (torch.Tensor): The embedding of the query.
+        chunk_key (frozenset): The key of the chunks the answer was generated from.
+        answer (str): The generated answer.
+        """
+        with self._lock:
+            self.entries[self._next_id] = {
+                    "query_embedding": F.normalize(query_embedding.detach().float().cpu(), dim=0),
+                    "chunk_key": chunk_key,
+                    "answer": answer,
+                    }
+            self._next_id += 1
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+
+    def stats(self) -> dict[str, int | float | str]:
+        """
+        Returns the cache counters.
+
+        Returns:
+        dict[str, int | float | str]: The size, hits, misses, hit rate, evictions, invalidations and corpus version.
+        """
+        lookups = self.hits + self.misses
+        return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "corpus_version": self.corpus_version,
+                }
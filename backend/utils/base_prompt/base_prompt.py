@@ -96,3 +96,20 @@ IMPLEMENTATION NOTES:
 
 Anwser:
 """
+
+FOLLOW_UP_PROMPT = """{query}
+"""
+
+NO_INFORMATION_RESPONSE = """**Confidence**: None
+**Relevant Quotes**: []
+**Answer**: I apologize, but I cannot find information about "{query}" in the provided context. I can only provide information that is explicitly present in these documents.
+"""
+
+FOLLOW_UP_CONTEXT_PROMPT = """ADDITIONAL CONTEXT:
+{context}
+
+Follow the same guidelines and response format as before, using the context above and the additional context.
+
+QUERY:
+{query}
+"""
@@ -0,0 +1,196 @@
+import sys
+from typing import Iterable
+
+import numpy as np
+
+
+class ChunkStore:
+    def __init__(self):
+        """
+        Constructor for ChunkStore.
+
+        Holds the metadata of every chunk in a few flat arrays instead of one dict per chunk.
+        Rows are numbered in insertion order, the chunks of a document are contiguous.
+
+        Sets the following attributes:
+        text_buffer (bytes): The UTF-8 encoded text of every chunk, concatenated.
+        text_offsets (np.ndarray): int64 array, the text of row i is text_buffer[text_offsets[i]:text_offsets[i + 1]].
+        page_numbers (np.ndarray): int32 array with the page number of each row.
+        document_ids (np.ndarray): int32 array with the index into document_names of each row.
+        document_names (list[str]): The interned name of each document.
+        document_starts (np.ndarray): int64 array, the first row of each document plus the total number of rows.
+        """
+        self.text_buffer: bytes = b""
+        self.text_offsets = np.zeros(1, dtype=np.int64)
+        self.page_numbers = np.zeros(0, dtype=np.int32)
+        self.document_ids = np.zeros(0, dtype=np.int32)
+        self.document_names: list[str] = []
+        self.document_starts = np.zeros(1, dtype=np.int64)
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[tuple[str, Iterable[str], Iterable[int]]]) -> "ChunkStore":
+        """
+        Builds a store from the chunks of several documents.
+
+        Parameters:
+        documents (Iterable[tuple[str, Iterable[str], Iterable[int]]]): (document name, chunk texts,
+            page numbers) for each document, in the order the documents should be numbered.
+
+        Returns:
+        ChunkStore: The populated store.
+        """
+        store = cls()
+        encoded_texts: list[bytes] = []
+        lengths: list[int] = []
+        page_numbers: list[np.ndarray] = []
+        document_ids: list[np.ndarray] = []
+        document_starts = [0]
+
+        for document_id, (name, texts, pages) in enumerate(documents):
+            encoded = [str(text).encode("utf-8") for text in texts]
+            pages = np.asarray(list(pages), dtype=np.int32)
+            if len(pages) != len(encoded):
+                raise ValueError(f"Document {name} has {len(encoded)} chunks but {len(pages)} page numbers")
+
+            store.document_names.append(sys.intern(name))
+            encoded_texts.extend(encoded)
+            lengths.extend(len(text) for text in encoded)
+            page_numbers.append(pages)
+            document_ids.append(np.full(len(encoded), document_id, dtype=np.int32))
+            document_starts.append(document_starts[-1] + len(encoded))
+
+        store.text_buffer = b"".join(encoded_texts)
+        store.text_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        store.text_offsets[1:] = np.cumsum(np.asarray(lengths, dtype=np.int64))
+        if page_numbers:
+            store.page_numbers = np.concatenate(page_numbers)
+            store.document_ids = np.concatenate(document_ids)
+        store.document_starts = np.asarray(document_starts, dtype=np.int64)
+        return store
+
+    def __len__(self) -> int:
+        return len(self.page_numbers)
+
+    def row_id(self, document_index: int, local_index: int) -> int:
+        """
+        Returns the row ID of the local_index-th chunk of a document.
+        """
+        return int(self.document_starts[document_index] + local_index)
+
+    def locate(self, row_id: int) -> tuple[int, int]:
+        """
+        Returns the (document index, local index) of a row ID, the inverse of row_id.
+        """
+        document_index = int(self.document_ids[row_id])
+        return document_index, int(row_id - self.document_starts[document_index])
+
+    def document_size(self, document_index: int) -> int:
+        """
+        Returns the number of chunks of a document.
+        """
+        return int(self.document_starts[document_index + 1] - self.document_starts[document_index])
+
+    def text(self, row_id: int) -> str:
+        """
+        Returns the text of a chunk.
+        """
+        return self.text_buffer[self.text_offsets[row_id]:self.text_offsets[row_id + 1]].decode("utf-8")
+
+    def get(self, row_id: int) -> dict:
+        """
+        Returns one chunk in the dict form used by the prompt builder.
+
+        Parameters:
+        row_id (int): The row ID of the chunk.
+
+        Returns:
+        dict: The keys sentence_chunk, page_number, pdf_name and row_id.
+        """
+        return {
+            "sentence_chunk": self.text(row_id),
+            "page_number": int(self.page_numbers[row_id]),
+            "pdf_name": self.document_names[self.document_ids[row_id]],
+            "row_id": int(row_id),
+            }
+
+    def get_many(self, row_ids: Iterable[int]) -> list[dict]:
+        """
+        Returns several chunks, in the order of row_ids.
+        """
+        return [self.get(row_id) for row_id in row_ids]
+
+    def memory_usage(self) -> int:
+        """
+        Returns the number of bytes held by the store, including the document names.
+        """
+        return (len(self.text_buffer)
+                + self.text_offsets.nbytes
+                + self.page_numbers.nbytes
+                + self.document_ids.nbytes
+                + self.document_starts.nbytes
+                + sum(sys.getsizeof(name) for name in self.document_names))
+
+
+if __name__ == "__main__":
+    # Compares the memory held per million chunks by the store and by the list of record dicts it
+    # replaces. The records still carry the parsed float32 embedding they used to duplicate.
+    import argparse
+    import gc
+    import tracemalloc
+
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Measure the memory of the chunk metadata per million chunks.")
+    parser.add_argument("--chunks", type=int, default=200_000, help="Number of synthetic chunks.")
+    parser.add_argument("--documents", type=int, default=100, help="Number of synthetic documents.")
+    parser.add_argument("--chunk-chars", type=int, default=1000, help="Characters per chunk.")
+    parser.add_argument("--dimension", type=int, default=768, help="Embedding dimension of the records.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    per_document = args.chunks // args.documents
+    base_text = ("lorem ipsum dolor sit amet " * (args.chunk_chars // 27 + 1))[:args.chunk_chars - 8]
+
+    def measure(build) -> tuple[int, object]:
+        gc.collect()
+        tracemalloc.start()
+        result = build()
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return current, result
+
+    def build_records() -> list[list[dict]]:
+        pages_and_chunks = []
+        for document in range(args.documents):
+            chunk_df = pd.DataFrame({
+                "page_number": np.arange(per_document) // 10,
+                "sentence_chunk": [f"{base_text}{i:08d}" for i in range(per_document)],
+                "chunk_char_count": args.chunk_chars,
+                "chunk_word_count": args.chunk_chars // 6,
+                "chunk_token_count": args.chunk_chars / 4,
+                })
+            chunk_df["pdf_name"] = f"document-{document}.pdf"
+            chunk_df["embedding"] = list(rng.random((per_document, args.dimension), dtype=np.float32))
+            pages_and_chunks.append(chunk_df.to_dict(orient="records"))
+        return pages_and_chunks
+
+    def build_store() -> ChunkStore:
+        return ChunkStore.from_documents(
+                (f"document-{document}.pdf",
+                 (f"{base_text}{i:08d}" for i in range(per_document)),
+                 np.arange(per_document) // 10)
+                for document in range(args.documents))
+
+    n_chunks = per_document * args.documents
+    embedding_bytes = n_chunks * args.dimension * 4
+    records_bytes, records = measure(build_records)
+    del records
+    store_bytes, store = measure(build_store)
+
+    scale = 1_000_000 / n_chunks
+    print(f"{n_chunks} chunks of {args.chunk_chars} characters")
+    print(f"record dicts:         {records_bytes * scale / 2**20:10.1f} MiB per million chunks "
+          f"({(records_bytes - embedding_bytes) * scale / 2**20:.1f} MiB without the duplicated embeddings)")
+    print(f"chunk store:          {store_bytes * scale / 2**20:10.1f} MiB per million chunks")
+    print(f"chunk store overhead: {(store.memory_usage() - len(store.text_buffer)) / n_chunks:10.1f} bytes per chunk")
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def select_context(similarities: np.ndarray,
+                   embeddings: np.ndarray | None = None,
+                   max_items: int = 5,
+                   min_similarity: float = 0.0,
+                   max_score_gap: float | None = None,
+                   mmr_lambda: float = 1.0) -> np.ndarray:
+    """
+    Chooses which retrieved candidates are placed in the prompt, instead of always the top k.
+
+    The candidates are ranked by similarity and filtered in three steps, each vectorized over the
+    candidate set:
+        1. candidates below min_similarity are dropped;
+        2. the ranking is cut at the first drop between consecutive similarities larger than
+           max_score_gap, which separates the chunks that answer the query from the rest;
+        3. up to max_items candidates are picked by maximal marginal relevance, trading the
+           similarity to the query for the dissimilarity to the candidates already picked, so
+           near-duplicate chunks do not fill the prompt.
+
+    Parameters:
+    similarities (np.ndarray): The similarity of each candidate to the query.
+    embeddings (np.ndarray | None): The embedding of each candidate, only needed for MMR.
+    max_items (int): The maximum number of candidates returned. Defaults to 5.
+    min_similarity (float): The similarity a candidate needs to be kept. Defaults to 0.
+    max_score_gap (float | None): The largest drop in similarity kept within the ranking, None disables
+        the cut. Defaults to None.
+    mmr_lambda (float): The weight of the similarity to the query in MMR, 1 keeps the similarity
+        order. Defaults to 1.
+
+    Returns:
+    np.ndarray: The indices of the selected candidates in the order they should be placed, empty
+        when no candidate passes min_similarity.
+    """
+    similarities = np.asarray(similarities, dtype=np.float32).reshape(-1)
+    order = np.argsort(-similarities, kind="stable")
+    ranked = similarities[order]
+
+    n_kept = int(np.count_nonzero(ranked >= min_similarity))
+    if max_score_gap is not None and n_kept > 1:
+        gaps = np.flatnonzero(ranked[:n_kept - 1] - ranked[1:n_kept] > max_score_gap)
+        if len(gaps):
+            n_kept = int(gaps[0]) + 1
+    candidates = order[:n_kept]
+
+    if mmr_lambda >= 1.0 or embeddings is None or n_kept <= 1:
+        return candidates[:max_items]
+
+    candidate_embeddings = np.asarray(embeddings, dtype=np.float32)[candidates]
+    norms = np.linalg.norm(candidate_embeddings, axis=1, keepdims=True)
+    candidate_embeddings = candidate_embeddings / np.maximum(norms, 1e-12)
+    pairwise = candidate_embeddings @ candidate_embeddings.T
+    relevance = similarities[candidates]
+
+    selected = [0]
+    redundancy = pairwise[0].copy()
+    available = np.ones(n_kept, dtype=bool)
+    available[0] = False
+    for _ in range(min(max_items, n_kept) - 1):
+        mmr = np.where(available, mmr_lambda * relevance - (1.0 - mmr_lambda) * redundancy, -np.inf)
+        best = int(np.argmax(mmr))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, pairwise[best])
+    return candidates[selected]
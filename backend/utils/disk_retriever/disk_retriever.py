@@ -0,0 +1,272 @@
+import heapq
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter as timer
+
+import numpy as np
+import pandas as pd
+import torch
+
+from utils.chunk_store.chunk_store import ChunkStore
+from utils.file_reader.file_reader import (EmbeddingsReader, blocked_scores, embedding_sidecar_path,
+                                           load_embeddings_array, to_float32)
+from utils.logger.logger import get_logger
+from utils.metrics.metrics import CACHE_EVENTS, STAGE_SECONDS
+
+
+logger = get_logger("disk_retriever")
+
+
+class DiskEmbeddingsReader(EmbeddingsReader):
+    def __init__(self,
+                 block_rows: int = 65536,
+                 hot_tier_bytes: int = 512 * 2**20,
+                 promote_after_hits: int = 2,
+                 prefetch_workers: int = 4,
+                 embedding_model=None,
+                 embedding_dtype: str = "float32"):
+        """
+        Constructor for DiskEmbeddingsReader.
+
+        Keeps the embeddings on disk as memory-mapped sidecars instead of loading them at startup.
+        Each query streams the embeddings through the scorer one block at a time while a prefetch
+        thread reads the next block, and keeps a running top k heap, so memory use does not grow
+        with the corpus. Documents that keep appearing in the results are copied into an in-memory
+        hot tier, managed as an LRU cache within hot_tier_bytes, by a separate promotion thread so
+        the copies never delay the reads of a query.
+
+        Parameters:
+        block_rows (int): The number of embeddings read and scored at once. Defaults to 65536.
+        hot_tier_bytes (int): The memory budget of the hot tier, 0 disables it. Defaults to 512 MiB.
+        promote_after_hits (int): The number of queries a document has to appear in the results of
+            before it is promoted to the hot tier. Defaults to 2.
+        prefetch_workers (int): The number of prefetch threads, each query reads ahead one block at
+            a time, so this is the number of concurrent queries that prefetch without waiting. Defaults to 4.
+        embedding_model (SentenceTransformer | None): The model used to embed queries, see EmbeddingsReader.
+        embedding_dtype (str): The dtype of the sidecars that are memory-mapped, see EmbeddingsReader.
+
+        Sets the following attributes:
+        memmaps (list[np.ndarray]): The memory-mapped embeddings of each document.
+        hot_tier (OrderedDict[str, np.ndarray]): The in-memory embeddings of the hot documents, by sidecar path.
+        """
+        super().__init__(embedding_model=embedding_model, embedding_dtype=embedding_dtype)
+        self.block_rows = block_rows
+        self.hot_tier_bytes = hot_tier_bytes
+        self.promote_after_hits = promote_after_hits
+
+        self.memmaps: list[np.ndarray] = []
+        self.hot_tier: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._document_keys: list[str] = []
+        self._hits: dict[str, int] = {}
+        self._hot_lock = Lock()
+        self._prefetcher = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="embedding-prefetch")
+        self._promoter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-promote")
+
+    def read_csvs(self, csv_file_pahts: list[str]):
+        """
+        Reads the chunk text of the CSV files and memory-maps their embeddings.
+
+        Only the chunk text is loaded, so startup time and memory do not depend on the size of the
+        embeddings. Hot documents whose sidecar did not change stay in the hot tier.
+
+        Parameters:
+        csv_file_pahts (list[str]): A list of paths to the CSV files to read
+        """
+        self.embeddings = []
+
+        documents = []
+        memmaps = []
+        document_keys = []
+        for csv_file_path in csv_file_pahts:
+            chunk_df = pd.read_csv(csv_file_path, usecols=["sentence_chunk", "page_number"])
+            documents.append((os.path.basename(csv_file_path).replace(".csv", ""),
+                              chunk_df["sentence_chunk"], chunk_df["page_number"]))
+            memmaps.append(load_embeddings_array(csv_file_path, self.embedding_dtype))
+            npy_path = embedding_sidecar_path(csv_file_path, self.embedding_dtype)
+            document_keys.append(f"{npy_path}:{os.stat(npy_path).st_mtime_ns}")
+
+        with self._hot_lock:
+            self.chunk_store = ChunkStore.from_documents(documents)
+            self.memmaps = memmaps
+            self._document_keys = document_keys
+            for key in [key for key in self.hot_tier if key not in document_keys]:
+                del self.hot_tier[key]
+            self._hits = {key: hits for key, hits in self._hits.items() if key in document_keys}
+
+    def _hot_tier_size(self) -> int:
+        return sum(embeddings.nbytes for embeddings in self.hot_tier.values())
+
+    def _promote(self, key: str, memmap: np.ndarray):
+        """
+        Copies the embeddings of a document into the hot tier, evicting the least recently used ones.
+        Runs on the promotion thread so the query that triggered it does not wait for the read.
+        The document is skipped if a reload removed its key in the meantime.
+        """
+        if memmap.nbytes > self.hot_tier_bytes:
+            return
+        embeddings = np.array(memmap)
+        with self._hot_lock:
+            if key not in self._document_keys or key in self.hot_tier:
+                return
+            while self.hot_tier and self._hot_tier_size() + embeddings.nbytes > self.hot_tier_bytes:
+                self.hot_tier.popitem(last=False)
+                CACHE_EVENTS.inc(cache="hot_tier", result="evicted")
+            self.hot_tier[key] = embeddings
+
+    def _record_hits(self, hit_memmaps: dict[str, np.ndarray]):
+        """
+        Counts the documents appearing in the results of a query and promotes those hit often enough.
+
+        Parameters:
+        hit_memmaps (dict[str, np.ndarray]): The memory-mapped embeddings of the documents hit, by
+        document key, taken from the snapshot the query scored so they match even after a reload.
+        """
+        if not self.hot_tier_bytes:
+            return
+        with self._hot_lock:
+            to_promote = []
+            for key, memmap in hit_memmaps.items():
+                if key not in self._document_keys:
+                    continue
+                if key in self.hot_tier:
+                    self.hot_tier.move_to_end(key)
+                    continue
+                self._hits[key] = self._hits.get(key, 0) + 1
+                if self._hits[key] >= self.promote_after_hits:
+                    self._hits[key] = 0
+                    to_promote.append((key, memmap))
+        for key, memmap in to_promote:
+            self._promoter.submit(self._promote, key, memmap)
+
+    def retrive_relevant_resources(self,
+                                  query: str,
+                                  n_resources_to_return: int=5,
+                                  print_time: bool=True,
+                                  query_embedding: torch.Tensor | None = None,
+                                  timings: dict[str, float] | None = None,
+                                  return_embeddings: bool = False):
+        """
+        Retrieves the top n relevant resources by streaming the embeddings through the scorer.
+
+        Hot documents are scored first from memory. The other documents are split into blocks of
+        block_rows embeddings, and the next block is read from disk while the current one is scored.
+
+        Parameters:
+        query (str): The query to search for
+        n_resources_to_return (int): The number of relevant resources to return. Defaults to 5.
+        print_time (bool): If True, prints the time taken to compute the scores. Defaults to True.
+        query_embedding (torch.Tensor | None): The embedding of the query, if it was already computed by the caller.
+        timings (dict[str, float] | None): If given, the time taken by each stage is added to it.
+        return_embeddings (bool): If True, each result also holds its float32 embedding under "embedding",
+            read from the same snapshot of the documents the scores were computed on. Defaults to False.
+
+        Returns:
+        A list of dictionaries, each containing the row ID, batch index, embedding index, and similarity score of the top n most relevant resources.
+        """
+        embed_start_time = timer()
+        if query_embedding is None:
+            query_embedding = self.encode_query(query)
+        query_array = query_embedding.detach().float().cpu().numpy().reshape(-1)
+        embed_end_time = timer()
+
+        start_time = timer()
+        with self._hot_lock:
+            memmaps = self.memmaps
+            chunk_store = self.chunk_store
+            document_keys = self._document_keys
+            hot_tier = {key: self.hot_tier[key] for key in document_keys if key in self.hot_tier}
+
+        # Blocks of (batch index, first row, embeddings), the memory-mapped ones are read lazily
+        hot_blocks = []
+        cold_blocks = []
+        for batch_index, (key, memmap) in enumerate(zip(document_keys, memmaps)):
+            if key in hot_tier:
+                hot_blocks.append((batch_index, 0, hot_tier[key]))
+            else:
+                cold_blocks.extend((batch_index, start, memmap[start:start + self.block_rows])
+                                   for start in range(0, len(memmap), self.block_rows))
+        CACHE_EVENTS.inc(len(hot_blocks), cache="hot_tier", result="hit")
+        CACHE_EVENTS.inc(len({batch_index for batch_index, _, _ in cold_blocks}), cache="hot_tier", result="miss")
+
+        heap: list[tuple[float, int, int]] = []
+
+        def score_block(batch_index: int, start: int, embeddings: np.ndarray):
+            if len(embeddings) == 0:
+                return
+            scores = blocked_scores(embeddings, query_array, self.embedding_dtype, block_rows=self.block_rows)
+            k = min(n_resources_to_return, len(scores))
+            local_indices = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+            for i in local_indices:
+                item = (float(scores[i]), batch_index, start + int(i))
+                if len(heap) < n_resources_to_return:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        if n_resources_to_return > 0:
+            pending = self._prefetcher.submit(np.ascontiguousarray, cold_blocks[0][2]) if cold_blocks else None
+            for block in hot_blocks:
+                score_block(*block)
+            for i, (batch_index, start, _) in enumerate(cold_blocks):
+                embeddings = pending.result()
+                pending = self._prefetcher.submit(np.ascontiguousarray, cold_blocks[i + 1][2]) \
+                        if i + 1 < len(cold_blocks) else None
+                score_block(batch_index, start, embeddings)
+
+        merged = sorted(heap, reverse=True)
+        end_time = timer()
+
+        if timings is not None:
+            timings.update({
+                    "embed_query": embed_end_time - embed_start_time,
+                    "score": end_time - start_time,
+                    "hot_documents": float(len(hot_blocks)),
+                    })
+        STAGE_SECONDS.observe(end_time - start_time, stage="retrieval_score")
+
+        if print_time:
+            logger.debug(f"Time taken to stream {len(cold_blocks)} blocks and {len(hot_blocks)} hot documents: "
+                         f"{end_time - start_time:.5f} seconds.")
+
+        self._record_hits({document_keys[batch_index]: memmaps[batch_index] for _, batch_index, _ in merged})
+
+        return [{
+            'row_id': chunk_store.row_id(batch_index, local_index),
+            'batch': batch_index,
+            'embedding_index': local_index,
+            'similarity': score,
+            **({'embedding': to_float32(memmaps[batch_index][local_index:local_index + 1], self.embedding_dtype)[0]}
+               if return_embeddings else {}),
+            } for score, batch_index, local_index in merged]
+
+
+if __name__ == "__main__":
+    # Measures query latency with a cold and with a warm hot tier on a synthetic corpus
+    import tempfile
+
+    n_documents, chunks_per_document, dimension, n_queries = 16, 50_000, 768, 50
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        csv_paths = []
+        for i in range(n_documents):
+            csv_path = os.path.join(directory, f"document_{i}.pdf.csv")
+            pd.DataFrame({"page_number": np.zeros(chunks_per_document, dtype=int),
+                          "sentence_chunk": [""] * chunks_per_document}).to_csv(csv_path, index=False)
+            np.save(csv_path + ".npy", rng.standard_normal((chunks_per_document, dimension), dtype=np.float32))
+            csv_paths.append(csv_path)
+
+        queries = torch.from_numpy(rng.standard_normal((n_queries, dimension), dtype=np.float32))
+
+        for hot_tier_bytes in [0, 2**31]:
+            reader = DiskEmbeddingsReader(hot_tier_bytes=hot_tier_bytes, promote_after_hits=1)
+            reader.read_csvs(csv_paths)
+            for _ in range(2):
+                start_time = timer()
+                for query_embedding in queries:
+                    reader.retrive_relevant_resources("", query_embedding=query_embedding, print_time=False)
+                elapsed = timer() - start_time
+                print(f"hot tier {hot_tier_bytes >> 20} MiB ({len(reader.hot_tier)} documents): "
+                      f"{1000 * elapsed / n_queries:.1f} ms/query over {n_documents * chunks_per_document} embeddings")
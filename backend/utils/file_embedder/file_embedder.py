@@ -1,22 +1,37 @@
 from typing_extensions import Doc
-from colorama import Fore, Style
+import logging
 import os
 from tqdm import tqdm
 from spacy.lang.en import English
-import pymupdf
 import re
+import numpy as np
 import pandas as pd
 from sentence_transformers import SentenceTransformer
 
+from config import settings
+from utils.file_reader.file_reader import save_embeddings_array
+from utils.logger.logger import get_logger
+from utils.metrics.metrics import INGESTED, trace_span
+from utils.page_extractor.page_extractor import extract_pages
+from utils.stub_models.stub_models import StubEmbedder
+
+
+logger = get_logger("file_embedder")
 
 
 class FileImporter:
-    def __init__(self):
+    def __init__(self,
+                 embedding_model: SentenceTransformer | None = None,
+                 upload_directory: str = "uploads",
+                 embeddings_directory: str = "embeddings"):
         """
         Constructor for FileImporter.
         
         Parameters:
-        None
+        embedding_model (SentenceTransformer | None): The model used to embed the chunks. Defaults to
+            settings.embedding_model when None, the server passes the default model of the registry.
+        upload_directory (str): The directory the PDF files are read from. Defaults to "uploads".
+        embeddings_directory (str): The directory the embeddings are saved to. Defaults to "embeddings".
         
         Returns:
         None
@@ -26,33 +41,37 @@ class FileImporter:
         pages_and_texts (list[dict[str, int | float | str | list[str]]]): A list of dictionaries, each containing the page number, character count, word count, sentence count, and text for a page of the PDF
         pages_and_chunks (list[dict[str, str | int | list[str]]]): A list of dictionaries, each containing the page number, sentence chunks, and index for a page of the PDF
         embedding_model (SentenceTransformer): An instance of SentenceTransformer for generating embeddings from text
+        embeddings (np.ndarray): The float32 embedding of each chunk of pages_and_chunks
         """
         self.pdf_path: str = ""
         self.pages_and_texts: list[dict[str, int | float | str | list[str]]] = []
         self.pages_and_chunks : list[dict[str, str | int | list[str]]] = []
-        self.embedding_model = SentenceTransformer(model_name_or_path="all-mpnet-base-v2",
-                                     device="cuda")
+        self.embeddings: np.ndarray = np.zeros((0, 0), dtype=np.float32)
+        self.upload_directory = upload_directory
+        self.embeddings_directory = embeddings_directory
+        if embedding_model is None:
+            embedding_model = StubEmbedder() if settings.stub_models else \
+                    SentenceTransformer(model_name_or_path=settings.embedding_model, device="cuda")
+        self.embedding_model = embedding_model
 
 
     def _print_message(self, message_type: str, message: str):
         """
-        Prints a message to the console with color depending on the message type.
+        Logs a message through the structured logger, at a level depending on the message type.
 
         Parameters:
-        message_type (str): The type of message to print. Can be "INFO", "ERROR", or "SUCCESS".
-        message (str): The message to print.
+        message_type (str): The type of message to log. Can be "INFO", "ERROR", or "SUCCESS".
+        message (str): The message to log.
 
         Returns:
         None
         """
-        if message_type == "INFO":
-            print(f"{Fore.YELLOW}[INFO]{Style.RESET_ALL} {message}")
-        elif message_type == "ERROR":
-            print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} {message}")
+        if message_type == "ERROR":
+            logger.error(message, extra={"fields": {"pdf": self.pdf_path}})
         elif message_type == "SUCCESS":
-            print(f"{Fore.GREEN}[SUCESS]{Style.RESET_ALL} {message}")
+            logger.info(message, extra={"fields": {"pdf": self.pdf_path, "status": "success"}})
         else:
-            print(f"{message}")
+            logger.info(message, extra={"fields": {"pdf": self.pdf_path}})
 
 
     def insert_pdf_file(self):
@@ -69,10 +88,9 @@ class FileImporter:
         if self.pdf_path[-4:] != ".pdf":
             self.pdf_path += ".pdf"
 
-        print(self.pdf_path)
+        logger.debug("Inserting PDF", extra={"fields": {"pdf": self.pdf_path}})
 
-        directory = "uploads/" 
-        pdf_upload_path = os.path.join(directory, self.pdf_path)
+        pdf_upload_path = os.path.join(self.upload_directory, self.pdf_path)
 
         if not os.path.exists(pdf_upload_path):
             self._print_message("ERROR", f"File:[{pdf_upload_path}] can't be found!")
@@ -87,10 +105,12 @@ class FileImporter:
         Opens a PDF file from the uploads directory, reads its content page by page,
         formats the text, and stores detailed information about each page.
 
-        This method utilizes the pymupdf library to read the PDF and processes each
-        page using a text formatter. The formatted text and its metrics, such as character
+        The page ranges are read in parallel by settings.extraction_workers processes, each with its
+        own pymupdf handle. Pages with almost no text are image-only scans, when settings.ocr_enabled
+        is set they are recognised with OCR by a separate pool of settings.ocr_workers processes,
+        otherwise they are logged and skipped. The formatted text and its metrics, such as character
         count, word count, raw sentence count, and token count, are stored in the
-        pages_and_texts attribute.
+        pages_and_texts attribute in page order.
 
         Raises:
         ValueError: If the specified PDF file cannot be opened.
@@ -98,9 +118,17 @@ class FileImporter:
         Logs:
         Prints a success message upon successful processing of the PDF pages.
         """
-        doc = pymupdf.open("uploads/" + self.pdf_path)
-        for page_number, page in tqdm(enumerate(doc), total=len(doc), desc="Processing PDF pages"):
-            text: str = page.get_text()
+        texts, low_text_pages, ocr_pages = extract_pages(os.path.join(self.upload_directory, self.pdf_path),
+                                                         workers=settings.extraction_workers,
+                                                         ocr_enabled=settings.ocr_enabled,
+                                                         ocr_min_chars=settings.ocr_min_chars,
+                                                         ocr_workers=settings.ocr_workers,
+                                                         ocr_language=settings.ocr_language)
+        skipped_pages = set(low_text_pages) - set(ocr_pages)
+
+        for page_number, text in enumerate(texts):
+            if page_number in skipped_pages:
+                continue
             formatted_text: str = self.text_formatter(text=text)
             self.pages_and_texts.append({
                     "page_number": page_number + 1,
@@ -110,7 +138,12 @@ class FileImporter:
                     "page_token_count": len(formatted_text) / 4,
                     "text": formatted_text
             })
-        self._print_message("SUCCESS", f"Imported {len(doc)} pages!")
+
+        if skipped_pages:
+            logger.warning(f"Skipped {len(skipped_pages)} pages without a text layer",
+                           extra={"fields": {"pdf": self.pdf_path, "ocr_enabled": settings.ocr_enabled}})
+        INGESTED.inc(len(ocr_pages), kind="ocr_pages")
+        self._print_message("SUCCESS", f"Imported {len(texts)} pages!")
 
 
     def text_formatter(self, text: str):
@@ -143,7 +176,7 @@ class FileImporter:
         nlp = English()
         _ = nlp.add_pipe("sentencizer")
     
-        for item in tqdm(self.pages_and_texts):
+        for item in tqdm(self.pages_and_texts, disable=not logger.isEnabledFor(logging.DEBUG)):
             item["sentences"] = list(nlp(item['text']).sents)
     
             item['sentences'] = [str(sentence) for sentence in item["sentences"]]
@@ -182,12 +215,12 @@ class FileImporter:
         Logs:
         Prints a success message upon successful processing of the chunks.
         """
-        for item in tqdm(self.pages_and_texts):
+        for item in tqdm(self.pages_and_texts, disable=not logger.isEnabledFor(logging.DEBUG)):
             item["sentence_chunks"] = self._split_list(input_list=item["sentences"],
                                                 slice_size=num_sentence_chunk_size)
 
 
-        for i in tqdm(self.pages_and_texts):
+        for i in tqdm(self.pages_and_texts, disable=not logger.isEnabledFor(logging.DEBUG)):
             for sentence_chunk in i["sentence_chunks"]:
                 chunk_dict = {}
                 chunk_dict["page_number"] = i["page_number"]
@@ -208,9 +241,9 @@ class FileImporter:
         """
         Embeds the chunks of text into vectors using the SentenceTransformer model.
 
-        Embeds all the chunks of text in the pages_and_chunks list into vectors.
-        The vectors are stored in a new key called "embedding" in the pages_and_chunks
-        list.
+        Embeds all the chunks of text in the pages_and_chunks list into vectors, in batches of 32.
+        The vectors are stored as one float32 array in the embeddings attribute, row i belonging to
+        the i-th chunk of the pages_and_chunks list.
 
         Parameters:
         None
@@ -219,10 +252,12 @@ class FileImporter:
         Prints a message upon successful embedding of the chunks.
         """
         self._print_message("INFO", "Embedding the chunks")
-        for item in tqdm(self.pages_and_chunks):
-            item["embedding"] = self.embedding_model.encode(sentences=item["sentence_chunk"],
-                                                            batch_size=32,
-                                                            convert_to_tensor=False)
+        self.embeddings = self.embedding_model.encode([item["sentence_chunk"] for item in self.pages_and_chunks],
+                                                      batch_size=32,
+                                                      convert_to_numpy=True,
+                                                      show_progress_bar=logger.isEnabledFor(logging.DEBUG))
+        self.embeddings = np.asarray(self.embeddings, dtype=np.float32).reshape(
+                len(self.pages_and_chunks), self.embedding_model.get_sentence_embedding_dimension())
         self._print_message("SUCESS", "Chunks embedded!")
 
     def save_pdf(self) -> bool:
@@ -230,9 +265,13 @@ class FileImporter:
         """
         Saves the embedded chunks of text to a CSV file with the same name as the original PDF file.
 
-        The method first creates a DataFrame from the pages_and_chunks list, which contains the chunks of text
-        and their corresponding embeddings. The chunks are then saved in chunks of 100 to a CSV file in the
-        embeddings directory. The method returns a boolean indicating whether the file was saved successfully.
+        The method first creates a DataFrame from the pages_and_chunks list, which contains the chunks of text.
+        The chunks are then saved in chunks of 100 to a temporary file in the embeddings directory, and the
+        embeddings are written to a ".npy" sidecar in settings.embedding_dtype. The embedding column is
+        only written to the CSV in float32 mode, to keep the files readable by older versions.
+        The temporary file is then renamed to the CSV file, so readers never see a partially written
+        CSV file or one without its sidecar.
+        The method returns a boolean indicating whether the file was saved successfully.
 
         Parameters:
         None
@@ -243,28 +282,38 @@ class FileImporter:
         from time import perf_counter as timer
 
         text_chunks_and_embeddings_df = pd.DataFrame(self.pages_and_chunks)
-        directory = 'embeddings/'
-        os.makedirs(directory, exist_ok=True)
-        pdf_save_path = os.path.join(directory, self.pdf_path + ".csv")
+        if settings.embedding_dtype == "float32":
+            text_chunks_and_embeddings_df["embedding"] = list(self.embeddings)
+        os.makedirs(self.embeddings_directory, exist_ok=True)
+        pdf_save_path = os.path.join(self.embeddings_directory, self.pdf_path + ".csv")
 
         chunksize = 100
 
         start_time = timer()
-        with open(pdf_save_path, mode="w", encoding="utf-8", newline="") as file:
+        # Not named *.csv, so an interrupted write is never picked up as a document
+        tmp_path = f"{pdf_save_path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w", encoding="utf-8", newline="") as file:
             # Write header for the first chunk
             text_chunks_and_embeddings_df.iloc[:0].to_csv(file, index=False)
             
             # Process data in chunks
             for chunk in tqdm(
                 range(0, len(text_chunks_and_embeddings_df), chunksize), 
-                desc="Saving chunks"
+                desc="Saving chunks",
+                disable=not logger.isEnabledFor(logging.DEBUG)
             ):
                 text_chunks_and_embeddings_df.iloc[chunk : chunk + chunksize].to_csv(
                     file, index=False, header=False
                 )
+            file.flush()
+            os.fsync(file.fileno())
+
+        # Written after the CSV so the sidecar is never older than it, and in place before the CSV appears
+        save_embeddings_array(pdf_save_path, self.embeddings, settings.embedding_dtype)
+        os.replace(tmp_path, pdf_save_path)
 
         end_time = timer()
-        print(f"Saving took {end_time - start_time:.5f} seconds")
+        logger.debug("Saved chunks", extra={"fields": {"pdf": self.pdf_path, "seconds": round(end_time - start_time, 5)}})
 
         return os.path.exists(pdf_save_path)
 
@@ -272,28 +321,41 @@ class FileImporter:
     def import_and_embed_pdfs(self, pdfs: list[str]|str) -> bool:
 
         """
-        Imports a PDF file and embeds its text chunks.
+        Imports PDF files and embeds their text chunks.
 
         Parameters:
         pdfs (list[str]|str): The path to the PDF file(s) to be imported and embedded.
 
         Returns:
-        bool: Whether the PDF file was successfully imported and embedded.
+        bool: Whether every PDF file was successfully imported and embedded.
         """
         if isinstance(pdfs, str):
              pdfs = [pdfs]
 
+        all_saved = bool(pdfs)
         for i in pdfs:
             self.pdf_path = i
+            self.pages_and_texts = []
+            self.pages_and_chunks = []
 
             self.insert_pdf_file()
-            self.open_and_read_pdf()
-            self.split_text_into_sentences()
-            self.chunks_from_text()
-            self.embed_chunks()
-            return self.save_pdf()
-
-        return False
+            with trace_span("ingest_extract", pdf=i):
+                self.open_and_read_pdf()
+            with trace_span("ingest_sentencize", pdf=i):
+                self.split_text_into_sentences()
+            with trace_span("ingest_chunk", pdf=i):
+                self.chunks_from_text()
+            with trace_span("ingest_embed", pdf=i, chunks=len(self.pages_and_chunks)):
+                self.embed_chunks()
+            with trace_span("ingest_save", pdf=i):
+                saved = self.save_pdf()
+
+            INGESTED.inc(kind="documents")
+            INGESTED.inc(len(self.pages_and_texts), kind="pages")
+            INGESTED.inc(len(self.pages_and_chunks), kind="chunks")
+            all_saved = all_saved and saved
+
+        return all_saved
 
 if __name__ == "__main__":
     pdfs = ["Hands-On Machine Learning With - Aurelien Geron.pdf"
@@ -1,10 +1,14 @@
 from fastapi import UploadFile
 import os
 import shutil
-from ..file_embedder.file_embedder import FileImporter
 import hashlib
 import csv
 
+from utils.logger.logger import get_logger
+
+
+logger = get_logger("file_hash")
+
 
 UPLOAD_DIRECTORY = "uploads"
 
@@ -31,52 +35,131 @@ def calculate_file_hash(file: UploadFile, hash_algorithm: str="sha256") -> str:
     return hash_obj.hexdigest()
 
 
-def check_file_existance(file: UploadFile, CSV_FILE_PATH: str = "file_hashes.csv") -> bool:
-
+def calculate_path_hash(path: str, hash_algorithm: str="sha256") -> str:
     """
-    Checks if a file with the same hash already exists in the CSV file.
-
-    The method first calculates the hash of the uploaded file using the specified hash algorithm.
-    It then checks if an entry with the same hash exists in the CSV file. If such an entry is found,
-    the method returns True, indicating that the file already exists. Otherwise, it returns False
-    and adds the file's hash to the CSV file.
+    Calculates the hash of a file on disk, the same way calculate_file_hash does for an upload.
 
     Parameters:
-    file (UploadFile): The uploaded file to check for existence.
-    CSV_FILE_PATH (str): The path to the CSV file containing the hashes of previously uploaded files.
-        Defaults to "file_hashes.csv".
+    path (str): The path of the file.
+    hash_algorithm (str): The hash algorithm to use. Defaults to 'sha256'.
 
     Returns:
-    bool: True if a file with the same hash already exists, False otherwise.
+        str: The hexadecimal digest of the file hash.
     """
-    file_hash: str = calculate_file_hash(file)
-    entry_exists: bool = False
+    hash_obj = hashlib.new(hash_algorithm)
 
-    if file.filename:
-        file_name: str = file.filename
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(4096), b""):
+            hash_obj.update(chunk)
+    return hash_obj.hexdigest()
 
 
+def _ensure_hash_file(CSV_FILE_PATH: str):
     if not os.path.exists(CSV_FILE_PATH):
         with open(CSV_FILE_PATH, mode="w", newline="", encoding="utf-8") as csv_file:
             writer = csv.writer(csv_file)
             writer.writerow(["filename", "hash"])
 
 
+def check_file_existance(file_hash: str, CSV_FILE_PATH: str = "file_hashes.csv") -> bool:
+
+    """
+    Checks if a file with the same hash already exists in the CSV file.
+
+    Only committed uploads are recorded in the CSV file, see record_file_hash, so a file whose
+    ingest did not finish can be uploaded again.
+
+    Parameters:
+    file_hash (str): The hash of the uploaded file, see calculate_file_hash.
+    CSV_FILE_PATH (str): The path to the CSV file containing the hashes of previously uploaded files.
+        Defaults to "file_hashes.csv".
+
+    Returns:
+    bool: True if a file with the same hash already exists, False otherwise.
+    """
+    _ensure_hash_file(CSV_FILE_PATH)
+
     with open(CSV_FILE_PATH, mode="r", newline="", encoding="utf-8") as csv_file:
         reader = csv.DictReader(csv_file)
         for row in reader:
-            print(row["hash"], file_hash)
             if row["hash"] == file_hash:
-                entry_exists = True
-                return entry_exists
+                return True
+    return False
+
 
-    if not entry_exists:
-        with open(CSV_FILE_PATH, mode='a', newline='') as csv_file:
-            writer = csv.writer(csv_file, quotechar='"', quoting=csv.QUOTE_ALL)
-            writer.writerow([file_name, file_hash])
-        print("Entry added.")
-        return entry_exists
+def committed_file_hash(file_name: str, CSV_FILE_PATH: str = "file_hashes.csv") -> str | None:
+    """
+    Returns the hash recorded for a file name, or None if no file of that name is committed.
 
-    
+    Parameters:
+    file_name (str): The name of the uploaded file.
+    CSV_FILE_PATH (str): The path to the CSV file. Defaults to "file_hashes.csv".
+    """
+    _ensure_hash_file(CSV_FILE_PATH)
+
+    with open(CSV_FILE_PATH, mode="r", newline="", encoding="utf-8") as csv_file:
+        for row in csv.DictReader(csv_file):
+            if row["filename"] == file_name:
+                return row["hash"]
+    return None
+
+
+def record_file_hash(file_name: str, file_hash: str, CSV_FILE_PATH: str = "file_hashes.csv"):
+    """
+    Adds the hash of a file to the CSV file, once its embeddings are committed.
+
+    Parameters:
+    file_name (str): The name of the uploaded file.
+    file_hash (str): The hash of the uploaded file.
+    CSV_FILE_PATH (str): The path to the CSV file. Defaults to "file_hashes.csv".
+    """
+    _ensure_hash_file(CSV_FILE_PATH)
 
+    with open(CSV_FILE_PATH, mode='a', newline='', encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file, quotechar='"', quoting=csv.QUOTE_ALL)
+        writer.writerow([file_name, file_hash])
+        csv_file.flush()
+        os.fsync(csv_file.fileno())
+    logger.debug("Hash entry added", extra={"fields": {"filename": file_name, "hash": file_hash}})
 
+
+def remove_file_hash(file_name: str, CSV_FILE_PATH: str = "file_hashes.csv") -> str | None:
+    """
+    Removes the entries of a file from the CSV file. The CSV file is rewritten to a temporary file
+    that replaces it, so a crash leaves either the old or the new version.
+
+    Parameters:
+    file_name (str): The name of the file.
+    CSV_FILE_PATH (str): The path to the CSV file. Defaults to "file_hashes.csv".
+
+    Returns:
+    str | None: The hash of the removed entry, or None if the file had no entry.
+
+    Raises:
+    ValueError: If the CSV file does not have the required columns.
+    """
+    _ensure_hash_file(CSV_FILE_PATH)
+
+    removed_hash = None
+    filtered_rows = []
+    with open(CSV_FILE_PATH, mode="r", newline='', encoding="utf-8") as csv_file:
+        reader = csv.DictReader(csv_file)
+        fieldnames = reader.fieldnames
+        if not fieldnames or "filename" not in fieldnames:
+            raise ValueError("The CSV file does not have the required 'filename' column.")
+
+        for row in reader:
+            if row["filename"] != file_name:
+                filtered_rows.append(row)
+            else:
+                removed_hash = row["hash"]
+
+    tmp_path = f"{CSV_FILE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="w", newline='', encoding="utf-8") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(filtered_rows)
+        csv_file.flush()
+        os.fsync(csv_file.fileno())
+    os.replace(tmp_path, CSV_FILE_PATH)
+    return removed_hash
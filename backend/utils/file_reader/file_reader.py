@@ -4,76 +4,234 @@ import numpy as np
 import pandas as pd
 import tqdm
 from time import perf_counter as timer
-from colorama import Fore, Style
 import os
 
-from sentence_transformers import util, SentenceTransformer
+from sentence_transformers import SentenceTransformer
 
+from utils.chunk_store.chunk_store import ChunkStore
+from utils.logger.logger import get_logger
+from utils.metrics.metrics import STAGE_SECONDS
+
+
+logger = get_logger("file_reader")
+
+
+# Sidecar file of each storage dtype. bfloat16 has no numpy dtype, its bit patterns are stored as int16
+EMBEDDING_SIDECARS = {"float32": ".npy", "float16": ".f16.npy", "bfloat16": ".bf16.npy"}
+
+
+def embedding_sidecar_path(csv_file_path: str, dtype: str = "float32") -> str:
+    """
+    Returns the path of the ".npy" sidecar holding the embeddings of a CSV file in the given dtype.
+    """
+    if dtype not in EMBEDDING_SIDECARS:
+        raise ValueError(f"Unsupported embedding dtype {dtype}, expected one of {list(EMBEDDING_SIDECARS)}")
+    return csv_file_path + EMBEDDING_SIDECARS[dtype]
+
+
+def to_storage_dtype(embeddings: np.ndarray, dtype: str) -> np.ndarray:
+    """
+    Converts float32 embeddings to the storage dtype, rounding to nearest even.
+
+    Parameters:
+    embeddings (np.ndarray): The float32 embeddings.
+    dtype (str): "float32", "float16" or "bfloat16".
+
+    Returns:
+    np.ndarray: The converted embeddings, bfloat16 is returned as its int16 bit patterns.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if dtype == "float16":
+        return embeddings.astype(np.float16)
+    if dtype == "bfloat16":
+        bits = embeddings.view(np.uint32).astype(np.uint64)
+        return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16).view(np.int16)
+    return embeddings
+
+
+def to_float32(embeddings: np.ndarray, dtype: str) -> np.ndarray:
+    """
+    Converts embeddings from their storage dtype back to float32.
+    """
+    if dtype == "bfloat16":
+        return (np.ascontiguousarray(embeddings).view(np.uint16).astype(np.uint32) << 16).view(np.float32)
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def blocked_scores(embeddings: np.ndarray, query_embedding: np.ndarray, dtype: str = "float32",
+                   block_rows: int = 16384) -> np.ndarray:
+    """
+    Computes the dot product of every embedding with the query in float32.
+
+    Reduced precision embeddings are upcast one block at a time, so only a block sized float32
+    copy exists at any time while the scan reads half the bytes of a float32 matrix.
+
+    Parameters:
+    embeddings (np.ndarray): The (number of chunks, dimension) embeddings in their storage dtype.
+    query_embedding (np.ndarray): The float32 query embedding.
+    dtype (str): The storage dtype of the embeddings. Defaults to "float32".
+    block_rows (int): The number of rows upcast at once. Defaults to 16384.
+
+    Returns:
+    np.ndarray: The float32 score of each embedding.
+    """
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    if dtype == "float32":
+        return embeddings @ query_embedding
+    scores = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), block_rows):
+        scores[start:start + block_rows] = to_float32(embeddings[start:start + block_rows], dtype) @ query_embedding
+    return scores
+
+
+def save_embeddings_array(csv_file_path: str, embeddings: np.ndarray, dtype: str = "float32"):
+    """
+    Atomically writes the sidecar of a CSV file in the given dtype.
+
+    Parameters:
+    csv_file_path (str): The path to the CSV file the embeddings belong to
+    embeddings (np.ndarray): The float32 embeddings
+    dtype (str): The storage dtype. Defaults to "float32".
+    """
+    npy_path = embedding_sidecar_path(csv_file_path, dtype)
+    tmp_path = f"{npy_path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, to_storage_dtype(embeddings, dtype))
+    os.replace(tmp_path, npy_path)
+
+
+def _read_float32_embeddings(csv_file_path: str) -> np.ndarray:
+    """
+    Reads the embeddings of a CSV file as float32 from the best available source: a fresh float32
+    sidecar, the embedding column of a legacy CSV, or else the sidecar of another dtype.
+    """
+    csv_mtime = os.path.getmtime(csv_file_path)
+    npy_path = embedding_sidecar_path(csv_file_path, "float32")
+    if os.path.exists(npy_path) and os.path.getmtime(npy_path) >= csv_mtime:
+        return np.load(npy_path)
+
+    if "embedding" in pd.read_csv(csv_file_path, nrows=0).columns:
+        embedding_df = pd.read_csv(csv_file_path, usecols=["embedding"])
+        embeddings = np.array([np.fromstring(x.strip("[]"), sep=" ") for x in embedding_df["embedding"]],
+                              dtype=np.float32)
+        if embeddings.ndim != 2:
+            embeddings = embeddings.reshape(len(embedding_df), 0)
+        return embeddings
+
+    for dtype in EMBEDDING_SIDECARS:
+        npy_path = embedding_sidecar_path(csv_file_path, dtype)
+        if os.path.exists(npy_path) and os.path.getmtime(npy_path) >= csv_mtime:
+            return to_float32(np.load(npy_path), dtype)
+
+    raise FileNotFoundError(f"No embeddings found for {csv_file_path}")
+
+
+def load_embeddings_array(csv_file_path: str, dtype: str = "float32") -> np.ndarray:
+    """
+    Returns the embeddings of a CSV file as a read-only memory-mapped array in the given storage dtype.
+
+    The embeddings are cached in a sidecar ".npy" file next to the CSV, one per dtype. A missing sidecar
+    is built from the embedding column of legacy CSVs or converted from the sidecar of another dtype.
+    The sidecar is rebuilt whenever it is older than the CSV.
+
+    Parameters:
+    csv_file_path (str): The path to the CSV file containing the embeddings
+    dtype (str): "float32", "float16" or "bfloat16", see to_storage_dtype. Defaults to "float32".
+
+    Returns:
+    np.ndarray: A (number of chunks, embedding dimension) memory-mapped array
+    """
+    npy_path = embedding_sidecar_path(csv_file_path, dtype)
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(csv_file_path):
+        save_embeddings_array(csv_file_path, _read_float32_embeddings(csv_file_path), dtype)
+
+    return np.load(npy_path, mmap_mode="r")
 
 
 class EmbeddingsReader():
-    def __init__(self):
+    def __init__(self, embedding_model: SentenceTransformer | None = None, embedding_dtype: str = "float32"):
         """
         Constructor for EmbeddingsReader.
 
+        Parameters:
+        embedding_model (SentenceTransformer | None): The model used to embed queries. Defaults to
+            all-mpnet-base-v2 when None, benchmarks pass a local stand-in instead.
+        embedding_dtype (str): The dtype the embeddings are stored and held in, "float32", "float16"
+            or "bfloat16". Scores are always accumulated in float32. Defaults to "float32".
+
         Sets the following attributes:
         embeddings (list): An empty list to store the embeddings from the CSV files
         device (str): The device to use for the embeddings model. If a CUDA device is
             available, it will be used, otherwise the CPU will be used.
         embedding_model (SentenceTransformer): An instance of the SentenceTransformer
             model, which is used to generate embeddings from the text.
-        pages_and_chunks (list): An empty list to store the chunks of text from the PDFs
-            and their corresponding embeddings.
+        chunk_store (ChunkStore): The text, page number and document of every chunk, addressed by row ID.
         """
+        self.embedding_dtype = embedding_dtype
         self.embeddings = []
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.embedding_model = SentenceTransformer(model_name_or_path="all-mpnet-base-v2", 
-                                      device=self.device)
-        self.pages_and_chunks = []
+        self.embedding_model = embedding_model or SentenceTransformer(model_name_or_path="all-mpnet-base-v2",
+                                                                      device=self.device)
+        self.chunk_store = ChunkStore()
 
     def _print_message(self, message_type: str, message: str):
-        if message_type == "INFO":
-           print(f"{Fore.YELLOW}[INFO]{Style.RESET_ALL} {message}")
-        elif message_type == "ERROR":
-           print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} {message}")
+        if message_type == "ERROR":
+            logger.error(message)
         elif message_type == "SUCCESS":
-            print(f"{Fore.GREEN}[SUCESS]{Style.RESET_ALL} {message}")
+            logger.info(message, extra={"fields": {"status": "success"}})
         else:
-            print(f"{message}")
+            logger.info(message)
 
     def read_csvs(self, csv_file_pahts: list[str]):
         """
-        Reads a list of CSV files and stores the text chunks and their corresponding embeddings in the pages_and_chunks attribute.
+        Reads a list of CSV files and stores the text chunks in the chunk_store attribute.
 
         The CSV files should have the following columns:
-            - text (str): The text chunk
+            - sentence_chunk (str): The text chunk
+            - page_number (int): The page the chunk starts on
             - embedding (str): The embedding of the text chunk as a string of space-separated floats
 
-        The embeddings are stored as a list of torch tensors in the embeddings attribute.
+        The embeddings are stored as a list of torch tensors in the embeddings attribute, one per file.
+        They are read from the ".npy" sidecar of each CSV in the embedding_dtype, so the embedding column
+        is never parsed into per-row Python objects and the embeddings are only held once.
 
         Parameters:
         csv_file_pahts (list[str]): A list of paths to the CSV files to read
         """
-        self.embeddings = []
-        self.pages_and_chunks = []
+        loaded_embeddings = []
+        documents = []
+        for csv_file_path in csv_file_pahts or []:
+            chunk_df = pd.read_csv(csv_file_path, usecols=["sentence_chunk", "page_number"])
+            pdf_file_name = os.path.basename(csv_file_path).replace(".csv", "")  # Adjust based on your file naming convention
+            documents.append((pdf_file_name, chunk_df["sentence_chunk"], chunk_df["page_number"]))
 
-        text_chunks_and_embedding_df = []
-        if csv_file_pahts:
-            for i, csv_file_path in enumerate(csv_file_pahts):
-                text_chunks_and_embedding_df.append(pd.read_csv(csv_file_path))
-                pdf_file_name = os.path.basename(csv_file_path).replace(".csv", "")  # Adjust based on your file naming convention
-                text_chunks_and_embedding_df[i]["pdf_name"] = pdf_file_name
-                text_chunks_and_embedding_df[i]["embedding"] = \
-                        text_chunks_and_embedding_df[i]["embedding"].apply(lambda x: np.fromstring(x.strip("[]"), sep=" "))
-                self.pages_and_chunks.append(text_chunks_and_embedding_df[i].to_dict(orient="records"))
+            embeddings = torch.from_numpy(np.array(load_embeddings_array(csv_file_path, self.embedding_dtype)))
+            if self.embedding_dtype == "bfloat16":
+                embeddings = embeddings.view(torch.bfloat16)
+            loaded_embeddings.append(embeddings.to(self.device))
 
-                # Convert embeddings to torch tensor and send to device (note: NumPy arrays are float64, torch tensors are float32 by default)
-                self.embeddings.append(torch.tensor(np.array(text_chunks_and_embedding_df[i]["embedding"].tolist()), dtype=torch.float32).to(self.device))
+        # Replaced only once loaded, so a concurrent retrieval keeps scoring the previous documents
+        self.embeddings = loaded_embeddings
+        self.chunk_store = ChunkStore.from_documents(documents)
+
+    def encode_query(self, query: str) -> torch.Tensor:
+        """
+        Embeds a query with the embedding model.
+
+        Parameters:
+        query (str): The query to embed
+
+        Returns:
+        torch.Tensor: The embedding of the query on the reader's device
+        """
+        return self.embedding_model.encode(query, convert_to_tensor=True)
 
     def retrive_relevant_resources(self,
                                   query: str,
                                   n_resources_to_return: int=5,
-                                  print_time: bool=True):
+                                  print_time: bool=True,
+                                  query_embedding: torch.Tensor | None = None,
+                                  timings: dict[str, float] | None = None,
+                                  return_embeddings: bool = False):
         """
         Retrieves the top n relevant resources based on the given query.
 
@@ -81,47 +239,62 @@ class EmbeddingsReader():
         query (str): The query to search for
         n_resources_to_return (int): The number of relevant resources to return. Defaults to 5.
         print_time (bool): If True, prints the time taken to compute the scores. Defaults to True.
+        query_embedding (torch.Tensor | None): The embedding of the query, if it was already computed by the caller.
+        timings (dict[str, float] | None): If given, the time taken by each stage is added to it.
+        return_embeddings (bool): If True, each result also holds its float32 embedding under "embedding",
+            read from the same snapshot of the documents the scores were computed on. Defaults to False.
 
         Returns:
-        A list of dictionaries, each containing the batch index, embedding index, and similarity score of the top n most relevant resources.
+        A list of dictionaries, each containing the row ID, batch index, embedding index, and similarity score of the top n most relevant resources.
         """
-        query_embedding = self.embedding_model.encode(query, convert_to_tensor=True)
-        
+        embed_start_time = timer()
+        if query_embedding is None:
+            query_embedding = self.encode_query(query)
+        embed_end_time = timer()
+
         dot_scores_list = []
-        index_mapping = []
-        current_index = 0
         start_time = timer()
+        # A reload replaces both lists, the snapshot keeps the indices valid until the results are built
+        embeddings, chunk_store = self.embeddings, self.chunk_store
         
-        # Process each batch of embeddings
-        for batch_index, embedding in enumerate(self.embeddings):
-            dot_scores = util.dot_score(query_embedding, embedding)[0]
-            dot_scores_list.append(dot_scores)
-
-            index_mapping.extend([(batch_index, i) for i in range(len(embedding))])
-            current_index += len(embedding)
+        # Process each batch of embeddings, the scores are concatenated in row ID order. Reduced precision
+        # embeddings are upcast block by block so the scores are accumulated in float32
+        query_embedding = query_embedding.to(self.device, torch.float32).reshape(-1)
+        for embedding in embeddings:
+            for block in embedding.split(16384):
+                dot_scores_list.append(block.float() @ query_embedding)
         
-        total_elements = sum(len(inner_list) for inner_list in self.embeddings)
+        total_elements = sum(len(inner_list) for inner_list in embeddings)
         all_scores = torch.empty((0,10))
         if total_elements:
             all_scores = torch.cat(dot_scores_list)
         
-        k = min(n_resources_to_return, len(index_mapping))
+        k = min(n_resources_to_return, total_elements)
         scores, indices = torch.topk(input=all_scores, k=k)
         
         end_time = timer()
         topk_results = []
         
-        for score, index in zip(scores, indices):
-            if index < len(index_mapping):
-                batch_index, local_index = index_mapping[index]
-                topk_results.append({
-                    'batch': batch_index,
-                    'embedding_index': local_index,
-                    'similarity': score.item()
-                })
+        for score, index in zip(scores.tolist(), indices.tolist()):
+            batch_index, local_index = chunk_store.locate(index)
+            topk_results.append({
+                'row_id': index,
+                'batch': batch_index,
+                'embedding_index': local_index,
+                'similarity': score
+            })
+            if return_embeddings:
+                topk_results[-1]['embedding'] = embeddings[batch_index][local_index].float().cpu().numpy()
         
+        if timings is not None:
+            timings.update({
+                    "embed_query": embed_end_time - embed_start_time,
+                    "score": end_time - start_time,
+                    })
+        STAGE_SECONDS.observe(end_time - start_time, stage="retrieval_score")
+
         if print_time:
-            self._print_message("INFO", f"Time taken to get scores on {total_elements} embeddings: {end_time - start_time:.5f} seconds.")
+            logger.debug(f"Time taken to get scores on {total_elements} embeddings: {end_time - start_time:.5f} seconds.")
         
         return topk_results 
 
@@ -138,4 +311,5 @@ if __name__ == "__main__":
     for i in er.embeddings:
         print(i.shape)
     print(er.retrieve_relevant_resources("Ridge Regression"))
-    print(er.pages_and_chunks[0][309]["sentence_chunk"], er.pages_and_chunks[0][309]["page_number"])
+    chunk = er.chunk_store.get(er.chunk_store.row_id(0, 309))
+    print(chunk["sentence_chunk"], chunk["page_number"])
@@ -0,0 +1,210 @@
+import json
+import os
+import re
+import uuid
+from datetime import datetime, timezone
+from threading import Lock
+
+import utils.file_hash.file_hash as fh
+from utils.file_reader.file_reader import EMBEDDING_SIDECARS, embedding_sidecar_path
+from utils.logger.logger import get_logger
+
+
+logger = get_logger("ingest_journal")
+
+# The states of a job, in order. A job is complete once it reaches "committed" or "aborted"
+BEGIN, PDF_WRITTEN, COMMITTED, ABORTED = "begin", "pdf_written", "committed", "aborted"
+
+# The suffixes of the temporary files of atomic writes: ".<pid>.tmp", ".<job_id>.tmp" and ".<pid>.tmp.npy"
+TEMPORARY_FILE_PATTERN = re.compile(r"\.(\d+|[0-9a-f]{32})\.tmp(\.npy)?$")
+
+
+def remove_temporary_files(directory: str, prefix: str = ""):
+    """
+    Removes the temporary files left in a directory by interrupted atomic writes, such as
+    "<name>.csv.<pid>.tmp" and "<name>.csv.npy.<pid>.tmp.npy". Only names ending in one of the
+    suffixes of TEMPORARY_FILE_PATTERN match, so documents like "report.tmp.pdf" are kept.
+
+    Parameters:
+    directory (str): The directory to clean up.
+    prefix (str): Only files starting with it are removed. Defaults to "", every temporary file.
+    """
+    if not os.path.isdir(directory):
+        return
+    for entry in os.scandir(directory):
+        if entry.name.startswith(prefix) and TEMPORARY_FILE_PATTERN.search(entry.name) and entry.is_file():
+            os.remove(entry.path)
+            logger.debug("Removed temporary file", extra={"fields": {"path": entry.path}})
+
+
+def remove_document_files(store_directories: list[str], pdf_name: str):
+    """
+    Removes the CSV file, the sidecars and the temporary files of a document from every store.
+    The CSV file goes first, so readers stop seeing the document before its sidecars disappear.
+
+    Parameters:
+    store_directories (list[str]): The directories of the embedding stores.
+    pdf_name (str): The file name of the PDF.
+    """
+    for store_directory in store_directories:
+        csv_path = os.path.join(store_directory, pdf_name + ".csv")
+        if os.path.isfile(csv_path):
+            os.remove(csv_path)
+        for dtype in EMBEDDING_SIDECARS:
+            if os.path.isfile(embedding_sidecar_path(csv_path, dtype)):
+                os.remove(embedding_sidecar_path(csv_path, dtype))
+        remove_temporary_files(store_directory, pdf_name + ".")
+
+
+def rollback_ingest(pdf_name: str, file_hash: str, upload_directory: str, store_directory: str,
+                    hash_file_path: str = "file_hashes.csv"):
+    """
+    Removes the files an ingest job created. Uploads under the name of a committed document are
+    rejected, so the CSV file and sidecars of the name belong to the job, unless another document
+    of that name was committed since. The PDF is only removed when it holds the content of the job.
+
+    Parameters:
+    pdf_name (str): The file name of the PDF.
+    file_hash (str): The hash of the PDF of the job.
+    upload_directory (str): The directory of the uploaded PDFs.
+    store_directory (str): The embedding store the job wrote to.
+    hash_file_path (str): The path of file_hashes.csv. Defaults to "file_hashes.csv".
+    """
+    committed_hash = fh.committed_file_hash(pdf_name, hash_file_path)
+    if committed_hash is not None and committed_hash != file_hash:
+        remove_temporary_files(upload_directory, pdf_name + ".")
+        return
+
+    remove_document_files([store_directory], pdf_name)
+    pdf_path = os.path.join(upload_directory, pdf_name)
+    if os.path.isfile(pdf_path) and fh.calculate_path_hash(pdf_path) == file_hash:
+        os.remove(pdf_path)
+    remove_temporary_files(upload_directory, pdf_name + ".")
+
+
+def recover_ingest_jobs(journal: "IngestJournal", upload_directory: str, store_directory: str,
+                        hash_file_path: str = "file_hashes.csv") -> tuple[list[dict], list[dict]]:
+    """
+    Settles the ingest jobs a crash left incomplete, called at startup before requests are served.
+
+    - An ingest whose hash and CSV file are in place crashed before its commit record, it is committed.
+    - An ingest whose PDF was fully written is returned, to be resumed.
+    - Any other ingest is rolled back with rollback_ingest and aborted.
+    - Deletions are returned, to be run again.
+
+    Parameters:
+    journal (IngestJournal): The journal of the jobs.
+    upload_directory (str): The directory of the uploaded PDFs.
+    store_directory (str): The embedding store ingests write to.
+    hash_file_path (str): The path of file_hashes.csv. Defaults to "file_hashes.csv".
+
+    Returns:
+    tuple[list[dict], list[dict]]: The ingest jobs to resume and the deletion jobs to finish.
+    """
+    to_resume = []
+    to_delete = []
+    for job in journal.incomplete_jobs():
+        logger.info("Recovering job", extra={"fields": {k: job.get(k) for k in ("job_id", "kind", "pdf", "state")}})
+        if job["kind"] == "delete":
+            to_delete.append(job)
+            continue
+
+        pdf_path = os.path.join(upload_directory, job["pdf"])
+        csv_path = os.path.join(store_directory, job["pdf"] + ".csv")
+        # The PDF is renamed into place before PDF_WRITTEN is recorded, so its content is checked
+        pdf_written = os.path.isfile(pdf_path) and fh.calculate_path_hash(pdf_path) == job["hash"]
+
+        if fh.committed_file_hash(job["pdf"], hash_file_path) == job["hash"] and os.path.isfile(csv_path):
+            journal.mark(job["job_id"], COMMITTED)
+        elif pdf_written:
+            to_resume.append(job)
+        else:
+            rollback_ingest(job["pdf"], job["hash"], upload_directory, store_directory, hash_file_path)
+            journal.mark(job["job_id"], ABORTED, error="Interrupted before the PDF was written" if job["state"] == BEGIN
+                         else "The PDF is missing")
+    return to_resume, to_delete
+
+
+class IngestJournal:
+    def __init__(self, path: str = "ingest_journal.jsonl"):
+        """
+        Constructor for IngestJournal.
+
+        A write-ahead log of the uploads and deletions of documents. Every state change of a job is
+        appended as one JSON line and flushed to disk before the step it announces is carried out, so
+        after a crash the last state of each job tells what was done and what has to be cleaned up
+        or resumed.
+
+        Parameters:
+        path (str): The path of the journal file. Defaults to "ingest_journal.jsonl".
+        """
+        self.path = os.path.abspath(path)
+        self._lock = Lock()
+
+    def _append(self, record: dict):
+        record["time"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        with self._lock:
+            with open(self.path, mode="a", encoding="utf-8") as file:
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def begin(self, pdf_name: str, file_hash: str | None, kind: str = "ingest") -> str:
+        """
+        Records the start of a job.
+
+        Parameters:
+        pdf_name (str): The file name of the PDF.
+        file_hash (str | None): The hash of the PDF. An ingest records it in file_hashes.csv only when it commits.
+        kind (str): "ingest" or "delete". Defaults to "ingest".
+
+        Returns:
+        str: The job ID.
+        """
+        job_id = uuid.uuid4().hex
+        self._append({"job_id": job_id, "kind": kind, "pdf": pdf_name, "hash": file_hash, "state": BEGIN})
+        return job_id
+
+    def mark(self, job_id: str, state: str, **fields):
+        """
+        Records a new state of an ingest job.
+
+        Parameters:
+        job_id (str): The job ID returned by begin().
+        state (str): One of PDF_WRITTEN, COMMITTED or ABORTED.
+        **fields: Extra fields stored with the record, e.g. the error of an aborted job.
+        """
+        self._append({"job_id": job_id, "state": state, **fields})
+
+    def incomplete_jobs(self) -> list[dict]:
+        """
+        Returns the jobs that neither committed nor aborted, with their kind, PDF, hash and last state.
+
+        A truncated last line, left by a crash while appending, is ignored.
+        """
+        jobs: dict[str, dict] = {}
+        if not os.path.exists(self.path):
+            return []
+        with self._lock, open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                job = jobs.setdefault(record["job_id"], {"job_id": record["job_id"]})
+                job.update({key: value for key, value in record.items() if key != "time"})
+        return [job for job in jobs.values() if job["state"] not in (COMMITTED, ABORTED)]
+
+    def compact(self):
+        """
+        Rewrites the journal keeping only the records of the incomplete jobs.
+        """
+        incomplete = self.incomplete_jobs()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with self._lock:
+            with open(tmp_path, mode="w", encoding="utf-8") as file:
+                for job in incomplete:
+                    file.write(json.dumps(job) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
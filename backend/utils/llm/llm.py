@@ -1,23 +1,108 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, BitsAndBytesConfig
-from threading import Thread
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, BitsAndBytesConfig, StoppingCriteria, StoppingCriteriaList, DynamicCache
+from queue import Full, Queue
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter as timer
+import numpy as np
 import torch
 
 
-from utils.base_prompt.base_prompt import COMPLETE_SYSTEM_PROMPT
+from utils.base_prompt.base_prompt import (COMPLETE_SYSTEM_PROMPT, FOLLOW_UP_CONTEXT_PROMPT, FOLLOW_UP_PROMPT,
+                                           NO_INFORMATION_RESPONSE)
+from utils.context_selector.context_selector import select_context
 from utils.file_reader.file_reader import EmbeddingsReader
+from utils.reranker.reranker import Reranker
+from utils.shard_retriever.shard_retriever import ShardedEmbeddingsReader
+from utils.disk_retriever.disk_retriever import DiskEmbeddingsReader
+from utils.answer_cache.answer_cache import SemanticAnswerCache
+from utils.session_store.session_store import Session, SessionStore
+from utils.model_registry.model_registry import model_registry
+from utils.stub_models.stub_models import StubTokenizer, build_stub_causal_lm
+from utils.logger.logger import get_logger
+from utils.metrics.metrics import (CACHE_EVENTS, GENERATED_TOKENS, QUEUE_WAIT, STAGE_SECONDS,
+                                   TIME_TO_FIRST_TOKEN, TOKENS_PER_SECOND, trace_span)
+from config import settings
 
 
 import os
-import glob
+import hashlib
+
+
+logger = get_logger("llm")
+
+
+def format_context_items(context_items: list[dict]) -> str:
+    """
+    Formats the retrieved chunks as the bullet list placed in the prompts.
+    """
+    return "- " + "\n- ".join([f"{item['sentence_chunk']} (PDF: {item['pdf_name']}) Page: {item['page_number']}" for item in context_items])
+
+
+def common_prefix_length(cached_ids: torch.Tensor, input_ids: torch.Tensor) -> int:
+    """
+    Returns the number of leading tokens two 1D token ID tensors have in common.
+    """
+    length = min(len(cached_ids), len(input_ids))
+    mismatches = (cached_ids[:length] != input_ids[:length]).nonzero()
+    return int(mismatches[0]) if len(mismatches) else length
+
+
+class StopOnEvent(StoppingCriteria):
+    def __init__(self, stop_event: Event):
+        """
+        Stopping criterion that ends generation once the event is set, e.g. when the client disconnected.
+
+        Parameters:
+        stop_event (Event): The event checked after every decoding step.
+        """
+        self.stop_event = stop_event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.stop_event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class BoundedTextStreamer(TextIteratorStreamer):
+    def __init__(self, tokenizer, stop_event: Event, max_queued: int = 32, **kwargs):
+        """
+        Constructor for BoundedTextStreamer.
+
+        A TextIteratorStreamer whose queue holds at most max_queued pieces of text. The generation
+        thread blocks on a full queue, so a slow consumer throttles the decoding instead of the
+        text piling up in memory. Once stop_event is set the consumer is gone and the text is dropped.
+
+        Parameters:
+        tokenizer (AutoTokenizer): The tokenizer used to decode the tokens.
+        stop_event (Event): The event set when the consumer stops reading.
+        max_queued (int): The maximum number of text pieces waiting in the queue. Defaults to 32.
+        **kwargs: The arguments of TextIteratorStreamer.
+        """
+        super().__init__(tokenizer, **kwargs)
+        self.text_queue = Queue(maxsize=max_queued)
+        self.stop_event = stop_event
+
+    def _put(self, item, wait: float | None = None):
+        start_time = timer()
+        while wait is None or timer() - start_time < wait:
+            try:
+                self.text_queue.put(item, timeout=0.1)
+                return
+            except Full:
+                if self.stop_event.is_set() and wait is None:
+                    return
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        self._put(text)
+        if stream_end:
+            # A consumer that is still reading needs the stop signal, wait for it a bounded time only
+            self._put(self.stop_signal, wait=self.timeout if self.stop_event.is_set() else None)
 
 
 class Llm:
-    def __init__(self, model_id: str = "google/gemma-2-2b-it"):
+    def __init__(self, model_id: str | None = None):
         """
         Constructor for Llm.
 
         Parameters:
-        model_id (str): The model name or path to use for the LLM. Defaults to "google/gemma-2-2b-it".
+        model_id (str | None): The model name or path to use for the LLM. Defaults to settings.llm_model.
 
         Returns:
         None
@@ -25,37 +110,84 @@ class Llm:
         Sets the following attributes:
         model_id (str): The model name or path to use for the LLM.
         torch_device (str): The device to use for the LLM. If a CUDA device is available, it will be used, otherwise the CPU will be used.
-        base_directory (str): The base directory for the embeddings.
-        csv_paths (list[str]): A list of paths to the CSV files containing the embeddings.
         quantization_config (BitsAndBytesConfig): The configuration for quantizing the model.
         tokenizer (AutoTokenizer): An instance of AutoTokenizer for tokenizing text.
         model (AutoModelForCausalLM): An instance of AutoModelForCausalLM for generating text.
-        fr (EmbeddingsReader): An instance of EmbeddingsReader for retrieving relevant resources.
+        readers (dict[str, EmbeddingsReader]): The retriever of each embedding store of the model registry,
+            created on first use. A DiskEmbeddingsReader is used when settings.disk_retrieval is set, otherwise
+            a ShardedEmbeddingsReader when settings.retrieval_shards is greater than 1.
+        reader_paths (dict[str, list[str]]): The CSV files each reader has loaded.
+        reranker (Reranker | None): The optional second-stage re-ranker, enabled with settings.rerank_enabled.
+        answer_cache (SemanticAnswerCache | None): The optional semantic answer cache, enabled with settings.answer_cache_enabled.
+        draft_model (AutoModelForCausalLM | None): The draft model used when settings.speculative_decoding is "draft".
+        sessions (SessionStore): The KV caches and histories of the ongoing conversations.
+        session_window (int | None): The sliding attention window of the model, which bounds the KV cache of a session.
+        session_max_tokens (int): The prompt length of a conversation after which old turns are dropped,
+            settings.session_max_tokens capped to leave room for the answer within session_window.
         """
-        self.model_id = model_id
+        self.model_id = model_id = model_id or settings.llm_model
         self.torch_device = "cuda" if torch.cuda.is_available() else "cpu"
 
-        self.BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        self.base_directory = os.path.join(self.BASE_DIR, "embeddings")
-        self.csv_paths = glob.glob(os.path.join(self.base_directory, "*.csv"))
-
         self.quantization_config = BitsAndBytesConfig(load_in_4bit=True,
                                             bnb_4bit_compute_dtype=torch.float16)
-        self.tokenizer = AutoTokenizer.from_pretrained(
-                pretrained_model_name_or_path=model_id
-                )
+        if settings.stub_models:
+            self.tokenizer = StubTokenizer()
+            self.model = build_stub_causal_lm(self.tokenizer).to(self.torch_device)
+        else:
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                    pretrained_model_name_or_path=model_id
+                    )
 
-        self.model = AutoModelForCausalLM.from_pretrained(
-                pretrained_model_name_or_path =model_id,
-                torch_dtype=torch.float16,
-                quantization_config=self.quantization_config,
-                low_cpu_mem_usage=True
-                )
-        self.fr = EmbeddingsReader()
-        self.fr.read_csvs(self.csv_paths)
+            self.model = AutoModelForCausalLM.from_pretrained(
+                    pretrained_model_name_or_path =model_id,
+                    torch_dtype=torch.float16,
+                    quantization_config=self.quantization_config,
+                    low_cpu_mem_usage=True
+                    )
+        self.readers: dict[str, EmbeddingsReader] = {}
+        self.reader_paths: dict[str, list[str]] = {}
+        self._readers_lock = Lock()
+        _ = self.reader()
+
+        self.draft_model = None
+        if settings.speculative_decoding == "draft":
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                    pretrained_model_name_or_path=settings.speculative_draft_model,
+                    torch_dtype=torch.float16,
+                    quantization_config=self.quantization_config,
+                    low_cpu_mem_usage=True
+                    )
+            self.draft_model.generation_config.num_assistant_tokens = settings.speculative_num_tokens
+
+        self.reranker: Reranker | None = None
+        if settings.rerank_enabled:
+            self.reranker = Reranker(model_name=settings.rerank_model,
+                                     top_k=settings.rerank_top_k,
+                                     max_candidates=settings.rerank_candidates,
+                                     latency_budget=settings.rerank_latency_budget,
+                                     max_in_flight=settings.rerank_max_in_flight,
+                                     cache_size=settings.rerank_cache_size)
+        self.answer_cache: SemanticAnswerCache | None = None
+        if settings.answer_cache_enabled:
+            self.answer_cache = SemanticAnswerCache(similarity_threshold=settings.answer_cache_similarity,
+                                                    max_entries=settings.answer_cache_max_entries)
+        self.sessions = SessionStore(max_sessions=settings.session_max_sessions,
+                                     ttl=settings.session_ttl,
+                                     max_bytes=settings.session_max_bytes)
 
-        print("Running on device:", self.torch_device)
-        print("CPU threads:", torch.get_num_threads())
+        # Sessions keep their KV cache in a DynamicCache, which does not evict the tokens that leave
+        # a sliding attention window (gemma-2 uses 4096 tokens), so a session must stay within it
+        sliding_window = getattr(self.model.config, "sliding_window", None)
+        use_sliding_window = getattr(self.model.config, "use_sliding_window", True)
+        self.session_window: int | None = sliding_window if isinstance(sliding_window, int) and use_sliding_window else None
+        self.session_max_tokens = settings.session_max_tokens
+        if self.session_window is not None:
+            answer_tokens = min(settings.max_new_tokens, self.session_window // 4)
+            self.session_max_tokens = min(self.session_max_tokens, self.session_window - answer_tokens)
+
+        logger.info("Model loaded", extra={"fields": {"model_id": self.model_id,
+                                                      "device": self.torch_device,
+                                                      "cpu_threads": torch.get_num_threads()}})
 
 
     def prompt_formatter(self, query: str, context_items: list[dict]) -> str:
@@ -70,7 +202,7 @@ class Llm:
         Returns:
         str: The formatted prompt
         """
-        context_items = "- " + "\n- ".join([f"{item['sentence_chunk']} (PDF: {item['pdf_name']}) Page: {item['page_number']}" for item in context_items])
+        context_items = format_context_items(context_items)
     
         
         base_prompt = COMPLETE_SYSTEM_PROMPT.format(context=context_items, query=query)
@@ -87,63 +219,484 @@ class Llm:
         
         return prompt
 
-    def run_generation(self, user_text: str):
+    @property
+    def fr(self) -> EmbeddingsReader:
+        """
+        The retriever of the default embedding store.
+        """
+        return self.reader()
+
+    def reader(self, embedding_model: str | None = None) -> EmbeddingsReader:
+        """
+        Returns the retriever of the store of an embedding model, creating it on first use and
+        reloading its CSV files whenever documents were added to or deleted from the store.
+
+        Parameters:
+        embedding_model (str | None): The embedding model, the default model of the registry when None.
+
+        Returns:
+        EmbeddingsReader: The retriever, with the embedding model of the store as its query encoder.
+        """
+        embedding_model = embedding_model or model_registry.default_embedding_model
+        with self._readers_lock:
+            fr = self.readers.get(embedding_model)
+            if fr is None:
+                embedder = model_registry.get_embedder(embedding_model)
+                if settings.disk_retrieval:
+                    fr = DiskEmbeddingsReader(block_rows=settings.disk_block_rows,
+                                              hot_tier_bytes=settings.disk_hot_tier_bytes,
+                                              promote_after_hits=settings.disk_promote_after_hits,
+                                              prefetch_workers=settings.disk_prefetch_workers,
+                                              embedding_model=embedder,
+                                              embedding_dtype=settings.embedding_dtype)
+                elif settings.retrieval_shards > 1:
+                    fr = ShardedEmbeddingsReader(n_shards=settings.retrieval_shards,
+                                                 embedding_model=embedder,
+                                                 embedding_dtype=settings.embedding_dtype)
+                else:
+                    fr = EmbeddingsReader(embedding_model=embedder, embedding_dtype=settings.embedding_dtype)
+                self.readers[embedding_model] = fr
+
+            new_paths = model_registry.csv_paths(embedding_model)
+            if self.reader_paths.get(embedding_model) != new_paths:
+                with trace_span("load_embeddings", documents=len(new_paths), model=embedding_model):
+                    fr.read_csvs(new_paths)
+                self.reader_paths[embedding_model] = new_paths
+        return fr
+
+    def corpus_version(self, embedding_model: str | None = None) -> str:
+        """
+        Returns a digest of the embedding files currently loaded, which changes whenever a PDF is added, replaced or deleted.
+        A loaded file deleted in the meantime counts as a change.
+
+        Parameters:
+        embedding_model (str | None): The embedding store, the default store when None.
+
+        Returns:
+        str: The corpus version
+        """
+        digest = hashlib.sha1()
+        for path in sorted(self.reader_paths.get(embedding_model or model_registry.default_embedding_model, [])):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Deleted since the reader loaded it, the corpus changed
+                digest.update(f"{path}:missing;".encode("utf-8"))
+                continue
+            digest.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size};".encode("utf-8"))
+        return digest.hexdigest()
+
+    def retrieve_context(self, user_text: str, query_embedding: torch.Tensor | None = None,
+                         fr: EmbeddingsReader | None = None, timings: dict[str, float] | None = None) -> list[dict]:
+        """
+        Retrieves the context items for the given query.
+
+        When the re-ranker is enabled a larger candidate pool is retrieved from the dense index
+        and re-ranked with the cross-encoder, otherwise the dense top 5 are used directly.
+
+        With settings.adaptive_retrieval the number of chunks adapts to the query: candidates below
+        settings.retrieval_min_similarity or past a gap of settings.retrieval_score_gap in the
+        similarities are dropped, and without the re-ranker up to settings.retrieval_max_chunks
+        are picked by MMR. No chunk is returned when none is similar enough to the query.
+
+        Parameters:
+        user_text (str): The user query.
+        query_embedding (torch.Tensor | None): The embedding of the query, if it was already computed.
+        fr (EmbeddingsReader | None): The retriever to search, the one of the default store when None.
+        timings (dict[str, float] | None): If given, the time taken by each stage is added to it.
+
+        Returns:
+        list[dict]: The chunks to place in the prompt, in descending relevance order.
+        """
+        fr = fr or self.fr
+        if timings is None:
+            timings = {}
+        n_resources_to_return = settings.rerank_candidates if self.reranker else 5
+        if settings.adaptive_retrieval:
+            n_resources_to_return = max(n_resources_to_return, settings.retrieval_candidates)
+
+        # The re-ranker chooses the final chunks itself, MMR only runs without it. Its embeddings are
+        # returned with the results, so a concurrent reload of the reader cannot invalidate them
+        use_mmr = settings.adaptive_retrieval and self.reranker is None and settings.retrieval_mmr_lambda < 1
+
+        start_time = timer()
+        top_k_results = fr.retrive_relevant_resources(user_text,
+                                                      n_resources_to_return=n_resources_to_return,
+                                                      query_embedding=query_embedding,
+                                                      timings=timings,
+                                                      return_embeddings=use_mmr)
+        timings["retrieval"] = timer() - start_time
+
+        if settings.adaptive_retrieval:
+            start_time = timer()
+            selected = select_context(np.array([i["similarity"] for i in top_k_results], dtype=np.float32),
+                                      np.stack([i["embedding"] for i in top_k_results]) if use_mmr and top_k_results else None,
+                                      max_items=len(top_k_results) if self.reranker else settings.retrieval_max_chunks,
+                                      min_similarity=settings.retrieval_min_similarity,
+                                      max_score_gap=settings.retrieval_score_gap or None,
+                                      mmr_lambda=settings.retrieval_mmr_lambda)
+            top_k_results = [top_k_results[i] for i in selected]
+            timings["context_select"] = timer() - start_time
+            timings["context_chunks"] = float(len(top_k_results))
+
+        if self.reranker is not None and top_k_results:
+            top_k_results = self.reranker.rerank(query=user_text,
+                                                 candidates=top_k_results,
+                                                 texts=[fr.chunk_store.text(i["row_id"]) for i in top_k_results],
+                                                 timings=timings)
+
+        return fr.chunk_store.get_many(i["row_id"] for i in top_k_results)
+
+    def speculative_kwargs(self) -> dict:
+        """
+        Returns the extra model.generate arguments for the configured speculative decoding mode.
+
+        "prompt_lookup" drafts candidate tokens from n-grams of the prompt, which suits answers that
+        quote the retrieved chunks verbatim. "draft" uses a small draft model sharing the tokenizer.
+        Both verify the candidates with the main model, so the sampled output distribution is unchanged.
+
+        Returns:
+        dict: The arguments to add to model.generate, empty when speculative decoding is off
+        """
+        if settings.speculative_decoding == "prompt_lookup":
+            return {"prompt_lookup_num_tokens": settings.speculative_num_tokens}
+        if settings.speculative_decoding == "draft" and self.draft_model is not None:
+            return {"assistant_model": self.draft_model}
+        return {}
+
+    def _generate(self, generate_kwargs: dict, stats: dict[str, float], outputs: list | None = None):
+        """
+        Runs model.generate and records how many tokens were drafted and accepted.
+
+        A forward pre-hook records the number of tokens fed to the main model on each call made
+        from this thread. The first call holds the prompt plus any candidates, every later call
+        holds the last accepted token plus the new candidates, and each call yields the accepted
+        candidates plus one token sampled by the main model. When a KV cache is passed in, the first
+        call only holds the uncached part of the prompt.
+
+        Parameters:
+        generate_kwargs (dict): The arguments passed to model.generate.
+        stats (dict[str, float]): Filled with the prompt, cached, generated, drafted and accepted token counts.
+        outputs (list | None): When given, the output token IDs are appended to it.
+        """
+        thread_id = get_ident()
+        input_lengths: list[int] = []
+
+        def record_input_length(module, args, kwargs):
+            input_ids = kwargs.get("input_ids")
+            if input_ids is not None and get_ident() == thread_id:
+                input_lengths.append(input_ids.shape[1])
+
+        past_key_values = generate_kwargs.get("past_key_values")
+        cached_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
+
+        handle = self.model.register_forward_pre_hook(record_input_length, with_kwargs=True)
+        try:
+            output = self.model.generate(**generate_kwargs)
+        finally:
+            handle.remove()
+        if outputs is not None:
+            outputs.append(output)
+
+        prompt_tokens = generate_kwargs["input_ids"].shape[1]
+        new_tokens = output.shape[1] - prompt_tokens
+        forward_calls = len(input_lengths)
+        drafted_tokens = max(sum(input_lengths) - (prompt_tokens - cached_tokens) - max(forward_calls - 1, 0), 0)
+        accepted_tokens = min(max(new_tokens - forward_calls, 0), drafted_tokens)
+
+        stats.update({
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": cached_tokens,
+            "new_tokens": new_tokens,
+            "forward_calls": forward_calls,
+            "drafted_tokens": drafted_tokens,
+            "accepted_tokens": accepted_tokens,
+            "acceptance_rate": accepted_tokens / drafted_tokens if drafted_tokens else 0.0,
+            })
+
+    def run_generation(self, user_text: str, received_at: float | None = None, stop_event: Event | None = None,
+                       conversation_id: str | None = None, embedding_model: str | None = None):
     
         """
         Generates a response based on the user input text using a pre-trained causal language model.
     
         This function retrieves the top relevant context items for the given user input,
         formats them into a prompt, and generates a model response. The text generation is
-        performed in a separate thread, and the output is streamed in real-time.
+        performed in a separate thread, and the output is streamed in real-time. When the
+        answer cache holds an answer to a paraphrase of the query built from the same chunks,
+        that answer is returned without running the model. Closing the generator stops the
+        generation thread.
     
         Parameters:
         user_text (str): The input text provided by the user for which a response is generated.
+        received_at (float | None): The perf_counter time the request was received, used to
+            measure the queue wait and the time to first token.
+        stop_event (Event | None): Setting this event stops the generation after the current step.
+        conversation_id (str | None): Continues the conversation with this ID, see generate_events.
+        embedding_model (str | None): The embedding store to retrieve from, see generate_events.
     
         Returns:
         Generator[str, None, None]: A generator yielding chunks of generated text as they are produced.
         """
-        new_paths = glob.glob(os.path.join(self.base_directory, "*.csv"))
-        if self.csv_paths != new_paths: 
-            self.csv_paths = new_paths
-            self.fr.read_csvs(self.csv_paths)
-    
-    
-        
-        top_k_results = self.fr.retrive_relevant_resources(user_text)
-        context_items = [self.fr.pages_and_chunks[i["batch"]][i["embedding_index"]] for i in top_k_results]
-    
-        prompt = self.prompt_formatter(query=user_text, context_items=context_items)
-        print(prompt)
+        events = self.generate_events(user_text, received_at=received_at, stop_event=stop_event,
+                                      conversation_id=conversation_id, embedding_model=embedding_model)
+        try:
+            for event, payload in events:
+                if event == "token":
+                    yield payload
+        finally:
+            events.close()
+
+    def generate_events(self, user_text: str, received_at: float | None = None, stop_event: Event | None = None,
+                        conversation_id: str | None = None, embedding_model: str | None = None,
+                        session: Session | None = None):
+        """
+        Runs retrieval and generation for the query, yielding typed events.
+
+        The events are, in order:
+            - ("sources", list[dict]): the retrieved chunks, before any token is generated
+            - ("token", str): a piece of generated text, repeated
+            - ("done", dict): the generation statistics, with the time taken by each stage under "timings"
+
+        With a conversation_id the turn is appended to the session of that conversation. The KV cache
+        of the previous turns is reused, so only the tokens of the new turn are prefilled, and chunks
+        that are already part of the conversation are not repeated in the prompt.
+
+        Parameters:
+        user_text (str): The input text provided by the user for which a response is generated.
+        received_at (float | None): The perf_counter time the request was received.
+        stop_event (Event | None): Setting this event stops the generation after the current step.
+            The event is also set when the generator is closed early.
+        conversation_id (str | None): The conversation the turn belongs to, None for a stateless query.
+        embedding_model (str | None): The embedding store of the model registry to retrieve from, which
+            trades retrieval quality for latency. The default store when None.
+        session (Session | None): A session the caller already acquired from sessions, used instead of
+            conversation_id. It is released once the generator, after being started, finishes or is closed.
+
+        Returns:
+        Generator[tuple[str, Any], None, None]: A generator yielding (event, payload) tuples.
+
+        Raises:
+        TimeoutError: If the previous turn of the conversation is still running.
+        """
+        if session is None and conversation_id is None:
+            yield from self._run_turn(user_text, received_at, stop_event, None, embedding_model)
+            return
+
+        session = session or self.sessions.acquire(conversation_id)
+        try:
+            yield from self._run_turn(user_text, received_at, stop_event, session, embedding_model)
+        finally:
+            self.sessions.release(session)
+
+    def _build_turn(self, user_text: str, context_items: list[dict], session: Session | None) -> tuple[list[dict[str, str]], str]:
+        """
+        Builds the chat messages of a turn and renders them with the chat template.
+
+        The first turn of a conversation carries the full system prompt with the retrieved context.
+        Follow-up turns only add the query and the retrieved chunks that are not yet in the conversation.
+        When the conversation grows beyond session_max_tokens the oldest follow-up turns are
+        dropped, the first turn with the context is always kept.
+
+        Returns:
+        tuple[list[dict[str, str]], str]: The messages, the last one being the new user message, and the prompt.
+        """
+        if session is None or not session.messages:
+            content = COMPLETE_SYSTEM_PROMPT.format(context=format_context_items(context_items), query=user_text)
+            messages = [{"role": "user", "content": content}]
+        else:
+            known = {(item["pdf_name"], item["page_number"], item["sentence_chunk"]) for item in session.context_items}
+            new_items = [item for item in context_items
+                         if (item["pdf_name"], item["page_number"], item["sentence_chunk"]) not in known]
+            if new_items:
+                content = FOLLOW_UP_CONTEXT_PROMPT.format(context=format_context_items(new_items), query=user_text)
+            else:
+                content = FOLLOW_UP_PROMPT.format(query=user_text)
+            messages = session.messages + [{"role": "user", "content": content}]
+
+        while True:
+            prompt = self.tokenizer.apply_chat_template(conversation=messages,
+                                                        tokenize=False,
+                                                        add_generation_prompt=True)
+            if len(messages) <= 3 or len(self.tokenizer(prompt)["input_ids"]) <= self.session_max_tokens:
+                return messages, prompt
+            messages = messages[:2] + messages[4:]
+
+    def _run_turn(self, user_text: str, received_at: float | None, stop_event: Event | None, session: Session | None,
+                  embedding_model: str | None):
+        """
+        Runs one turn of generate_events, with session locked by the caller when given.
+        """
+        stop_event = stop_event or Event()
+        request_start_time = timer()
+        if received_at is not None:
+            QUEUE_WAIT.observe(request_start_time - received_at)
+        else:
+            received_at = request_start_time
+
+        embedding_model = embedding_model or model_registry.default_embedding_model
+        fr = self.reader(embedding_model)
+
+        embed_start_time = timer()
+        query_embedding = fr.encode_query(user_text)
+        embed_time = timer() - embed_start_time
+
+        # Kept per request, the Llm instance is shared by concurrent requests
+        timings: dict[str, float] = {}
+        context_items = self.retrieve_context(user_text, query_embedding=query_embedding, fr=fr, timings=timings)
+        timings["embed_query"] = embed_time
+        yield "sources", context_items
+
+        follow_up = session is not None and bool(session.messages)
+        if settings.adaptive_retrieval and not context_items and not follow_up:
+            # Nothing in the corpus is relevant to the query, answer without running the model. Follow-up
+            # turns still run it as the conversation may hold the answer, and the session is left
+            # empty so the next turn is a first turn again
+            TIME_TO_FIRST_TOKEN.observe(timer() - received_at)
+            logger.info("No relevant context, generation skipped", extra={"fields": {"embedding_model": embedding_model}})
+            yield "token", NO_INFORMATION_RESPONSE.format(query=user_text)
+            no_context_stats = {"no_context": True, "cancelled": False, "embedding_model": embedding_model}
+            if session is not None:
+                no_context_stats["conversation_id"] = session.conversation_id
+            yield "done", no_context_stats
+            return
+
+        # Answers to follow-up turns depend on the conversation, only first turns use the answer cache.
+        # The cached query embeddings come from the default embedding model
+        chunk_key = None
+        if self.answer_cache is not None and not follow_up and embedding_model == model_registry.default_embedding_model:
+            self.answer_cache.set_corpus_version(self.corpus_version(embedding_model))
+            chunk_key = SemanticAnswerCache.chunk_key(context_items)
+            cached_answer = self.answer_cache.lookup(query_embedding, chunk_key)
+            timings["answer_cache_hit"] = float(cached_answer is not None)
+            CACHE_EVENTS.inc(cache="answer", result="hit" if cached_answer is not None else "miss")
+            if cached_answer is not None:
+                TIME_TO_FIRST_TOKEN.observe(timer() - received_at)
+                if session is not None:
+                    content = COMPLETE_SYSTEM_PROMPT.format(context=format_context_items(context_items), query=user_text)
+                    session.messages = [{"role": "user", "content": content},
+                                        {"role": "assistant", "content": cached_answer}]
+                    session.context_items = list(context_items)
+                yield "token", cached_answer
+                yield "done", {"answer_cache_hit": True}
+                return
+
+        start_time = timer()
+        messages, prompt = self._build_turn(user_text, context_items, session)
+        timings["prompt_build"] = timer() - start_time
+
+        for stage in ("embed_query", "retrieval", "context_select", "rerank", "prompt_build"):
+            if stage in timings:
+                STAGE_SECONDS.observe(timings[stage], stage=stage)
+        logger.debug("Prompt built", extra={"fields": {"prompt": prompt, "timings": timings}})
 
 
         model_inputs = self.tokenizer(prompt, return_tensors="pt").to(self.torch_device)
-        streamer = TextIteratorStreamer(
-                tokenizer=self.tokenizer, 
-                timeout=10.0, 
+        streamer = BoundedTextStreamer(
+                tokenizer=self.tokenizer,
+                stop_event=stop_event,
+                max_queued=settings.stream_queue_size,
+                timeout=10.0,
                 skip_prompt=True,
                 skip_special_tokens=True
                 )
+
+        session_kwargs = {}
+        max_new_tokens = settings.max_new_tokens
+        if session is not None and self.session_window is not None \
+                and len(model_inputs["input_ids"][0]) >= self.session_window:
+            # The first turn of the conversation alone fills the window, the turn runs without a KV cache
+            session.past_key_values = None
+            session.token_ids = None
+        elif session is not None:
+            input_ids = model_inputs["input_ids"][0]
+            if self.session_window is not None:
+                max_new_tokens = min(max_new_tokens, self.session_window - len(input_ids))
+            reused_tokens = 0
+            if session.past_key_values is not None and session.token_ids is not None:
+                # At least one token has to be prefilled to get the logits of the next token
+                reused_tokens = min(common_prefix_length(session.token_ids.to(input_ids.device), input_ids),
+                                    len(input_ids) - 1)
+            if reused_tokens:
+                session.past_key_values.crop(reused_tokens)
+            else:
+                session.past_key_values = DynamicCache()
+            session_kwargs["past_key_values"] = session.past_key_values
     
         generate_kwargs = dict(
             **model_inputs,
             streamer=streamer,
-            max_new_tokens=4096,
+            max_new_tokens=max_new_tokens,
             do_sample=True,
             top_p=0.9,
             temperature=float(0.2),
             top_k=10,
-            repetition_penalty=1.25
+            repetition_penalty=1.25,
+            stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_event)]),
+            **session_kwargs,
+            **self.speculative_kwargs()
         )
-    
-        t = Thread(target=self.model.generate, kwargs=generate_kwargs)
+
+        generation_stats: dict[str, float] = {}
+        outputs: list[torch.Tensor] = []
+        generation_start_time = timer()
+        first_token_time = None
+        t = Thread(target=self._generate, args=(generate_kwargs, generation_stats, outputs))
         t.start()
     
         # Pull the generated text from the streamer, and update the model output.
         model_output = ""
-        for new_text in streamer:
-            model_output += new_text
-            yield new_text
-        return model_output
+        try:
+            for new_text in streamer:
+                if first_token_time is None:
+                    first_token_time = timer()
+                    TIME_TO_FIRST_TOKEN.observe(first_token_time - received_at)
+                model_output += new_text
+                yield "token", new_text
+        finally:
+            # Also reached when the consumer goes away, generation then stops after the current step
+            cancelled = stop_event.is_set()
+            stop_event.set()
+            if session is not None:
+                # The session is released once this generator is closed, its KV cache must not change afterwards
+                t.join()
+
+        t.join()
+        generation_end_time = timer()
+        if first_token_time is not None:
+            timings["prefill"] = first_token_time - generation_start_time
+            timings["decode"] = generation_end_time - first_token_time
+            STAGE_SECONDS.observe(timings["prefill"], stage="prefill")
+            STAGE_SECONDS.observe(timings["decode"], stage="decode")
+        decode_time = generation_end_time - (first_token_time or generation_start_time)
+        generation_stats["tokens_per_second"] = generation_stats.get("new_tokens", 0) / decode_time if decode_time else 0.0
+
+        GENERATED_TOKENS.inc(generation_stats.get("new_tokens", 0))
+        TOKENS_PER_SECOND.observe(generation_stats["tokens_per_second"])
+        logger.info("Generation finished", extra={"fields": generation_stats})
+
+        if session is not None:
+            if outputs and session.past_key_values is not None:
+                # The cache covers every token but the last sampled one, which was never fed to the model
+                session.token_ids = outputs[0][0, :session.past_key_values.get_seq_length()].detach()
+            else:
+                session.past_key_values = None
+                session.token_ids = None
+            if not cancelled:
+                known = {(item["pdf_name"], item["page_number"], item["sentence_chunk"]) for item in session.context_items}
+                session.context_items.extend(item for item in context_items
+                                             if (item["pdf_name"], item["page_number"], item["sentence_chunk"]) not in known)
+                session.messages = messages + [{"role": "assistant", "content": model_output}]
+
+        if self.answer_cache is not None and chunk_key is not None and not cancelled:
+            self.answer_cache.store(query_embedding, chunk_key, model_output)
+
+        generation_stats["cancelled"] = cancelled
+        generation_stats["embedding_model"] = embedding_model
+        generation_stats["timings"] = timings
+        if session is not None:
+            generation_stats["conversation_id"] = session.conversation_id
+        yield "done", generation_stats
 
 
 if __name__ == "__main__":
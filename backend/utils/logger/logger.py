@@ -0,0 +1,52 @@
+import json
+import logging
+import sys
+from contextvars import ContextVar
+
+from config import settings
+
+
+# Set by the tracing middleware, read here so every record of a request carries its trace ID
+current_trace_id: ContextVar[str | None] = ContextVar("current_trace_id", default=None)
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        Formats a record as one JSON object per line.
+
+        Fields passed with extra={"fields": {...}} are merged into the object.
+        """
+        entry = {
+                "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage(),
+                }
+        trace_id = current_trace_id.get()
+        if trace_id:
+            entry["trace_id"] = trace_id
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Returns a logger writing structured JSON lines to stderr, at the level set by settings.logging_level.
+
+    Parameters:
+    name (str): The logger name, prefixed with "rag.".
+
+    Returns:
+    logging.Logger: The configured logger.
+    """
+    root = logging.getLogger("rag")
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(StructuredFormatter())
+        root.addHandler(handler)
+        root.setLevel(settings.logging_level.upper())
+        root.propagate = False
+    return root.getChild(name)
@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter as timer
+import random
+import uuid
+
+from utils.logger.logger import current_trace_id, get_logger
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+trace_sampled_var: ContextVar[bool] = ContextVar("trace_sampled", default=False)
+
+logger = get_logger("metrics")
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        """
+        A monotonically increasing counter, optionally split by labels.
+
+        Parameters:
+        name (str): The metric name.
+        documentation (str): The HELP text of the metric.
+        label_names (tuple[str, ...]): The names of the labels. Defaults to no labels.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values: dict[tuple[str, ...], float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        """
+        A histogram of observed values with cumulative buckets, optionally split by labels.
+
+        Parameters:
+        name (str): The metric name.
+        documentation (str): The HELP text of the metric.
+        label_names (tuple[str, ...]): The names of the labels. Defaults to no labels.
+        buckets (tuple[float, ...]): The upper bounds of the buckets. Defaults to LATENCY_BUCKETS.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values: dict[tuple[str, ...], dict] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            series = self.values.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    bucket_labels = _format_labels(self.label_names, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+                bucket_labels = _format_labels(self.label_names, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        Holds every metric of the process and renders them in the Prometheus text exposition format.
+        """
+        self.metrics: list[Counter | Histogram] = []
+
+    def counter(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, label_names: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUESTS = registry.counter("rag_http_requests_total", "HTTP requests by route and status",
+                                 ("method", "route", "status"))
+HTTP_LATENCY = registry.histogram("rag_http_request_seconds", "Time until the response headers are sent",
+                                  ("method", "route"))
+STAGE_SECONDS = registry.histogram("rag_stage_seconds", "Time spent in each pipeline stage", ("stage",))
+QUEUE_WAIT = registry.histogram("rag_queue_wait_seconds",
+                                "Time between receiving a generation request and starting retrieval")
+TIME_TO_FIRST_TOKEN = registry.histogram("rag_time_to_first_token_seconds",
+                                         "Time between receiving a generation request and streaming the first token")
+TOKENS_PER_SECOND = registry.histogram("rag_decode_tokens_per_second", "Decode throughput of each generation",
+                                       buckets=RATE_BUCKETS)
+GENERATED_TOKENS = registry.counter("rag_generated_tokens_total", "Tokens generated by the language model")
+CACHE_EVENTS = registry.counter("rag_cache_events_total", "Cache lookups by cache and result", ("cache", "result"))
+INGESTED = registry.counter("rag_ingested_total", "Ingested documents, pages and chunks", ("kind",))
+
+
+def start_trace(trace_id: str | None = None, sample_rate: float = 0.0) -> str:
+    """
+    Starts a trace for the current request context.
+
+    Parameters:
+    trace_id (str | None): The trace ID sent by the client, a new one is generated when None.
+    sample_rate (float): The fraction of traces whose spans are logged. Defaults to 0.
+
+    Returns:
+    str: The trace ID.
+    """
+    trace_id = trace_id or uuid.uuid4().hex
+    current_trace_id.set(trace_id)
+    trace_sampled_var.set(random.random() < sample_rate)
+    return trace_id
+
+
+@contextmanager
+def trace_span(stage: str, **attributes):
+    """
+    Times a block, records it in the rag_stage_seconds histogram and logs it as a span
+    when the current trace is sampled.
+
+    Parameters:
+    stage (str): The stage name, used as the histogram label.
+    **attributes: Extra fields added to the span log record.
+    """
+    start_time = timer()
+    try:
+        yield
+    finally:
+        elapsed = timer() - start_time
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if trace_sampled_var.get():
+            logger.info("span", extra={"fields": {"stage": stage, "seconds": round(elapsed, 6), **attributes}})
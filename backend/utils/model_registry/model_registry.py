@@ -0,0 +1,335 @@
+import glob
+import json
+import os
+import re
+import uuid
+from datetime import datetime, timezone
+from threading import Lock, Thread, Timer
+
+import pandas as pd
+import torch
+from sentence_transformers import SentenceTransformer
+
+from config import settings
+from utils.file_reader.file_reader import EMBEDDING_SIDECARS, embedding_sidecar_path, save_embeddings_array
+from utils.logger.logger import get_logger
+from utils.stub_models.stub_models import StubEmbedder
+
+
+logger = get_logger("model_registry")
+
+EMBEDDINGS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                    "embeddings")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _slug(model_name: str) -> str:
+    """
+    Returns a directory name for a model name such as "sentence-transformers/all-MiniLM-L6-v2".
+    """
+    return re.sub(r"[^A-Za-z0-9._-]", "_", model_name.replace("/", "__"))
+
+
+class ModelRegistry:
+    def __init__(self, embeddings_directory: str = EMBEDDINGS_DIRECTORY, default_embedding_model: str = "all-mpnet-base-v2",
+                 sync_retry_delay: float = 60.0):
+        """
+        Constructor for ModelRegistry.
+
+        Keeps track of the embedding stores, one directory of CSV files and sidecars per embedding
+        model, and of the jobs re-embedding the corpus with another model. The stores are described
+        in a "registry.json" file in the embeddings directory. The store of default_embedding_model
+        is the embeddings directory itself, so existing corpora are picked up as they are, the
+        other stores are sub directories named after their model.
+
+        Parameters:
+        embeddings_directory (str): The directory holding the embedding stores.
+        default_embedding_model (str): The embedding model of a corpus without a registry file.
+            Defaults to "all-mpnet-base-v2".
+        sync_retry_delay (float): The seconds before a failed sync is retried, doubled on every
+            further failure up to an hour. Defaults to 60.
+
+        Sets the following attributes:
+        stores (dict[str, dict]): The directory, dimension and status of the store of each model.
+        default_embedding_model (str): The model new documents are embedded with and queries use by default.
+        jobs (dict[str, dict]): The migration jobs started since the process started.
+        """
+        self.embeddings_directory = os.path.abspath(embeddings_directory)
+        self.registry_path = os.path.join(self.embeddings_directory, "registry.json")
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        self.stores: dict[str, dict] = {}
+        self.default_embedding_model = default_embedding_model
+        self.jobs: dict[str, dict] = {}
+        self.sync_retry_delay = sync_retry_delay
+
+        self._embedders: dict[str, SentenceTransformer] = {}
+        self._lock = Lock()
+        self._load()
+
+    def _load(self):
+        os.makedirs(self.embeddings_directory, exist_ok=True)
+        if os.path.exists(self.registry_path):
+            with open(self.registry_path, encoding="utf-8") as file:
+                registry = json.load(file)
+            self.default_embedding_model = registry["default"]
+            self.stores = registry["stores"]
+            for store in self.stores.values():
+                # A migration interrupted by a restart left a partial store, it can be resumed
+                if store["status"] == "migrating":
+                    store["status"] = "incomplete"
+        else:
+            self.stores = {self.default_embedding_model: {"directory": ".", "dimension": None, "status": "ready"}}
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.registry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"default": self.default_embedding_model, "stores": self.stores}, file, indent=2)
+        os.replace(tmp_path, self.registry_path)
+
+    def store_directory(self, model_name: str | None = None) -> str:
+        """
+        Returns the directory of the store of a model, the default model when None.
+        """
+        model_name = model_name or self.default_embedding_model
+        store = self.stores.get(model_name)
+        directory = store["directory"] if store else _slug(model_name)
+        return os.path.normpath(os.path.join(self.embeddings_directory, directory))
+
+    def store_directories(self) -> list[str]:
+        """
+        Returns the directories of every registered store.
+        """
+        return [self.store_directory(model_name) for model_name in self.stores]
+
+    def csv_paths(self, model_name: str | None = None) -> list[str]:
+        """
+        Returns the CSV files of the store of a model, the default model when None.
+        """
+        return glob.glob(os.path.join(self.store_directory(model_name), "*.csv"))
+
+    def is_ready(self, model_name: str) -> bool:
+        """
+        Returns whether the store of a model is complete and can serve queries.
+        """
+        return self.stores.get(model_name, {}).get("status") == "ready"
+
+    def get_embedder(self, model_name: str | None = None) -> SentenceTransformer:
+        """
+        Returns the embedding model, loading it on first use. Every model is a StubEmbedder when
+        settings.stub_models is set.
+
+        Parameters:
+        model_name (str | None): The SentenceTransformer model name, the default model when None.
+
+        Returns:
+        SentenceTransformer: The shared instance of the model.
+        """
+        model_name = model_name or self.default_embedding_model
+        with self._lock:
+            if model_name not in self._embedders:
+                logger.info("Loading embedding model", extra={"fields": {"model": model_name, "device": self.device}})
+                self._embedders[model_name] = StubEmbedder() if settings.stub_models else \
+                        SentenceTransformer(model_name_or_path=model_name, device=self.device)
+            return self._embedders[model_name]
+
+    def describe(self) -> list[dict]:
+        """
+        Returns the name, status, dimension and document count of every store.
+        """
+        return [{
+            "model": model_name,
+            "default": model_name == self.default_embedding_model,
+            "status": store["status"],
+            "dimension": store["dimension"],
+            "documents": len(self.csv_paths(model_name)),
+            } for model_name, store in self.stores.items()]
+
+    def set_default(self, model_name: str):
+        """
+        Makes a model the default embedding model. New documents are embedded with it and
+        queries without a model use it.
+
+        Raises:
+        ValueError: If the store of the model is not ready.
+        """
+        if not self.is_ready(model_name):
+            raise ValueError(f"The store of {model_name} is not ready")
+        with self._lock:
+            self.default_embedding_model = model_name
+            self._save()
+        logger.info("Default embedding model changed", extra={"fields": {"model": model_name}})
+
+    def _running_job(self, model_name: str) -> dict | None:
+        for job in self.jobs.values():
+            if job["model"] == model_name and job["status"] in ("pending", "running"):
+                return job
+        return None
+
+    def start_migration(self, model_name: str, make_default: bool = False, attempt: int = 1) -> dict:
+        """
+        Starts a background job embedding the corpus of the default store with another model.
+
+        The job is incremental: documents whose CSV in the target store is newer than the source are
+        skipped and documents deleted from the source are removed, so it also brings a store up to
+        date after uploads. The default store keeps serving queries while the job runs. A job on a
+        ready store is a "sync": the store stays ready and keeps serving queries while it is updated,
+        and a failed sync is retried. Any other job is a "migration" and the store is "migrating"
+        until it succeeds.
+
+        Parameters:
+        model_name (str): The SentenceTransformer model to embed with.
+        make_default (bool): Whether the model becomes the default once the job succeeds. Defaults to False.
+        attempt (int): The number of the attempt, counted by the retries of failed syncs. Defaults to 1.
+
+        Returns:
+        dict: The job, see job_status.
+
+        Raises:
+        ValueError: If the model is the default model or a job for it is already running.
+        """
+        with self._lock:
+            if model_name == self.default_embedding_model:
+                raise ValueError(f"{model_name} is already the default embedding model")
+            if self._running_job(model_name) is not None:
+                raise ValueError(f"A migration to {model_name} is already running")
+
+            sync = self.is_ready(model_name)
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "kind": "sync" if sync else "migration",
+                "attempt": attempt,
+                "resync": False,
+                "model": model_name,
+                "source_model": self.default_embedding_model,
+                "make_default": make_default,
+                "status": "pending",
+                "documents_total": 0,
+                "documents_done": 0,
+                "chunks_embedded": 0,
+                "error": None,
+                "started_at": _now(),
+                "finished_at": None,
+                }
+            self.jobs[job["job_id"]] = job
+            if not sync:
+                store = self.stores.setdefault(model_name, {"directory": _slug(model_name), "dimension": None,
+                                                            "status": "migrating"})
+                store["status"] = "migrating"
+                self._save()
+
+        Thread(target=self._migrate, args=(job,), daemon=True).start()
+        return dict(job)
+
+    def sync_stores(self):
+        """
+        Starts a sync of every other ready store, called after the default store changed. A store
+        whose sync is already running is synced again once it finishes, so no change is missed.
+        """
+        for model_name in list(self.stores):
+            if model_name != self.default_embedding_model and self.is_ready(model_name):
+                with self._lock:
+                    running_job = self._running_job(model_name)
+                    if running_job is not None:
+                        running_job["resync"] = True
+                        continue
+                try:
+                    self.start_migration(model_name)
+                except ValueError:
+                    pass
+
+    def _restart_sync(self, model_name: str, attempt: int):
+        if model_name == self.default_embedding_model or not self.is_ready(model_name):
+            return
+        try:
+            self.start_migration(model_name, attempt=attempt)
+        except ValueError:
+            pass
+
+    def job_status(self, job_id: str) -> dict | None:
+        """
+        Returns a copy of a migration job, or None if it does not exist.
+
+        The job holds its model, kind ("migration" or "sync"), attempt, status ("pending", "running",
+        "succeeded" or "failed"), progress counters, error message and start and finish times.
+        """
+        job = self.jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def _migrate(self, job: dict):
+        model_name = job["model"]
+        source_directory = self.store_directory(job["source_model"])
+        target_directory = self.store_directory(model_name)
+        job["status"] = "running"
+        status = "failed"
+
+        try:
+            os.makedirs(target_directory, exist_ok=True)
+            embedder = self.get_embedder(model_name)
+            source_paths = sorted(glob.glob(os.path.join(source_directory, "*.csv")))
+            job["documents_total"] = len(source_paths)
+
+            for source_path in source_paths:
+                target_path = os.path.join(target_directory, os.path.basename(source_path))
+                if not os.path.exists(target_path) or os.path.getmtime(target_path) < os.path.getmtime(source_path):
+                    chunk_df = pd.read_csv(source_path, usecols=lambda column: column != "embedding")
+                    embeddings = embedder.encode(chunk_df["sentence_chunk"].astype(str).tolist(),
+                                                 batch_size=32,
+                                                 convert_to_numpy=True,
+                                                 show_progress_bar=False)
+                    tmp_path = f"{target_path}.{os.getpid()}.tmp"
+                    chunk_df.to_csv(tmp_path, index=False)
+                    # Written after the CSV so the sidecar is never older than it, and in place before the CSV appears
+                    save_embeddings_array(target_path, embeddings, settings.embedding_dtype)
+                    os.replace(tmp_path, target_path)
+                    job["chunks_embedded"] += len(chunk_df)
+                job["documents_done"] += 1
+
+            source_names = {os.path.basename(path) for path in source_paths}
+            for target_path in glob.glob(os.path.join(target_directory, "*.csv")):
+                if os.path.basename(target_path) not in source_names:
+                    os.remove(target_path)
+                    for dtype in EMBEDDING_SIDECARS:
+                        if os.path.isfile(embedding_sidecar_path(target_path, dtype)):
+                            os.remove(embedding_sidecar_path(target_path, dtype))
+
+            with self._lock:
+                self.stores[model_name]["status"] = "ready"
+                self.stores[model_name]["dimension"] = embedder.get_sentence_embedding_dimension()
+                self._save()
+            if job["make_default"]:
+                self.set_default(model_name)
+            status = "succeeded"
+
+        except Exception as exception:
+            logger.exception("Migration failed", extra={"fields": {"job_id": job["job_id"], "model": model_name}})
+            job["error"] = str(exception)
+            # A failed sync leaves the store ready with the documents synced so far, it is retried below
+            if job["kind"] == "migration":
+                with self._lock:
+                    self.stores[model_name]["status"] = "failed"
+                    self._save()
+
+        finally:
+            with self._lock:
+                job["status"] = status
+                job["finished_at"] = _now()
+                resync = job["resync"]
+            logger.info("Migration finished", extra={"fields": {k: job[k] for k in ("job_id", "model", "kind", "status",
+                                                                                    "documents_done", "chunks_embedded")}})
+
+        if resync:
+            self._restart_sync(model_name, attempt=1)
+        elif status == "failed" and job["kind"] == "sync":
+            delay = min(self.sync_retry_delay * 2 ** (job["attempt"] - 1), 3600.0)
+            retry_timer = Timer(delay, self._restart_sync, args=(model_name, job["attempt"] + 1))
+            retry_timer.daemon = True
+            retry_timer.start()
+
+
+model_registry = ModelRegistry(embeddings_directory=settings.embeddings_dir or EMBEDDINGS_DIRECTORY,
+                               default_embedding_model=settings.embedding_model)
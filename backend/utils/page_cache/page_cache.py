@@ -0,0 +1,131 @@
+import hashlib
+import os
+from threading import Lock
+
+import pymupdf
+
+from utils.metrics.metrics import CACHE_EVENTS
+
+
+class PageRenderCache:
+    def __init__(self, directory: str = "page_cache", max_bytes: int = 256 * 2**20):
+        """
+        Constructor for PageRenderCache.
+
+        Renders single PDF pages to PNG images or plain text and keeps the results on disk.
+        The modification time of a cached file is refreshed on every hit, and the least recently
+        used files are deleted once the cache grows beyond max_bytes.
+
+        Parameters:
+        directory (str): The directory the rendered pages are stored in. Defaults to "page_cache".
+        max_bytes (int): The maximum total size of the cache. Defaults to 256 MiB.
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _prefix(self, pdf_name: str) -> str:
+        return hashlib.sha1(pdf_name.encode("utf-8")).hexdigest()[:16]
+
+    def version(self, pdf_path: str, page_number: int, output_format: str = "png", zoom: float = 1.5) -> str:
+        """
+        Returns the version of a rendered page, derived from the PDF's modification time and size
+        and the render options, without rendering it. The zoom is ignored for the text format.
+
+        Parameters:
+        pdf_path (str): The path of the PDF file.
+        page_number (int): The 1-based page number.
+        output_format (str): "png" or "text". Defaults to "png".
+        zoom (float): The scale of the rendered image. Defaults to 1.5.
+
+        Returns:
+        str: A hexadecimal digest that changes whenever the rendered content can change.
+        """
+        stat = os.stat(pdf_path)
+        options = f"png:{zoom}" if output_format == "png" else "text"
+        return hashlib.sha1(f"{stat.st_mtime_ns}:{stat.st_size}:{page_number}:{options}".encode("utf-8")).hexdigest()[:16]
+
+    def _cache_path(self, pdf_path: str, page_number: int, output_format: str, zoom: float) -> str:
+        version = self.version(pdf_path, page_number, output_format, zoom)
+        extension = "png" if output_format == "png" else "txt"
+        return os.path.join(self.directory,
+                            f"{self._prefix(os.path.basename(pdf_path))}-{version}-{page_number}.{extension}")
+
+    def render(self, pdf_path: str, page_number: int, output_format: str = "png", zoom: float = 1.5) -> str:
+        """
+        Returns the path of the rendered page, rendering it on a cache miss.
+
+        Only the requested page is loaded by pymupdf, so the cost does not depend on the size of the document.
+
+        Parameters:
+        pdf_path (str): The path of the PDF file.
+        page_number (int): The 1-based page number.
+        output_format (str): "png" for an image of the page, "text" for its text. Defaults to "png".
+        zoom (float): The scale of the rendered image, 1.0 is 72 dpi. Defaults to 1.5.
+
+        Returns:
+        str: The path of the cached file.
+
+        Raises:
+        IndexError: If the page does not exist in the document.
+        """
+        cache_path = self._cache_path(pdf_path, page_number, output_format, zoom)
+        if os.path.exists(cache_path):
+            os.utime(cache_path)
+            CACHE_EVENTS.inc(cache="page_render", result="hit")
+            return cache_path
+        CACHE_EVENTS.inc(cache="page_render", result="miss")
+
+        with pymupdf.open(pdf_path) as doc:
+            if not 1 <= page_number <= len(doc):
+                raise IndexError(f"Page {page_number} is out of range for a document of {len(doc)} pages")
+            page = doc.load_page(page_number - 1)
+            if output_format == "png":
+                content = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom)).tobytes("png")
+            else:
+                content = page.get_text().encode("utf-8")
+
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(content)
+        os.replace(tmp_path, cache_path)
+
+        self._evict()
+        return cache_path
+
+    def _evict(self):
+        """
+        Deletes the least recently used files until the cache fits in max_bytes.
+        """
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+    def purge(self, pdf_name: str):
+        """
+        Deletes every cached page of a PDF, used when the PDF is deleted.
+
+        Parameters:
+        pdf_name (str): The file name of the PDF.
+        """
+        prefix = self._prefix(pdf_name) + "-"
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(prefix):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
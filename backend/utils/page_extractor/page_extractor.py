@@ -0,0 +1,186 @@
+import os
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+import pymupdf
+
+from utils.worker_processes.worker_processes import worker_context
+
+
+# The pools start their processes from the fork server of worker_context, which preloads this module
+
+def _read_page_range(pdf_path: str, start: int, stop: int) -> tuple[int, list[str]]:
+    """
+    Extracts the text of the pages [start, stop) with a pymupdf handle owned by the calling process.
+
+    Returns:
+    tuple[int, list[str]]: The index of the first page and the text of each page.
+    """
+    with pymupdf.open(pdf_path) as doc:
+        return start, [doc.load_page(page_index).get_text() for page_index in range(start, stop)]
+
+
+def _ocr_page(pdf_path: str, page_index: int, language: str, dpi: int) -> tuple[int, str]:
+    """
+    Recognises the text of one page with the Tesseract OCR bundled with pymupdf.
+
+    Returns:
+    tuple[int, str]: The page index and the recognised text.
+    """
+    with pymupdf.open(pdf_path) as doc:
+        page = doc.load_page(page_index)
+        textpage = page.get_textpage_ocr(language=language, dpi=dpi, full=True)
+        return page_index, page.get_text(textpage=textpage)
+
+
+class _InlineExecutor(Executor):
+    """
+    Runs submitted calls immediately in the calling thread, used when a pool would only add overhead.
+    """
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exception:
+            future.set_exception(exception)
+        return future
+
+
+# The process pools are started once and shared by every extraction, spawning them for each PDF
+# costs more than extracting a small document
+_pools: dict[tuple[str, int], ProcessPoolExecutor] = {}
+_pools_lock = Lock()
+
+
+def _shared_pool(kind: str, workers: int) -> ProcessPoolExecutor:
+    with _pools_lock:
+        pool = _pools.get((kind, workers))
+        if pool is None:
+            pool = _pools[(kind, workers)] = ProcessPoolExecutor(max_workers=workers, mp_context=worker_context())
+        return pool
+
+
+def _discard_pool(kind: str, workers: int, pool: Executor):
+    """
+    Forgets a pool whose worker died, so the next extraction starts a new one.
+    """
+    with _pools_lock:
+        if _pools.get((kind, workers)) is pool:
+            del _pools[(kind, workers)]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_pools():
+    """
+    Stops the shared extraction and OCR processes, called when the application shuts down.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(cancel_futures=True)
+
+
+def extract_pages(pdf_path: str,
+                  workers: int = 1,
+                  ocr_enabled: bool = False,
+                  ocr_min_chars: int = 32,
+                  ocr_workers: int = 2,
+                  ocr_language: str = "eng",
+                  ocr_dpi: int = 300,
+                  min_pages_per_task: int = 8) -> tuple[list[str], list[int], list[int]]:
+    """
+    Extracts the text of every page of a PDF, splitting the page ranges across a process pool.
+
+    Pages with fewer than ocr_min_chars characters are treated as scanned. When OCR is enabled they
+    are sent to a separate pool of ocr_workers processes as soon as their range has been read, so OCR
+    of the scanned pages overlaps with the extraction of the digital ones, even with a single OCR
+    worker. The texts are returned in page order regardless of the order the tasks finish in.
+    The process pools are shared by all calls, see shutdown_pools.
+
+    Parameters:
+    pdf_path (str): The path to the PDF file.
+    workers (int): The number of extraction processes, 1 or less reads the pages in this process. Defaults to 1.
+    ocr_enabled (bool): Whether low-text pages are sent to OCR. Defaults to False.
+    ocr_min_chars (int): Pages with fewer non-whitespace characters are considered low-text. Defaults to 32.
+    ocr_workers (int): The number of OCR processes, OCR is much slower and heavier on memory than
+        extraction so it has its own limit. Defaults to 2.
+    ocr_language (str): The Tesseract language of the OCR. Defaults to "eng".
+    ocr_dpi (int): The resolution pages are rendered at for OCR. Defaults to 300.
+    min_pages_per_task (int): The minimum number of pages read by one extraction task. Defaults to 8.
+
+    Returns:
+    tuple[list[str], list[int], list[int]]: The text of each page, the indices of the low-text pages
+        and the indices of the pages whose text was recognised by OCR.
+    """
+    with pymupdf.open(pdf_path) as doc:
+        page_count = len(doc)
+
+    if page_count < 2 * min_pages_per_task:
+        workers = 1
+    pages_per_task = max(min_pages_per_task, -(-page_count // (max(workers, 1) * 4)))
+    ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+
+    texts: list[str] = [""] * page_count
+    low_text_pages: list[int] = []
+    ocr_pages: list[int] = []
+
+    extraction_workers = min(workers, len(ranges))
+    extraction_pool = _shared_pool("extraction", extraction_workers) if extraction_workers > 1 else _InlineExecutor()
+    ocr_pool = _shared_pool("ocr", max(ocr_workers, 1)) if ocr_enabled else None
+    ocr_futures = []
+    range_futures = []
+    try:
+        range_futures = [extraction_pool.submit(_read_page_range, pdf_path, start, stop) for start, stop in ranges]
+        for future in as_completed(range_futures):
+            start, range_texts = future.result()
+            texts[start:start + len(range_texts)] = range_texts
+
+            for page_index in range(start, start + len(range_texts)):
+                if len("".join(texts[page_index].split())) < ocr_min_chars:
+                    low_text_pages.append(page_index)
+                    if ocr_pool is not None:
+                        ocr_futures.append(ocr_pool.submit(_ocr_page, pdf_path, page_index, ocr_language, ocr_dpi))
+
+        for future in as_completed(ocr_futures):
+            try:
+                page_index, ocr_text = future.result()
+            except RuntimeError:
+                # Raised when Tesseract or its language data is not installed, keep the extracted text
+                continue
+            if ocr_text.strip():
+                texts[page_index] = ocr_text
+                ocr_pages.append(page_index)
+    except BrokenProcessPool:
+        if extraction_workers > 1:
+            _discard_pool("extraction", extraction_workers, extraction_pool)
+        if ocr_pool is not None:
+            _discard_pool("ocr", max(ocr_workers, 1), ocr_pool)
+        raise
+    finally:
+        # The pools outlive the call, only the tasks of this PDF that did not start are dropped
+        for future in range_futures + ocr_futures:
+            future.cancel()
+
+    return texts, sorted(low_text_pages), sorted(ocr_pages)
+
+
+if __name__ == "__main__":
+    # Compares the serial and the parallel extraction of a PDF given on the command line
+    import argparse
+    from time import perf_counter as timer
+
+    parser = argparse.ArgumentParser(description="Time the page extraction of a PDF.")
+    parser.add_argument("pdf_path", help="The PDF to extract.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Extraction processes.")
+    parser.add_argument("--ocr", action="store_true", help="OCR the low-text pages.")
+    parser.add_argument("--ocr-workers", type=int, default=2, help="OCR processes.")
+    args = parser.parse_args()
+
+    for workers in sorted({1, args.workers}):
+        start_time = timer()
+        texts, low_text_pages, ocr_pages = extract_pages(args.pdf_path, workers=workers,
+                                                         ocr_enabled=args.ocr, ocr_workers=args.ocr_workers)
+        print(f"{workers} workers: {len(texts)} pages, {len(low_text_pages)} low-text, {len(ocr_pages)} OCR "
+              f"in {timer() - start_time:.2f} seconds")
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from threading import Lock
+from time import perf_counter as timer
+import hashlib
+
+from sentence_transformers import CrossEncoder
+
+from utils.metrics.metrics import CACHE_EVENTS
+
+
+class Reranker:
+    def __init__(self,
+                 model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+                 top_k: int = 5,
+                 max_candidates: int = 20,
+                 latency_budget: float = 0.25,
+                 max_in_flight: int = 2,
+                 cache_size: int = 4096,
+                 skip_decay: float = 0.9,
+                 device: str = "cpu"):
+        """
+        Constructor for Reranker.
+
+        Parameters:
+        model_name (str): The cross-encoder used to score (query, chunk) pairs.
+        top_k (int): The number of chunks kept after re-ranking. Defaults to 5.
+        max_candidates (int): The maximum number of dense candidates that are scored. Defaults to 20.
+        latency_budget (float): The maximum estimated time in seconds a re-ranking pass may take.
+            If the estimate exceeds the budget the dense order is kept. Defaults to 0.25.
+        max_in_flight (int): The number of concurrent re-ranking passes after which new
+            requests skip re-ranking. Defaults to 2.
+        cache_size (int): The maximum number of (query, chunk) scores kept in the cache. Defaults to 4096.
+        skip_decay (float): The factor the time estimate is multiplied by whenever a pass is skipped for
+            exceeding the latency budget, so a slow pass does not disable re-ranking for good. Defaults to 0.9.
+        device (str): The device to run the cross-encoder on. Defaults to "cpu".
+
+        Sets the following attributes:
+        cross_encoder (CrossEncoder): The cross-encoder model.
+        score_cache (OrderedDict[tuple[str, str], float]): LRU cache of pair scores.
+        """
+        self.cross_encoder = CrossEncoder(model_name, device=device, max_length=512)
+        self.top_k = top_k
+        self.max_candidates = max_candidates
+        self.latency_budget = latency_budget
+        self.max_in_flight = max_in_flight
+        self.cache_size = cache_size
+        self.skip_decay = skip_decay
+
+        self.score_cache: OrderedDict[tuple[str, str], float] = OrderedDict()
+
+        # Exponentially weighted estimate of the seconds spent per scored pair
+        self.seconds_per_pair: float = 0.0
+        self._in_flight: int = 0
+        self._lock = Lock()
+
+
+    def _cache_key(self, query: str, text: str) -> tuple[str, str]:
+        """
+        Builds the cache key of a (query, chunk) pair. The chunk text is hashed so the cache
+        does not hold a second copy of every chunk.
+        """
+        return query, hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+    def _should_skip(self, n_pairs: int) -> bool:
+        """
+        Decides whether re-ranking should be skipped because the server is under load
+        or the estimated scoring time exceeds the latency budget.
+
+        The estimate is only measured by passes that run, so every pass skipped for the budget
+        decays it. After a slow spike the estimate falls back under the budget and the next pass
+        measures the actual cost again.
+        """
+        if self._in_flight >= self.max_in_flight:
+            return True
+        if self.seconds_per_pair * n_pairs > self.latency_budget:
+            self.seconds_per_pair *= self.skip_decay
+            return True
+        return False
+
+
+    def rerank(self, query: str, candidates: list[dict], texts: list[str],
+               timings: dict[str, float] | None = None) -> list[dict]:
+        """
+        Re-orders the dense retrieval candidates using cross-encoder scores and keeps the best ones.
+
+        All uncached pairs are scored in a single batch. When re-ranking is skipped the
+        dense order is kept and the first top_k candidates are returned.
+
+        Parameters:
+        query (str): The user query.
+        candidates (list[dict]): The dense retrieval results, in descending similarity order.
+        texts (list[str]): The chunk text of each candidate.
+        timings (dict[str, float] | None): If given, the timings and counters of the pass are added to it.
+
+        Returns:
+        list[dict]: At most top_k candidates, each with an added "rerank_score" key when re-ranked.
+        """
+        start_time = timer()
+        candidates = candidates[:self.max_candidates]
+        texts = texts[:self.max_candidates]
+
+        keys = [self._cache_key(query, text) for text in texts]
+        with self._lock:
+            cached = {key: self.score_cache[key] for key in keys if key in self.score_cache}
+            for key in cached:
+                self.score_cache.move_to_end(key)
+
+            missing = [i for i, key in enumerate(keys) if key not in cached]
+            skipped = self._should_skip(len(missing))
+            if not skipped:
+                self._in_flight += 1
+
+        CACHE_EVENTS.inc(len(cached), cache="rerank", result="hit")
+        CACHE_EVENTS.inc(len(missing), cache="rerank", result="miss")
+
+        if timings is None:
+            timings = {}
+        timings.update({
+                "rerank": 0.0,
+                "rerank_candidates": len(candidates),
+                "rerank_cache_hits": len(cached),
+                "rerank_skipped": float(skipped),
+                })
+
+        if skipped:
+            timings["rerank"] = timer() - start_time
+            return candidates[:self.top_k]
+
+        try:
+            scores = dict(cached)
+            if missing:
+                score_start = timer()
+                pair_scores = self.cross_encoder.predict([(query, texts[i]) for i in missing],
+                                                         batch_size=len(missing),
+                                                         show_progress_bar=False)
+                elapsed = timer() - score_start
+                for i, score in zip(missing, pair_scores):
+                    scores[keys[i]] = float(score)
+
+                with self._lock:
+                    per_pair = elapsed / len(missing)
+                    self.seconds_per_pair = per_pair if not self.seconds_per_pair \
+                            else 0.8 * self.seconds_per_pair + 0.2 * per_pair
+                    for i in missing:
+                        self.score_cache[keys[i]] = scores[keys[i]]
+                    while len(self.score_cache) > self.cache_size:
+                        self.score_cache.popitem(last=False)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+        reranked = [dict(candidate, rerank_score=scores[key]) for candidate, key in zip(candidates, keys)]
+        reranked.sort(key=lambda item: item["rerank_score"], reverse=True)
+
+        timings["rerank"] = timer() - start_time
+        return reranked[:self.top_k]
@@ -0,0 +1,216 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+import torch
+
+from utils.metrics.metrics import CACHE_EVENTS
+
+
+def cache_nbytes(past_key_values) -> int:
+    """
+    Returns the number of bytes held by the key and value tensors of a transformers cache.
+
+    Parameters:
+    past_key_values (Cache | tuple | None): A transformers Cache object or a legacy tuple of (key, value) pairs.
+
+    Returns:
+    int: The size of the cached tensors in bytes.
+    """
+    if past_key_values is None:
+        return 0
+    if hasattr(past_key_values, "layers"):
+        tensors = [tensor for layer in past_key_values.layers
+                   for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    elif hasattr(past_key_values, "key_cache"):
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    else:
+        tensors = [tensor for layer in past_key_values for tensor in layer]
+    return sum(tensor.element_size() * tensor.nelement() for tensor in tensors if isinstance(tensor, torch.Tensor))
+
+
+class Session:
+    def __init__(self, conversation_id: str):
+        """
+        Constructor for Session.
+
+        Holds the state of one conversation between turns.
+
+        Parameters:
+        conversation_id (str): The ID the client sends with every turn of the conversation.
+
+        Sets the following attributes:
+        messages (list[dict[str, str]]): The chat messages of the completed turns, the first one holds the retrieved context.
+        context_items (list[dict]): The chunks already placed in the conversation.
+        past_key_values (Cache | None): The KV cache of the model over token_ids.
+        token_ids (torch.Tensor | None): The 1D token IDs covered by past_key_values.
+        nbytes (int): The size of the KV cache when the session was last released.
+        created_at, last_used (float): monotonic() timestamps.
+        """
+        self.conversation_id = conversation_id
+        self.messages: list[dict[str, str]] = []
+        self.context_items: list[dict] = []
+        self.past_key_values = None
+        self.token_ids: torch.Tensor | None = None
+        self.nbytes: int = 0
+        self.created_at: float = monotonic()
+        self.last_used: float = self.created_at
+        self.lock = Lock()
+
+    def summary(self) -> dict[str, int | float | str]:
+        return {
+            "conversation_id": self.conversation_id,
+            "turns": len(self.messages) // 2,
+            "cached_tokens": 0 if self.token_ids is None else len(self.token_ids),
+            "kv_cache_bytes": self.nbytes,
+            "idle_seconds": round(monotonic() - self.last_used, 3),
+            }
+
+
+class SessionStore:
+    def __init__(self, max_sessions: int = 64, ttl: float = 1800.0, max_bytes: int = 2**30):
+        """
+        Constructor for SessionStore.
+
+        Keeps the sessions of the ongoing conversations. Sessions idle for longer than ttl seconds
+        are dropped, and the least recently used sessions are evicted once there are more than
+        max_sessions or their KV caches hold more than max_bytes in total.
+
+        Parameters:
+        max_sessions (int): The maximum number of sessions kept. Defaults to 64.
+        ttl (float): The number of idle seconds after which a session expires. Defaults to 1800.
+        max_bytes (int): The memory budget of all KV caches together. Defaults to 1 GiB.
+
+        Sets the following attributes:
+        sessions (OrderedDict[str, Session]): The sessions in least recently used order.
+        hits, misses, evictions, expirations (int): Counters exposed through stats().
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+        self._lock = Lock()
+
+
+    def _expire(self):
+        now = monotonic()
+        for conversation_id in [key for key, session in self.sessions.items() if now - session.last_used > self.ttl]:
+            if not self.sessions[conversation_id].lock.locked():
+                del self.sessions[conversation_id]
+                self.expirations += 1
+                CACHE_EVENTS.inc(cache="session", result="expired")
+
+
+    def _evict(self):
+        """
+        Evicts idle sessions, least recently used first, until the store fits its limits.
+        Sessions in use are skipped, their cache size is only known once they are released.
+        """
+        total_bytes = sum(session.nbytes for session in self.sessions.values())
+        for conversation_id in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions and total_bytes <= self.max_bytes:
+                break
+            session = self.sessions[conversation_id]
+            if session.lock.locked():
+                continue
+            del self.sessions[conversation_id]
+            total_bytes -= session.nbytes
+            self.evictions += 1
+            CACHE_EVENTS.inc(cache="session", result="evicted")
+
+
+    def acquire(self, conversation_id: str, timeout: float = 30.0) -> Session:
+        """
+        Returns the session of a conversation, creating it if needed, and locks it for one turn.
+
+        Parameters:
+        conversation_id (str): The conversation ID.
+        timeout (float): The number of seconds to wait while another turn of the same conversation runs.
+
+        Returns:
+        Session: The locked session, hand it back with release().
+
+        Raises:
+        TimeoutError: If the previous turn of the conversation did not finish in time.
+        """
+        with self._lock:
+            self._expire()
+            session = self.sessions.get(conversation_id)
+            if session is None:
+                session = Session(conversation_id)
+                self.sessions[conversation_id] = session
+                self.misses += 1
+                CACHE_EVENTS.inc(cache="session", result="miss")
+            else:
+                self.sessions.move_to_end(conversation_id)
+                self.hits += 1
+                CACHE_EVENTS.inc(cache="session", result="hit")
+
+        if not session.lock.acquire(timeout=timeout):
+            raise TimeoutError(f"Conversation {conversation_id} is busy")
+        return session
+
+
+    def release(self, session: Session):
+        """
+        Records the new size of a session's KV cache, unlocks it and evicts sessions over the budget.
+
+        A session that was evicted while in use is stored again, as it is now the most recently used.
+
+        Parameters:
+        session (Session): A session returned by acquire().
+        """
+        session.nbytes = cache_nbytes(session.past_key_values)
+        session.last_used = monotonic()
+        if session.nbytes > self.max_bytes:
+            # A single conversation over the whole budget keeps its history but not its KV cache
+            session.past_key_values = None
+            session.token_ids = None
+            session.nbytes = 0
+
+        with self._lock:
+            self.sessions[session.conversation_id] = session
+            self.sessions.move_to_end(session.conversation_id)
+            session.lock.release()
+            self._evict()
+
+
+    def get(self, conversation_id: str) -> Session | None:
+        """
+        Returns the session of a conversation without locking it, or None if there is none.
+        """
+        with self._lock:
+            self._expire()
+            return self.sessions.get(conversation_id)
+
+
+    def delete(self, conversation_id: str) -> bool:
+        """
+        Deletes a session.
+
+        Returns:
+        bool: Whether the session existed.
+        """
+        with self._lock:
+            return self.sessions.pop(conversation_id, None) is not None
+
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            self._expire()
+            return {
+                "sessions": len(self.sessions),
+                "kv_cache_bytes": sum(session.nbytes for session in self.sessions.values()),
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                }
@@ -0,0 +1,280 @@
+import heapq
+import os
+from threading import Lock
+from time import perf_counter as timer
+
+import numpy as np
+import pandas as pd
+import torch
+
+from utils.chunk_store.chunk_store import ChunkStore
+from utils.file_reader.file_reader import EmbeddingsReader
+from utils.logger.logger import get_logger
+from utils.metrics.metrics import STAGE_SECONDS
+from utils.shard_retriever.shard_worker import shard_worker
+from utils.worker_processes.worker_processes import worker_context
+
+
+logger = get_logger("shard_retriever")
+
+
+class ShardedEmbeddingsReader(EmbeddingsReader):
+    def __init__(self, n_shards: int = 2, imbalance_ratio: float = 1.5, embedding_model=None,
+                 embedding_dtype: str = "float32", response_timeout: float = 30.0):
+        """
+        Constructor for ShardedEmbeddingsReader.
+
+        The documents are partitioned across n_shards worker processes, each holding its own
+        memory-mapped embeddings. The parent process only keeps the chunk text and the query
+        embedding model.
+
+        Parameters:
+        n_shards (int): The number of worker processes. Defaults to 2.
+        imbalance_ratio (float): The ratio between the largest and the smallest shard above which
+            all documents are redistributed instead of only placing the new ones. Defaults to 1.5.
+        embedding_model (SentenceTransformer | None): The model used to embed queries, see EmbeddingsReader.
+        embedding_dtype (str): The dtype the shards hold the embeddings in, see EmbeddingsReader.
+        response_timeout (float): The seconds a query waits for the shards before failing. Defaults to 30.
+
+        Sets the following attributes:
+        n_shards (int): The number of worker processes.
+        assignments (dict[str, int]): The shard each CSV file is assigned to.
+        shard_sizes (list[int]): The number of embeddings held by each shard.
+        """
+        super().__init__(embedding_model=embedding_model, embedding_dtype=embedding_dtype)
+        self.n_shards = n_shards
+        self.imbalance_ratio = imbalance_ratio
+        self.assignments: dict[str, int] = {}
+        self.shard_sizes: list[int] = [0] * n_shards
+        self.batch_sizes: list[int] = []
+        self.response_timeout = response_timeout
+        self._pipe_lock = Lock()
+        self._request_id = 0
+
+        context = worker_context()
+        self._connections = []
+        self._processes = []
+        for _ in range(n_shards):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=shard_worker, args=(child_conn, embedding_dtype), daemon=True)
+            process.start()
+            self._connections.append(parent_conn)
+            self._processes.append(process)
+
+    def _request(self, messages: list[tuple[str, object]], timeout: float | None = None) -> list:
+        """
+        Sends one message to every shard and returns their replies, in shard order.
+
+        Requests from concurrent threads are serialized on the pipes, and replies are matched to
+        their request by ID, so a late reply to a request that timed out is discarded instead of
+        answering the next one. The workers are polled, so a dead worker fails the request.
+
+        Parameters:
+        messages (list[tuple[str, object]]): The (command, payload) of each shard.
+        timeout (float | None): The seconds to wait for all replies, None waits as long as the workers live.
+
+        Returns:
+        list: The reply of each shard.
+
+        Raises:
+        RuntimeError: If a worker process exited.
+        TimeoutError: If a worker did not reply in time.
+        """
+        with self._pipe_lock:
+            self._request_id += 1
+            request_id = self._request_id
+            for conn, (command, payload) in zip(self._connections, messages):
+                conn.send((command, payload, request_id))
+
+            deadline = None if timeout is None else timer() + timeout
+            replies = []
+            for shard, (conn, process) in enumerate(zip(self._connections, self._processes)):
+                while True:
+                    wait = 0.5 if deadline is None else min(0.5, max(deadline - timer(), 0.0))
+                    if conn.poll(wait):
+                        reply_id, result = conn.recv()
+                        if reply_id == request_id:
+                            replies.append(result)
+                            break
+                        continue
+                    if not process.is_alive():
+                        raise RuntimeError(f"Shard worker {shard} exited with code {process.exitcode}")
+                    if deadline is not None and timer() >= deadline:
+                        raise TimeoutError(f"Shard worker {shard} did not reply within {timeout} seconds")
+            return replies
+
+    def _rebalance(self, csv_file_paths: list[str], sizes: list[int]) -> dict[str, int]:
+        """
+        Assigns every CSV file to a shard.
+
+        Documents that are still present keep their shard so their embeddings are not reloaded,
+        new documents go to the least loaded shard. If the shards end up too unbalanced (e.g.
+        after deleting documents) all documents are redistributed, largest first.
+
+        Parameters:
+        csv_file_paths (list[str]): The CSV files currently in the corpus.
+        sizes (list[int]): The number of chunks of each CSV file.
+
+        Returns:
+        dict[str, int]: The shard of each CSV file.
+        """
+        size_of = dict(zip(csv_file_paths, sizes))
+        by_size = sorted(csv_file_paths, key=lambda path: size_of[path], reverse=True)
+
+        assignments = {path: shard for path, shard in self.assignments.items() if path in size_of}
+        loads = [0] * self.n_shards
+        for path, shard in assignments.items():
+            loads[shard] += size_of[path]
+
+        for path in by_size:
+            if path not in assignments:
+                shard = loads.index(min(loads))
+                assignments[path] = shard
+                loads[shard] += size_of[path]
+
+        if min(loads):
+            unbalanced = max(loads) / min(loads) > self.imbalance_ratio
+        else:
+            unbalanced = len(csv_file_paths) >= self.n_shards
+
+        if unbalanced:
+            assignments = {}
+            loads = [0] * self.n_shards
+            for path in by_size:
+                shard = loads.index(min(loads))
+                assignments[path] = shard
+                loads[shard] += size_of[path]
+
+        return assignments
+
+    def read_csvs(self, csv_file_pahts: list[str]):
+        """
+        Reads the chunk text of the CSV files and distributes their embeddings across the shards.
+
+        Called on start-up and whenever documents are uploaded or deleted, which rebalances the shards.
+
+        Parameters:
+        csv_file_pahts (list[str]): A list of paths to the CSV files to read
+        """
+        self.embeddings = []
+
+        documents = []
+        for csv_file_path in csv_file_pahts:
+            chunk_df = pd.read_csv(csv_file_path, usecols=["sentence_chunk", "page_number"])
+            documents.append((os.path.basename(csv_file_path).replace(".csv", ""),
+                              chunk_df["sentence_chunk"], chunk_df["page_number"]))
+        self.chunk_store = ChunkStore.from_documents(documents)
+        self.batch_sizes = [self.chunk_store.document_size(i) for i in range(len(csv_file_pahts))]
+
+        self.assignments = self._rebalance(csv_file_pahts, self.batch_sizes)
+
+        start_time = timer()
+        self.shard_sizes = self._request([("assign", {path: batch_index for batch_index, path in enumerate(csv_file_pahts)
+                                                      if self.assignments[path] == shard})
+                                          for shard in range(self.n_shards)])
+
+        self._print_message("INFO", f"Distributed {len(csv_file_pahts)} documents across {self.n_shards} shards "
+                                    f"{self.shard_sizes} in {timer() - start_time:.5f} seconds.")
+
+    def retrive_relevant_resources(self,
+                                  query: str,
+                                  n_resources_to_return: int=5,
+                                  print_time: bool=True,
+                                  query_embedding: torch.Tensor | None = None,
+                                  timings: dict[str, float] | None = None,
+                                  return_embeddings: bool = False):
+        """
+        Retrieves the top n relevant resources by fanning the query out to every shard in parallel
+        and merging their partial top k results.
+
+        Parameters:
+        query (str): The query to search for
+        n_resources_to_return (int): The number of relevant resources to return. Defaults to 5.
+        print_time (bool): If True, prints the time taken to compute the scores. Defaults to True.
+        query_embedding (torch.Tensor | None): The embedding of the query, if it was already computed by the caller.
+        timings (dict[str, float] | None): If given, the time taken by each stage is added to it.
+        return_embeddings (bool): If True, each result also holds its float32 embedding under "embedding",
+            sent back by the shard that scored it. Defaults to False.
+
+        Returns:
+        A list of dictionaries, each containing the row ID, batch index, embedding index, and similarity score of the top n most relevant resources.
+        """
+        embed_start_time = timer()
+        if query_embedding is None:
+            query_embedding = self.encode_query(query)
+        query_array = query_embedding.detach().float().cpu().numpy()
+        embed_end_time = timer()
+
+        start_time = timer()
+        chunk_store = self.chunk_store
+        replies = self._request([("query", (query_array, n_resources_to_return, return_embeddings))] * self.n_shards,
+                                timeout=self.response_timeout)
+        partial_results = [result for reply in replies for result in reply]
+        merged = heapq.nlargest(n_resources_to_return, partial_results)
+        end_time = timer()
+
+        if timings is not None:
+            timings.update({
+                    "embed_query": embed_end_time - embed_start_time,
+                    "score": end_time - start_time,
+                    })
+        STAGE_SECONDS.observe(end_time - start_time, stage="retrieval_score")
+
+        if print_time:
+            logger.debug(f"Time taken to get scores on {sum(self.shard_sizes)} embeddings "
+                                        f"across {self.n_shards} shards: {end_time - start_time:.5f} seconds.")
+
+        return [{
+            'row_id': chunk_store.row_id(batch_index, local_index),
+            'batch': batch_index,
+            'embedding_index': local_index,
+            'similarity': score,
+            **({'embedding': embedding[0]} if embedding else {}),
+            } for score, batch_index, local_index, *embedding in merged]
+
+    def close(self):
+        """
+        Stops the shard worker processes.
+        """
+        with self._pipe_lock:
+            for conn, process in zip(self._connections, self._processes):
+                if process.is_alive():
+                    conn.send(("stop", None, 0))
+        for process in self._processes:
+            process.join(timeout=5)
+
+
+if __name__ == "__main__":
+    # Measures the throughput of concurrent queries for an increasing number of shards on a synthetic corpus
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    from utils.stub_models.stub_models import StubEmbedder
+
+    n_documents, chunks_per_document, dimension, n_queries, n_clients = 32, 20_000, 768, 200, 8
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        csv_paths = []
+        for i in range(n_documents):
+            csv_path = os.path.join(directory, f"document_{i}.pdf.csv")
+            pd.DataFrame({"page_number": np.zeros(chunks_per_document, dtype=int),
+                          "sentence_chunk": [""] * chunks_per_document}).to_csv(csv_path, index=False)
+            np.save(csv_path + ".npy", rng.standard_normal((chunks_per_document, dimension), dtype=np.float32))
+            csv_paths.append(csv_path)
+
+        queries = [torch.from_numpy(query) for query in rng.standard_normal((n_queries, dimension), dtype=np.float32)]
+
+        for n_shards in [1, 2, 4, os.cpu_count() or 1]:
+            reader = ShardedEmbeddingsReader(n_shards=n_shards, embedding_model=StubEmbedder(dimension))
+            reader.read_csvs(csv_paths)
+
+            with ThreadPoolExecutor(max_workers=n_clients) as clients:
+                start_time = timer()
+                results = list(clients.map(lambda query_embedding: reader.retrive_relevant_resources(
+                    "", n_resources_to_return=5, print_time=False, query_embedding=query_embedding), queries))
+                elapsed = timer() - start_time
+
+            print(f"{n_shards} shards, {n_clients} clients: {n_queries / elapsed:.1f} queries/s "
+                  f"over {n_documents * chunks_per_document} embeddings")
+            reader.close()
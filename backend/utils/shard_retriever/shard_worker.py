@@ -0,0 +1,61 @@
+import heapq
+
+import numpy as np
+
+from utils.file_reader.file_reader import blocked_scores, load_embeddings_array, to_float32
+
+
+# Kept apart from shard_retriever so the fork server preloads only what the workers need
+
+
+def shard_worker(conn, embedding_dtype: str = "float32") -> None:
+    """
+    Main loop of a shard worker process.
+
+    The worker owns the memory-mapped embeddings of the documents assigned to it and answers
+    three kinds of messages sent over the pipe as (command, payload, request_id):
+        - ("assign", {csv_path: batch_index}): replaces the documents owned by the shard
+        - ("query", (query_embedding, k, with_embeddings)): returns the local top k as (score, batch_index,
+          local_index) tuples, followed by the float32 embedding when with_embeddings is set
+        - ("stop", None): exits the loop
+    Every reply is sent as (request_id, result).
+
+    Parameters:
+    conn (Connection): The worker end of the pipe to the parent process.
+    embedding_dtype (str): The storage dtype of the embeddings, see load_embeddings_array. Defaults to "float32".
+    """
+    documents: dict[str, tuple[int, np.ndarray]] = {}
+
+    while True:
+        command, payload, request_id = conn.recv()
+
+        if command == "stop":
+            break
+
+        if command == "assign":
+            documents = {
+                    path: (batch_index, documents[path][1] if path in documents else load_embeddings_array(path, embedding_dtype))
+                    for path, batch_index in payload.items()
+                    }
+            conn.send((request_id, sum(len(embeddings) for _, embeddings in documents.values())))
+
+        elif command == "query":
+            query_embedding, k, with_embeddings = payload
+            results: list[tuple[float, int, int]] = []
+            for batch_index, embeddings in documents.values():
+                if embeddings.size == 0:
+                    continue
+                scores = blocked_scores(embeddings, query_embedding, embedding_dtype)
+                if len(scores) > k:
+                    local_indices = np.argpartition(-scores, k - 1)[:k]
+                else:
+                    local_indices = np.arange(len(scores))
+                results.extend((float(scores[i]), batch_index, int(i)) for i in local_indices)
+            top = heapq.nlargest(k, results)
+            if with_embeddings:
+                by_batch = dict(documents.values())
+                top = [(score, batch_index, i, to_float32(by_batch[batch_index][i:i + 1], embedding_dtype)[0])
+                       for score, batch_index, i in top]
+            conn.send((request_id, top))
+
+    conn.close()
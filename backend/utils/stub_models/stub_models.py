@@ -0,0 +1,143 @@
+import re
+import zlib
+
+import numpy as np
+import torch
+from transformers import BatchEncoding, GPT2Config, GPT2LMHeadModel
+
+
+# Vocabulary of the synthetic corpora, the stub tokenizer maps every other word to a hash bucket
+WORDS = [
+    "model", "data", "training", "gradient", "descent", "loss", "function", "network", "layer", "weight",
+    "bias", "vector", "matrix", "tensor", "feature", "label", "sample", "batch", "epoch", "learning",
+    "rate", "optimizer", "regression", "classification", "cluster", "kernel", "margin", "support", "tree", "forest",
+    "boosting", "bagging", "variance", "error", "accuracy", "precision", "recall", "score", "metric", "validation",
+    "test", "split", "cross", "entropy", "probability", "distribution", "gaussian", "bayes", "prior", "posterior",
+    "likelihood", "estimate", "parameter", "hyperparameter", "search", "grid", "random", "noise", "signal", "image",
+    "text", "token", "sequence", "attention", "transformer", "encoder", "decoder", "embedding", "dimension", "space",
+    "projection", "component", "principal", "analysis", "reduction", "sparse", "dense", "linear", "nonlinear", "activation",
+    "sigmoid", "softmax", "relu", "convolution", "pooling", "recurrent", "memory", "state", "hidden", "output",
+    "input", "the", "a", "of", "and", "to", "in", "is", "that", "for",
+    "with", "as", "on", "by", "this", "are", "be", "can", "we", "which",
+    "from", "an", "it", "each", "when", "then", "more", "than", "used", "results",
+]
+
+
+class StubEmbedder:
+    def __init__(self, dimension: int = 384):
+        """
+        Constructor for StubEmbedder.
+
+        A download free stand-in for SentenceTransformer that embeds text with the hashing trick:
+        every word is hashed to a signed position of the vector and the result is L2 normalised.
+
+        Parameters:
+        dimension (int): The embedding dimension. Defaults to 384.
+        """
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def _embed(self, text: str) -> np.ndarray:
+        embedding = np.zeros(self.dimension, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            word_hash = zlib.crc32(word.encode("utf-8"))
+            embedding[word_hash % self.dimension] += 1.0 if word_hash & 1 else -1.0
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def encode(self, sentences: str | list[str], batch_size: int = 32, convert_to_tensor: bool = False,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False, **kwargs):
+        """
+        Embeds one or more sentences, mirroring SentenceTransformer.encode.
+
+        Returns:
+        np.ndarray | torch.Tensor: A 1D embedding for a single sentence, a 2D array otherwise.
+        """
+        if isinstance(sentences, str):
+            embeddings = self._embed(sentences)
+        else:
+            embeddings = np.stack([self._embed(sentence) for sentence in sentences]) if sentences \
+                    else np.zeros((0, self.dimension), dtype=np.float32)
+        return torch.from_numpy(embeddings) if convert_to_tensor else embeddings
+
+
+class StubTokenizer:
+    def __init__(self, n_hash_buckets: int = 512):
+        """
+        Constructor for StubTokenizer.
+
+        A word level tokenizer over WORDS, with unknown words hashed into n_hash_buckets ids. It
+        implements the parts of the Hugging Face tokenizer interface used by Llm and TextIteratorStreamer.
+
+        Parameters:
+        n_hash_buckets (int): The number of ids reserved for unknown words. Defaults to 512.
+        """
+        self.pad_token_id = 0
+        self.bos_token_id = 1
+        self.eos_token_id = 2
+        self._offset = 3
+        self.n_hash_buckets = n_hash_buckets
+        self.word_ids = {word: i + self._offset for i, word in enumerate(WORDS)}
+        self.vocab_size = self._offset + len(WORDS) + n_hash_buckets
+
+    def encode(self, text: str) -> list[int]:
+        ids = [self.bos_token_id]
+        for word in re.findall(r"\w+|[^\w\s]", text.lower()):
+            if word in self.word_ids:
+                ids.append(self.word_ids[word])
+            else:
+                ids.append(self._offset + len(WORDS) + zlib.crc32(word.encode("utf-8")) % self.n_hash_buckets)
+        return ids
+
+    def __call__(self, text: str, return_tensors: str = "pt", **kwargs) -> BatchEncoding:
+        input_ids = torch.tensor([self.encode(text)])
+        return BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+
+    def decode(self, token_ids, skip_special_tokens: bool = True, **kwargs) -> str:
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.tolist()
+        words = []
+        for token_id in token_ids:
+            if token_id < self._offset:
+                continue
+            index = token_id - self._offset
+            words.append(WORDS[index] if index < len(WORDS) else f"w{index - len(WORDS)}")
+        return "".join(f"{word} " for word in words)
+
+    def apply_chat_template(self, conversation: list[dict], tokenize: bool = False,
+                            add_generation_prompt: bool = True, **kwargs) -> str:
+        prompt = "".join(f"<{turn['role']}>\n{turn['content']}\n" for turn in conversation)
+        return prompt + "<model>\n" if add_generation_prompt else prompt
+
+
+def build_stub_causal_lm(tokenizer: StubTokenizer, n_layer: int = 2, n_embd: int = 128,
+                         n_positions: int = 8192, seed: int = 0) -> GPT2LMHeadModel:
+    """
+    Builds a tiny randomly initialised causal language model for the stub tokenizer.
+
+    The weights are random so the output is meaningless, but prefill and decode go through the
+    same model.generate code path as the real model, without any download.
+
+    Parameters:
+    tokenizer (StubTokenizer): The tokenizer whose vocabulary the model uses.
+    n_layer (int): The number of transformer blocks. Defaults to 2.
+    n_embd (int): The hidden size. Defaults to 128.
+    n_positions (int): The maximum sequence length. Defaults to 8192.
+    seed (int): The seed of the random initialisation. Defaults to 0.
+
+    Returns:
+    GPT2LMHeadModel: The model, in evaluation mode.
+    """
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=tokenizer.vocab_size,
+                        n_positions=n_positions,
+                        n_embd=n_embd,
+                        n_layer=n_layer,
+                        n_head=4,
+                        bos_token_id=tokenizer.bos_token_id,
+                        eos_token_id=tokenizer.eos_token_id)
+    model = GPT2LMHeadModel(config).eval()
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    return model
@@ -0,0 +1,27 @@
+import multiprocessing as mp
+
+
+# The modules holding the worker entry points, imported once by the fork server
+WORKER_MODULES = ["utils.shard_retriever.shard_worker", "utils.page_extractor.page_extractor"]
+
+
+def worker_context() -> mp.context.BaseContext:
+    """
+    Returns the multiprocessing context the retrieval shards and the extraction pools start their
+    processes with.
+
+    Workers are forked from a fork server, a separate process that preloads WORKER_MODULES but not
+    the __main__ module of the application, so a worker starts without re-importing the
+    application or inheriting the memory of the server. Platforms without a fork server use spawn.
+
+    Like spawned ones, forked workers still import the application's main module as __mp_main__
+    before running, so main.py must not build models at import time, see llm_router.get_llm.
+
+    Returns:
+    BaseContext: The forkserver context, or the spawn context where forkserver is not available.
+    """
+    if "forkserver" not in mp.get_all_start_methods():
+        return mp.get_context("spawn")
+    context = mp.get_context("forkserver")
+    context.set_forkserver_preload(WORKER_MODULES)
+    return context